@@ -5,9 +5,8 @@
 import sys
 
 import numpy as np
-from PyQt5.QtWidgets import QApplication
 
-from mainwindow import MainWindow
+from profiler import PROFILER
 
 
 if __name__ == '__main__':
@@ -22,11 +21,99 @@ if __name__ == '__main__':
         default=np.random.randint(0, 2 << 32 - 1, dtype=np.uint32),
         type=lambda s: int(s, base=0) % (2 << 32),
         help='Seed to use for random number generator when initializing particles.')
+    parser.add_argument(
+        '-p', '--playback',
+        required=False,
+        default=None,
+        metavar='FILE',
+        help='Replay a snapshot file instead of running the simulation.')
+    parser.add_argument(
+        '--trace',
+        required=False,
+        default=None,
+        metavar='FILE',
+        help='Record every profiler stage to a Chrome trace-event JSON file (chrome://tracing, ui.perfetto.dev).')
+    parser.add_argument(
+        '--flamegraph',
+        required=False,
+        default=None,
+        metavar='FILE',
+        help='Write profiler stage self-times as collapsed stacks for flamegraph tools.')
+    headless = parser.add_argument_group(
+        'headless',
+        'Run the simulation as fast as possible without a window, e.g. on nodes without a display.')
+    headless.add_argument(
+        '--headless',
+        action='store_true',
+        help='Run without a window and print the throughput at the end.')
+    headless.add_argument(
+        '--steps',
+        default=1000,
+        type=int,
+        help='Number of simulation steps (default: %(default)s).')
+    headless.add_argument(
+        '--particles',
+        default=None,
+        type=int,
+        help='Number of particles (default: NBodySimulation.max_particles).')
+    headless.add_argument(
+        '--galaxies',
+        default=None,
+        type=int,
+        help='Number of galaxies (default: NBodySimulation.num_galaxies).')
+    headless.add_argument(
+        '--dt',
+        default=1 / 60,
+        type=float,
+        help='Timestep of every step (default: %(default).4g).')
+    headless.add_argument(
+        '--backend',
+        default='cpu',
+        choices=('cpu', 'gl-compute', 'offscreen-gl'),
+        help='cpu: CPU backend, no OpenGL; gl-compute: compute shader in a surfaceless EGL context; '
+             'offscreen-gl: compute shader in a Qt offscreen context (default: %(default)s).')
+    headless.add_argument(
+        '--snapshot-every',
+        default=0,
+        type=int,
+        metavar='N',
+        help='Write a snapshot every N steps, 0 for none (default: %(default)s).')
+    headless.add_argument(
+        '--output',
+        default='nbody.snap',
+        metavar='FILE',
+        help='Snapshot file, can be replayed with --playback (default: %(default)s).')
+    collisions = headless.add_mutually_exclusive_group()
+    collisions.add_argument(
+        '--collisions',
+        action='store_true',
+        help='Merge colliding particles also with a GL backend, which needs a readback every step '
+             '(default: only with the cpu backend).')
+    collisions.add_argument(
+        '--no-collisions',
+        action='store_true',
+        help="Don't merge colliding particles.")
     args = parser.parse_args()
 
     print('Using seed {:d}'.format(args.seed))
     np.random.seed(args.seed)
 
+    if args.trace or args.flamegraph:
+        PROFILER.start_trace(args.trace, args.flamegraph)
+
+    if args.headless:
+        # no Qt or OpenGL imports before the headless backend has picked its context
+        import headless
+        try:
+            status = headless.main(args)
+        finally:
+            PROFILER.stop_trace()
+        sys.exit(status)
+
+    from PyQt5.QtWidgets import QApplication
+
+    from mainwindow import MainWindow
+
 
     app = QApplication([])
 
@@ -36,7 +123,9 @@ if __name__ == '__main__':
     # fmt.setSamples(4)
     # QSurfaceFormat.setDefaultFormat(fmt)
 
-    mw = MainWindow()
+    mw = MainWindow(args.playback)
     mw.show()
 
-    sys.exit(app.exec_())
+    status = app.exec_()
+    PROFILER.stop_trace()
+    sys.exit(status)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from profiler import profiled
+
+
+# offsets to half of the 26 neighbouring grid cells
+# every pair of adjacent cells is visited from exactly one side, pairs inside a cell are handled separately
+_HALF_NEIGHBOURS = np.array(
+    [(dx, dy, dz)
+     for dx in (-1, 0, 1)
+     for dy in (-1, 0, 1)
+     for dz in (-1, 0, 1)
+     if (dx, dy, dz) > (0, 0, 0)],
+    dtype=np.int64)
+
+# particles whose reach is this many times the median reach are "large"
+# they are tested against every particle instead of setting the grid cell size for everyone
+large_reach_factor = 4.0
+
+# maximum number of candidate pairs generated at once, bounds memory use
+max_candidates = 1 << 22
+
+
+def _reach(radius, overlap):
+    """
+    Distance from a particle's center within which another particle's reach must lie for them to collide.
+    Two particles collide when their distance is less than the sum of their reaches.
+
+    Arguments:
+        radius: array of float, particle radii
+        overlap: float in [0, 1), fraction of the radii allowed to overlap before colliding
+
+    Returns:
+        array of float
+    """
+    return np.asarray(radius, dtype=np.float64) * (1.0 - overlap)
+
+
+def _expand_ranges(starts, counts):
+    """
+    Concatenates the integer ranges [start, start + count) for every start and count.
+
+    Arguments:
+        starts: array of int
+        counts: array of int
+
+    Returns:
+        owner: array of int, index of the range each output element came from
+        values: array of int, the concatenated ranges
+    """
+    owner = np.repeat(np.arange(len(counts)), counts)
+    # position of each output element inside its own range
+    first = np.cumsum(counts) - counts
+    values = starts[owner] + (np.arange(len(owner)) - first[owner])
+    return owner, values
+
+
+def _close_pairs(position, reach, i, j):
+    """
+    Filters candidate pairs down to the ones that are actually overlapping.
+    """
+    d = position[i] - position[j]
+    dist_sq = np.einsum('ij,ij->i', d, d)
+    limit = reach[i] + reach[j]
+    hit = dist_sq < limit * limit
+    return i[hit], j[hit]
+
+
+def _grid_pairs(position, reach, index, cell_size):
+    """
+    Finds overlapping pairs among the given particles with a uniform grid.
+    Every particle's reach must be at most cell_size / 2, so colliding particles are always in the same or adjacent cells.
+
+    Arguments:
+        position: (n, 3) array of float, all particle positions
+        reach: (n,) array of float, all particle reaches
+        index: array of int, the particles to test against each other
+        cell_size: float, the grid cell edge length
+
+    Returns:
+        i, j: arrays of int, indices of overlapping pairs
+    """
+    pairs_i = []
+    pairs_j = []
+    if len(index) < 2:
+        return pairs_i, pairs_j
+
+    # integer cell coordinates, shifted to be non-negative
+    cell = np.floor(position[index] / cell_size).astype(np.int64)
+    cell -= cell.min(axis=0) - 1
+    # one past the largest coordinate plus a margin, so neighbour offsets never wrap into another row
+    extent = cell.max(axis=0) + 2
+    strides = np.array([extent[1] * extent[2], extent[2], 1], dtype=np.int64)
+    keys = cell @ strides
+
+    # sort particles by cell, so every cell is a contiguous run
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    index = index[order]
+    cell_keys, cell_starts, cell_counts = np.unique(keys, return_index=True, return_counts=True)
+    cell_ends = cell_starts + cell_counts
+
+    # pairs within the same cell: each particle against the particles after it in its cell
+    ends = np.repeat(cell_ends, cell_counts)
+    counts = ends - np.arange(len(keys)) - 1
+    for lo, hi in _chunks(counts):
+        owner, other = _expand_ranges(np.arange(lo, hi) + 1, counts[lo:hi])
+        i, j = _close_pairs(position, reach, index[owner + lo], index[other])
+        pairs_i.append(i)
+        pairs_j.append(j)
+
+    # pairs with the neighbouring cells: each occupied cell against half of its neighbours
+    for offset in _HALF_NEIGHBOURS @ strides:
+        neighbour = np.searchsorted(cell_keys, cell_keys + offset)
+        neighbour[neighbour == len(cell_keys)] = 0
+        found = cell_keys[neighbour] == cell_keys + offset
+        if not found.any():
+            continue
+        cells = np.flatnonzero(found)
+        neighbour = neighbour[cells]
+        # every particle of the cell against the whole neighbouring cell
+        particles = _expand_ranges(cell_starts[cells], cell_counts[cells])[1]
+        counts = np.repeat(cell_counts[neighbour], cell_counts[cells])
+        starts = np.repeat(cell_starts[neighbour], cell_counts[cells])
+        for lo, hi in _chunks(counts):
+            owner, other = _expand_ranges(starts[lo:hi], counts[lo:hi])
+            i, j = _close_pairs(position, reach, index[particles[owner + lo]], index[other])
+            pairs_i.append(i)
+            pairs_j.append(j)
+
+    return pairs_i, pairs_j
+
+
+def _chunks(counts):
+    """
+    Splits a sequence of per-particle candidate counts into runs of at most max_candidates candidates.
+
+    Yields:
+        lo, hi: int, the range of particles in the run
+    """
+    total = np.cumsum(counts)
+    lo = 0
+    while lo < len(counts):
+        base = total[lo - 1] if lo else 0
+        hi = int(np.searchsorted(total, base + max_candidates, side='right'))
+        # always make progress, even if one particle has too many candidates on its own
+        hi = max(hi, lo + 1)
+        yield lo, hi
+        lo = hi
+
+
+def find_collisions(position, radius, overlap=0.0):
+    """
+    Finds all pairs of overlapping particles using a uniform grid spatial hash.
+    Runs in O(N) time for particles of similar size. The few particles much larger than the rest are tested against every particle directly.
+
+    Arguments:
+        position: (n, 3) array of float, particle positions
+        radius: (n,) array of float, particle radii
+        overlap: float in [0, 1), fraction of the radii allowed to overlap before colliding
+
+    Returns:
+        i, j: arrays of int, indices of colliding pairs with i != j, each pair listed once
+    """
+    position = np.asarray(position, dtype=np.float64)
+    reach = _reach(radius, overlap)
+    n = len(reach)
+    if n < 2:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+
+    # particles with zero size never collide
+    active = reach > 0
+    median = np.median(reach[active]) if active.any() else 0.0
+    large = active & (reach > large_reach_factor * median)
+    small = np.flatnonzero(active & ~large)
+
+    pairs_i = []
+    pairs_j = []
+    if len(small):
+        cell_size = 2.0 * reach[small].max()
+        i, j = _grid_pairs(position, reach, small, cell_size)
+        pairs_i += i
+        pairs_j += j
+
+    # large particles against everything, skipping large pairs already seen from the other side
+    all_particles = np.flatnonzero(active)
+    for k in np.flatnonzero(large):
+        others = all_particles[(all_particles != k) & ~(large[all_particles] & (all_particles < k))]
+        i, j = _close_pairs(position, reach, np.full(len(others), k), others)
+        pairs_i.append(i)
+        pairs_j.append(j)
+
+    if not pairs_i:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def _group_labels(n, i, j):
+    """
+    Labels the connected groups of the collision graph.
+    A particle touching two others merges all three, so chains of collisions become a single particle.
+
+    Arguments:
+        n: int, number of particles
+        i, j: arrays of int, colliding pairs
+
+    Returns:
+        (n,) array of int, the smallest particle index in each particle's group
+    """
+    labels = np.arange(n)
+    while True:
+        old = labels.copy()
+        # pull the smaller label across every edge
+        np.minimum.at(labels, i, labels[j])
+        np.minimum.at(labels, j, labels[i])
+        # pointer jumping, so long chains collapse in a logarithmic number of passes
+        labels = labels[labels]
+        if np.array_equal(labels, old):
+            return labels
+
+
+def merge(data, i, j):
+    """
+    Inelastically merges colliding particles and compacts the buffer in place.
+    Each group of touching particles becomes one particle placed at the group's center of mass,
+    with the total mass, the total momentum, and the total volume.
+    Surviving particles keep their relative order and are moved to the front of the buffer.
+    The freed tail gets zero mass and radius.
+
+    Arguments:
+        data: structured array with 'position', 'mass', 'velocity', 'radius' fields,
+              e.g. the live part of NBodySimulation.particles_ssbo.data
+        i, j: arrays of int, colliding pairs from find_collisions
+
+    Returns:
+        int, the number of particles left at the front of data
+    """
+    n = len(data)
+    if len(i) == 0:
+        return n
+
+    labels = _group_labels(n, i, j)
+    survivors = np.flatnonzero(labels == np.arange(n))
+    # only groups with more than one member need new values
+    merged = np.unique(labels[labels != np.arange(n)])
+    members = np.flatnonzero(np.isin(labels, merged))
+    group = np.searchsorted(merged, labels[members])
+
+    mass = data['mass'][members].astype(np.float64)
+    position = data['position'][members].astype(np.float64)
+    velocity = data['velocity'][members].astype(np.float64)
+    radius = data['radius'][members].astype(np.float64)
+
+    total_mass = np.bincount(group, mass, minlength=len(merged))
+    # massless groups fall back to an unweighted average
+    weight = np.where(total_mass[group] > 0, mass, 1.0)
+    total_weight = np.bincount(group, weight, minlength=len(merged))
+    new_position = np.empty((len(merged), 3))
+    new_velocity = np.empty((len(merged), 3))
+    for k in range(3):
+        new_position[:, k] = np.bincount(group, weight * position[:, k], minlength=len(merged)) / total_weight
+        new_velocity[:, k] = np.bincount(group, weight * velocity[:, k], minlength=len(merged)) / total_weight
+    # keep the density constant, volume is conserved
+    new_radius = np.cbrt(np.bincount(group, radius ** 3, minlength=len(merged)))
+
+    data['position'][merged] = new_position
+    data['mass'][merged] = total_mass
+    data['velocity'][merged] = new_velocity
+    data['radius'][merged] = new_radius
+
+    # compact the survivors to the front and clear the tail
+    count = len(survivors)
+    data[:count] = data[survivors]
+    data[count:] = np.zeros(1, dtype=data.dtype)
+    return count
+
+
+@profiled
+def collide(data, num_particles, overlap=0.0):
+    """
+    Finds and merges all collisions among the first num_particles particles of a particle buffer.
+    Works in place on the persistently mapped particle buffer, so no upload is needed afterwards.
+
+    Arguments:
+        data: structured array with 'position', 'mass', 'velocity', 'radius' fields, e.g. NBodySimulation.particles_ssbo.data
+        num_particles: int, number of live particles at the front of data
+        overlap: float in [0, 1), fraction of the radii allowed to overlap before colliding
+
+    Returns:
+        int, the new number of live particles
+    """
+    live = data[:num_particles]
+    i, j = find_collisions(live['position'], live['radius'], overlap)
+    return merge(live, i, j)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import math
+import time
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from profiler import profiled
+
+
+# particles per block of rows in the NumPy fallback, bounds the (block, n, 3) temporaries
+numpy_block_size = 256
+
+
+class HostBuffer(object):
+    """
+    Plain host memory stand-in for MappedBufferObject when there is no OpenGL context.
+    Exposes the same data, dtype and length attributes, so code that only touches the particle data works with either.
+    """
+
+    def __init__(self, dtype, length):
+        self.dtype = dtype
+        self.length = length
+        self.data = np.zeros(length, dtype=dtype)
+
+
+def _raw(data):
+    """
+    Views a particle buffer as the vec4 pairs particle.comp reads.
+    Row i is [x, y, z, mass, vx, vy, vz, radius].
+    """
+    return data.view(np.float32).reshape(len(data), 8)
+
+
+def _step_numpy(raw, gravity_constant, dt):
+    n = len(raw)
+    pos = raw[:, 0:3]
+    mass = raw[:, 3]
+    acc = np.empty((n, 3), dtype=np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for lo in range(0, n, numpy_block_size):
+            hi = min(lo + numpy_block_size, n)
+            dpos = pos[np.newaxis, :, :] - pos[lo:hi, np.newaxis, :]
+            dist_2 = np.einsum('ijk,ijk->ij', dpos, dpos)
+            s = mass / np.sqrt(dist_2 * dist_2 * dist_2)
+            # skip self
+            s[np.arange(hi - lo), np.arange(lo, hi)] = 0.0
+            acc[lo:hi] = np.einsum('ij,ijk->ik', s, dpos)
+    acc *= gravity_constant
+    vel = raw[:, 4:7] + acc * dt
+    raw[:, 0:3] += vel * dt
+    raw[:, 4:7] = vel
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _accelerations_numba(raw, gravity_constant, acc):
+        n = raw.shape[0]
+        for i in numba.prange(n):
+            px = raw[i, 0]
+            py = raw[i, 1]
+            pz = raw[i, 2]
+            ax = np.float32(0.0)
+            ay = np.float32(0.0)
+            az = np.float32(0.0)
+            # same order and float32 arithmetic as the shader loop
+            for j in range(n):
+                if j == i:
+                    continue
+                dx = raw[j, 0] - px
+                dy = raw[j, 1] - py
+                dz = raw[j, 2] - pz
+                dist_2 = dx * dx + dy * dy + dz * dz
+                s = raw[j, 3] / math.sqrt(dist_2 * dist_2 * dist_2)
+                ax += s * dx
+                ay += s * dy
+                az += s * dz
+            acc[i, 0] = ax * gravity_constant
+            acc[i, 1] = ay * gravity_constant
+            acc[i, 2] = az * gravity_constant
+
+    @numba.njit(parallel=True, cache=True)
+    def _integrate_numba(raw, acc, dt):
+        for i in numba.prange(raw.shape[0]):
+            for k in range(3):
+                raw[i, 4 + k] += acc[i, k] * dt
+                raw[i, k] += raw[i, 4 + k] * dt
+
+    def _step_numba(raw, gravity_constant, dt):
+        acc = np.empty((len(raw), 3), dtype=np.float32)
+        _accelerations_numba(raw, gravity_constant, acc)
+        _integrate_numba(raw, acc, dt)
+
+
+@profiled
+def step(data, num_particles, gravity_constant, dt, use_numba=None):
+    """
+    Advances the first num_particles particles of a particle buffer by one step, in place.
+    Reproduces particle.comp: float32 math, unsoftened gravity from every other live particle (skipping self),
+    acc scaled by gravity_constant, then vel += acc * dt and pos += vel * dt.
+    All accelerations are computed from the positions at the start of the step.
+
+    Arguments:
+        data: structured array with 'position', 'mass', 'velocity', 'radius' fields, e.g. NBodySimulation.particles_ssbo.data
+        num_particles: int, number of live particles at the front of data
+        gravity_constant: float, gravitational constant
+        dt: float, timestep
+        use_numba: bool or None, whether to use the numba kernels, None uses them if numba is installed
+    """
+    if use_numba is None:
+        use_numba = numba is not None
+    elif use_numba and numba is None:
+        raise ImportError('numba is not installed')
+    raw = _raw(data[:num_particles])
+    gravity_constant = np.float32(gravity_constant)
+    dt = np.float32(dt)
+    if use_numba:
+        # the kernels take a contiguous array, the live part of a buffer always is one
+        _step_numba(raw, gravity_constant, dt)
+    else:
+        _step_numpy(raw, gravity_constant, dt)
+
+
+def warmup():
+    """
+    Compiles the numba kernels of step, or loads them from numba's on-disk cache, so the first step doesn't pay for it.
+
+    Returns:
+        float, seconds it took, 0 without numba
+    """
+    if numba is None:
+        return 0.0
+    start = time.perf_counter()
+    # same argument types as step passes, two particles at rest
+    raw = np.zeros((2, 8), dtype=np.float32)
+    raw[:, 3] = 1.0
+    raw[1, 0] = 1.0
+    _step_numba(raw, np.float32(1.0), np.float32(0.0))
+    return time.perf_counter() - start
+
+
+def compare(expected, actual, rtol=1e-4):
+    """
+    Compares two particle buffers, e.g. after a CPU and a GL step from the same state.
+    Errors are relative to the largest position / velocity magnitude, so particles that are nearly at rest don't dominate.
+
+    Arguments:
+        expected: structured particle array, the reference
+        actual: structured particle array of the same length
+        rtol: float, tolerance on the relative error
+
+    Returns:
+        ok: bool, True if both position and velocity errors are within rtol
+        position_error: float, max relative position error
+        velocity_error: float, max relative velocity error
+    """
+    errors = []
+    for field in ('position', 'velocity'):
+        e = expected[field].astype(np.float64)
+        a = actual[field].astype(np.float64)
+        scale = np.max(np.abs(e)) if len(e) else 0.0
+        errors.append(np.max(np.abs(a - e)) / scale if scale > 0 else 0.0)
+    position_error, velocity_error = errors
+    ok = bool(position_error <= rtol and velocity_error <= rtol)
+    return ok, position_error, velocity_error
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from profiler import profiled
+import util
+
+
+# bump when the generated particles change for the same parameters, invalidates cached initial conditions
+version = 1
+
+# stars generated per chunk, bounds the temporary arrays regardless of the number of particles
+chunk_size = 1 << 16
+
+
+def _rng(seed, *key):
+    """
+    Independent random stream for one part of the initial conditions.
+    Streams are derived from the seed and a key, not drawn one after another,
+    so every part gets the same numbers no matter in which order or on which thread it is generated.
+
+    Arguments:
+        seed: int, the simulation seed
+        key: ints, identifies the part, e.g. (galaxy, chunk)
+
+    Returns:
+        numpy.random.Generator
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=key))
+
+
+def _stars(chunk, center_position, rng, gravity_constant, center_star_mass, center_star_radius, galaxy_star_mass_factor):
+    """
+    Fills a slice of the particle buffer with stars orbiting one center star.
+
+    Arguments:
+        chunk: structured array slice of the particle buffer to fill
+        center_position: (3,) array of float, position of the galaxy's center star
+        rng: numpy.random.Generator, random stream of this chunk
+        other arguments: the NBodySimulation constants of the same name
+    """
+    n = len(chunk)
+    center_mass = np.float32(center_star_mass)
+    center_radius = np.float32(center_star_radius)
+
+    # mass is center * mass factor
+    mass = center_mass * np.float32(galaxy_star_mass_factor)
+
+    # stars are randomly distributed in a disk around the center star
+    # with a random height perturbation from the disk which is based on the radius from the center
+    # position theta
+    pt = rng.uniform(0, 2 * np.pi, n)
+    # position radius, higher chance of being closer, scaled by center star radius
+    pr = util.lerp(
+        rng.lognormal(sigma=0.5, size=n),
+        0, 1,
+        center_radius * 0.5, center_radius * 1.0)
+    # height envelope increases exponentially as radius gets smaller
+    ph = np.exp(-pr / center_radius) * center_radius / 3
+    # pick random height in that envelope
+    ph = rng.uniform(-ph, ph)
+
+    pos = np.stack([
+        pr * np.cos(pt),
+        ph,
+        pr * np.sin(pt)], axis=-1)
+    length = np.sqrt(np.sum(np.square(pos), axis=1))
+
+    # velocity needed to stay in orbit, perpendicular to position
+    # [-z, y, x] has the same length as the position
+    speed = np.sqrt(gravity_constant * (mass + center_mass) / length)
+    direction = np.stack([-pos[:, 2], pos[:, 1], pos[:, 0]], axis=-1) / length[:, np.newaxis]
+
+    chunk['mass'] = mass
+    # radius is scaled so orbiting stars have same density as center stars
+    chunk['radius'] = np.cbrt(mass / center_mass) * center_radius
+    chunk['position'] = center_position + pos
+    chunk['velocity'] = speed[:, np.newaxis] * direction
+
+
+@profiled
+def generate(
+        data,
+        num_galaxies,
+        seed,
+        gravity_constant,
+        starting_area_radius,
+        center_star_mass,
+        center_star_radius,
+        galaxy_star_mass_factor,
+        chunk_size=chunk_size,
+        workers=None):
+    """
+    Writes galaxies straight into a particle buffer, e.g. the mapped NBodySimulation.particles_ssbo.data.
+    The buffer is split evenly among the galaxies. Each galaxy's first particle is its center star, the rest orbit it.
+    Particles left over by the split are not touched.
+    The result depends only on seed and chunk_size, also when chunks are generated in parallel.
+
+    Arguments:
+        data: structured array with 'position', 'mass', 'velocity', 'radius' fields
+        num_galaxies: int, number of galaxies
+        seed: int, seed of all random streams
+        gravity_constant, starting_area_radius, center_star_mass, center_star_radius, galaxy_star_mass_factor:
+            the NBodySimulation constants of the same name
+        chunk_size: int, maximum stars generated at once
+        workers: int or None, number of threads generating chunks, None generates them on the calling thread
+
+    Returns:
+        (num_galaxies, 3) array of float, the galaxy center positions
+    """
+    num_stars_per_galaxy = len(data) // num_galaxies
+
+    # galaxy positions have their own stream, so changing the star creation keeps them the same
+    galaxy_positions = util.rand_spherical(starting_area_radius, num_galaxies, _rng(seed, 0))
+
+    jobs = []
+    for g in range(num_galaxies):
+        galaxy = data[g * num_stars_per_galaxy:(g + 1) * num_stars_per_galaxy]
+        if not len(galaxy):
+            continue
+        center_star = galaxy[:1]
+        center_star['position'] = galaxy_positions[g]
+        center_star['mass'] = center_star_mass
+        center_star['velocity'] = 0.0
+        center_star['radius'] = center_star_radius
+
+        stars = galaxy[1:]
+        for c, start in enumerate(range(0, len(stars), chunk_size)):
+            jobs.append((stars[start:start + chunk_size], galaxy_positions[g], (1, g, c)))
+
+    def run(job):
+        chunk, center_position, key = job
+        _stars(
+            chunk,
+            center_position,
+            _rng(seed, *key),
+            gravity_constant,
+            center_star_mass,
+            center_star_radius,
+            galaxy_star_mass_factor)
+
+    if workers is None or workers <= 1:
+        for job in jobs:
+            run(job)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        # NumPy releases the GIL in the heavy array operations, and chunks write disjoint slices
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(run, jobs))
+
+    return galaxy_positions
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import ctypes
 
 import numpy as np
 from OpenGL.GL import *
 
+from profiler import PROFILER
+
 
 def print_gl_version():
     # get OpenGL version strings, converting to UTF-8
@@ -145,6 +148,113 @@ def gl_sync():
     gl_lock()
     gl_wait()
 
+class GpuTimer(object):
+    """
+    Measures the GPU time of profiler stages with GL_TIMESTAMP queries.
+    Query results are read back frames later, once the GPU has finished with them, so timing never stalls the pipeline.
+    Timestamp pairs are used rather than GL_TIME_ELAPSED so timed stages can nest.
+    Needs OpenGL 3.3 or ARB_timer_query, which Mesa's llvmpipe provides.
+    """
+
+    latency = 4 # query pairs per stage, so results are read up to this many frames after they were issued
+
+    def __init__(self, profiler=PROFILER):
+        """
+        Arguments:
+            profiler: Profiler, receives the GPU times of its stages
+        """
+        self.profiler = profiler
+        # whether the context supports timestamp queries, checked on first use
+        self.enabled = None
+        # stage runs not timed because all of the stage's queries were still in flight
+        self.dropped = 0
+        # stage -> unused query pairs
+        self._free = {}
+        # stage -> query pairs allocated for it
+        self._allocated = collections.Counter()
+        # stage -> query pair of the currently running stage, None if it isn't timed this frame
+        self._open = {}
+        # (stage, query pair) in the order they were issued
+        self._pending = collections.deque()
+
+    def _check(self):
+        if self.enabled is None:
+            bits = np.zeros(1, dtype=np.int32)
+            try:
+                glGetQueryiv(GL_TIMESTAMP, GL_QUERY_COUNTER_BITS, bits)
+                self.enabled = bool(bits[0])
+            except GLError:
+                self.enabled = False
+            if not self.enabled:
+                print('WARNING: GL_TIMESTAMP queries are not supported, GPU stage times are disabled')
+        return self.enabled
+
+    def begin(self, stage):
+        """
+        Marks the start of a stage's GPU commands.
+
+        Arguments:
+            stage: str or profiler.Stage, the profiler stage
+        """
+        if not self._check():
+            return
+        if isinstance(stage, str):
+            stage = self.profiler.handle(stage)
+        free = self._free.setdefault(stage, [])
+        if not free:
+            if self._allocated[stage] >= self.latency:
+                # all of this stage's queries are waiting for the GPU, skip timing rather than wait
+                self.dropped += 1
+                self._open[stage] = None
+                return
+            free.append(tuple(int(q) for q in glGenQueries(2)))
+            self._allocated[stage] += 1
+        queries = free.pop()
+        glQueryCounter(queries[0], GL_TIMESTAMP)
+        self._open[stage] = queries
+
+    def end(self, stage):
+        """
+        Marks the end of a stage's GPU commands.
+
+        Arguments:
+            stage: str or profiler.Stage, the profiler stage
+        """
+        if not self.enabled:
+            return
+        if isinstance(stage, str):
+            stage = self.profiler.handle(stage)
+        queries = self._open.pop(stage, None)
+        if queries is not None:
+            glQueryCounter(queries[1], GL_TIMESTAMP)
+            self._pending.append((stage, queries))
+
+    def collect(self):
+        """
+        Reads back every finished query and adds its time to the profiler stage. Never waits for the GPU.
+        Call once per frame.
+
+        Returns:
+            int, number of stage times collected
+        """
+        collected = 0
+        pending = self._pending
+        while pending:
+            stage, (begin_query, end_query) = pending[0]
+            # queries finish in the order they were issued, so stop at the first unfinished one
+            if not glGetQueryObjectiv(end_query, GL_QUERY_RESULT_AVAILABLE):
+                break
+            pending.popleft()
+            begin_time = glGetQueryObjectui64v(begin_query, GL_QUERY_RESULT)
+            end_time = glGetQueryObjectui64v(end_query, GL_QUERY_RESULT)
+            stage.add_gpu_time(int(end_time) - int(begin_time))
+            self._free[stage].append((begin_query, end_query))
+            collected += 1
+        return collected
+
+# global GPU timer for PROFILER stages
+GPU_TIMER = GpuTimer()
+
 def setup_vbo_attrs(vbo, shader, attr_prefix=None, divisor=0):
     """
     Creates all the necessary shader attribute bindings for the given VBO.
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import os
+import time
+
+
+# --backend choices
+# 'cpu' runs NBodySimulation's CPU backend and needs no OpenGL at all
+# 'gl-compute' runs particle.comp in a surfaceless EGL context, no window system needed
+# 'offscreen-gl' runs particle.comp in a Qt offscreen surface context, uses whatever platform Qt is configured with
+backends = ('cpu', 'gl-compute', 'offscreen-gl')
+# OpenGL version particle.comp needs
+gl_version = (4, 5)
+
+
+def _egl_context():
+    """
+    Creates and makes current a surfaceless EGL context, e.g. on Mesa llvmpipe or a GPU node without a display.
+    Must run before OpenGL.GL is imported anywhere, since PyOpenGL picks its platform on first import.
+
+    Returns:
+        (display, context), keep them alive for as long as the context is used
+    """
+    os.environ['PYOPENGL_PLATFORM'] = 'egl'
+    from OpenGL import EGL
+
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+        raise RuntimeError('could not initialize EGL')
+
+    config = EGL.EGLConfig()
+    num_configs = EGL.EGLint()
+    config_attribs = (EGL.EGLint * 5)(
+        EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+        EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+        EGL.EGL_NONE)
+    if not EGL.eglChooseConfig(display, config_attribs, ctypes.pointer(config), 1, ctypes.pointer(num_configs)) \
+            or num_configs.value < 1:
+        raise RuntimeError('no EGL config supports desktop OpenGL')
+
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context_attribs = (EGL.EGLint * 7)(
+        EGL.EGL_CONTEXT_MAJOR_VERSION, gl_version[0],
+        EGL.EGL_CONTEXT_MINOR_VERSION, gl_version[1],
+        EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+        EGL.EGL_NONE)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, context_attribs)
+    if not context:
+        raise RuntimeError('could not create an OpenGL {}.{} EGL context'.format(*gl_version))
+    # no surface at all, compute shaders and buffers don't need one
+    if not EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context):
+        raise RuntimeError('could not make the EGL context current (needs EGL_KHR_surfaceless_context)')
+    return display, context
+
+
+def _qt_context():
+    """
+    Creates and makes current an OpenGL context on a Qt offscreen surface, no window is shown.
+
+    Returns:
+        (app, surface, context), keep them alive for as long as the context is used
+    """
+    from PyQt5.QtGui import QGuiApplication, QOffscreenSurface, QOpenGLContext, QSurfaceFormat
+
+    fmt = QSurfaceFormat()
+    fmt.setVersion(*gl_version)
+    fmt.setProfile(QSurfaceFormat.CoreProfile)
+    # never wait for vsync
+    fmt.setSwapInterval(0)
+    QSurfaceFormat.setDefaultFormat(fmt)
+
+    app = QGuiApplication([])
+    surface = QOffscreenSurface()
+    surface.setFormat(fmt)
+    surface.create()
+    context = QOpenGLContext()
+    context.setFormat(fmt)
+    if not context.create() or not context.makeCurrent(surface):
+        raise RuntimeError('could not create an OpenGL {}.{} context on an offscreen surface'.format(*gl_version))
+    return app, surface, context
+
+
+def run(
+        backend='cpu',
+        steps=1000,
+        dt=1 / 60,
+        num_particles=None,
+        num_galaxies=None,
+        seed=None,
+        snapshot_every=0,
+        output=None,
+        merge_collisions=None):
+    """
+    Runs the simulation as fast as possible without a window and prints the throughput.
+
+    Arguments:
+        backend: str in headless.backends
+        steps: int, number of updates
+        dt: float, timestep of every update
+        num_particles: int or None, particles to start with, rounded down to a multiple of the galaxies, None uses NBodySimulation.max_particles
+        num_galaxies: int or None, galaxies to generate, None uses NBodySimulation.num_galaxies
+        seed: int or None, seed of the initial conditions, None draws one from numpy.random
+        snapshot_every: int, write a snapshot every this many steps (and of the initial state), 0 for none
+        output: str or None, snapshot file, needed when snapshot_every is set
+        merge_collisions: bool or None, merge colliding particles after every step,
+                          with a GL backend this reads the particle buffer back every step,
+                          None uses the NBodySimulation default (only with the cpu backend)
+
+    Returns:
+        dict with 'steps', 'seconds', 'compile_seconds', 'interactions' and 'interactions_per_second',
+        seconds is the run time of the steps, compile_seconds the kernel compilation before them
+    """
+    if backend not in backends:
+        raise ValueError('Unknown backend {!r}, expected one of {}'.format(backend, backends))
+    if snapshot_every and not output:
+        raise ValueError('snapshot_every needs an output file')
+
+    # the context has to exist before the simulation compiles its shader
+    context = None
+    if backend == 'gl-compute':
+        context = _egl_context()
+    elif backend == 'offscreen-gl':
+        context = _qt_context()
+
+    # imported here so PyOpenGL sees the platform chosen above
+    from sim import NBodySimulation
+    from profiler import PROFILER
+    import cpu
+    import snapshot
+
+    if context is not None:
+        from gl_util import GPU_TIMER, gl_wait, print_gl_version
+        print_gl_version()
+
+    sim = NBodySimulation(
+        backend='cpu' if backend == 'cpu' else 'gl',
+        seed=seed,
+        num_particles=num_particles,
+        num_galaxies=num_galaxies)
+    if merge_collisions is not None:
+        sim.merge_collisions = merge_collisions
+
+    writer = None
+    if snapshot_every:
+        writer = snapshot.particle_writer(
+            output,
+            sim.particles_ssbo.data,
+            # production runs keep every frame, a full queue waits for the disk
+            on_full='block',
+            attrs=dict(
+                seed=sim.seed,
+                dt=dt,
+                gravity_constant=sim.gravity_constant,
+                collision_overlap=sim.collision_overlap))
+        writer.write(sim.particles_ssbo.data[:sim.num_particles], step=0, time=0.0)
+
+    compile_seconds = 0.0
+    if backend == 'cpu':
+        # compile (or load from the cache) before the clock starts, so steps/s is the run time alone
+        compile_seconds = cpu.warmup()
+        print('Numba kernels ready in {:.3f} s'.format(compile_seconds))
+
+    print('Running {:,d} steps of {:,d} particles on {}'.format(steps, sim.num_particles, backend))
+    interactions = 0
+    start_time = time.perf_counter()
+    try:
+        for step in range(1, steps + 1):
+            PROFILER.begin()
+            if context is not None:
+                GPU_TIMER.collect()
+            n = sim.num_particles
+            sim.update(dt)
+            interactions += n * (n - 1)
+            if writer is not None and step % snapshot_every == 0:
+                PROFILER.begin('snapshot')
+                if context is not None:
+                    # the only readback in the loop, unless collisions are merged
+                    gl_wait()
+                writer.write(sim.particles_ssbo.data[:sim.num_particles], step=step, time=step * dt)
+            PROFILER.end()
+        if context is not None:
+            # updates don't wait for the GPU, so wait for the last one before stopping the clock
+            gl_wait()
+        seconds = time.perf_counter() - start_time
+    finally:
+        if writer is not None:
+            writer.close()
+
+    PROFILER.print_stages()
+    print('{:,d} steps in {:.3f} s ({:.3g} steps/s), {:,d} particles left'.format(
+        steps,
+        seconds,
+        steps / seconds,
+        sim.num_particles))
+    print('{:.4g} interactions/s'.format(interactions / seconds))
+    if writer is not None:
+        print('Wrote {:,d} snapshots to {}'.format(writer.written, output))
+    return dict(
+        steps=steps,
+        seconds=seconds,
+        compile_seconds=compile_seconds,
+        interactions=interactions,
+        interactions_per_second=interactions / seconds)
+
+
+def main(args):
+    """
+    Entry point of nbody --headless.
+
+    Arguments:
+        args: argparse.Namespace from __main__
+    """
+    run(
+        backend=args.backend,
+        steps=args.steps,
+        dt=args.dt,
+        num_particles=args.particles,
+        num_galaxies=args.galaxies,
+        # __main__ seeded numpy.random with --seed, draw the simulation seed from it like the GUI's
+        # NBodySimulation() does, so the same --seed gives the same initial conditions in both
+        seed=None,
+        snapshot_every=args.snapshot_every,
+        output=args.output,
+        merge_collisions=True if args.collisions else False if args.no_collisions else None)
+    return 0
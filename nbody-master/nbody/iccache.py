@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+# cache directory, can be overridden with the NBODY_CACHE_DIR environment variable
+cache_dir = os.environ.get(
+    'NBODY_CACHE_DIR',
+    os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'nbody', 'ic'))
+# eviction limits, least recently used files are removed first
+max_bytes = 4 << 30
+max_entries = 16
+
+# file name suffix of cache entries
+_suffix = '.npy'
+
+
+def cache_key(params, dtype, length):
+    """
+    Hashes everything that determines the generated particles.
+
+    Arguments:
+        params: dict of JSON-serializable values, the seed and generator parameters
+        dtype: numpy.dtype, the particle buffer layout
+        length: int, the number of particles
+
+    Returns:
+        str, hex digest
+    """
+    desc = json.dumps({
+        'params': params,
+        'dtype': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'length': int(length),
+    }, sort_keys=True, default=_to_builtin)
+    return hashlib.sha256(desc.encode('utf-8')).hexdigest()
+
+
+def _to_builtin(value):
+    """
+    JSON fallback for NumPy scalars.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def _path(key, directory):
+    return os.path.join(directory, key + _suffix)
+
+
+def load(key, data, directory=None):
+    """
+    Copies a cached particle array into data, if there is one that matches.
+    The file is memory-mapped, so the read goes straight from the page cache into data.
+
+    Arguments:
+        key: str, from cache_key
+        data: structured array to fill, e.g. NBodySimulation.particles_ssbo.data
+        directory: str or None, cache directory, None uses iccache.cache_dir
+
+    Returns:
+        bool, True if data was filled from the cache
+    """
+    path = _path(key, directory or cache_dir)
+    try:
+        cached = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return False
+    try:
+        if cached.dtype != data.dtype or cached.shape != data.shape:
+            return False
+        data[:] = cached
+    finally:
+        # close the mapping now rather than whenever the array is collected
+        mm = getattr(cached, '_mmap', None)
+        if mm is not None:
+            mm.close()
+    # mark as recently used for eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return True
+
+
+def store(key, data, directory=None):
+    """
+    Writes a particle array to the cache, then evicts old entries.
+    The file is written under a temporary name and renamed, so concurrent runs never see a partial file.
+
+    Arguments:
+        key: str, from cache_key
+        data: structured array to store
+        directory: str or None, cache directory, None uses iccache.cache_dir
+    """
+    directory = directory or cache_dir
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, _path(key, directory))
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    evict(directory, keep=key)
+
+
+def evict(directory=None, max_bytes=None, max_entries=None, keep=None):
+    """
+    Removes least recently used cache entries until the directory is within the limits.
+
+    Arguments:
+        directory: str or None, cache directory, None uses iccache.cache_dir
+        max_bytes: int or None, total size limit, None uses iccache.max_bytes
+        max_entries: int or None, entry count limit, None uses iccache.max_entries
+        keep: str or None, key of an entry that is never removed, e.g. the one just stored
+
+    Returns:
+        [str], the removed paths
+    """
+    directory = directory or cache_dir
+    max_bytes = globals()['max_bytes'] if max_bytes is None else max_bytes
+    max_entries = globals()['max_entries'] if max_entries is None else max_entries
+
+    entries = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    for name in names:
+        if not name.endswith(_suffix):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    # most recently used first
+    entries.sort(reverse=True)
+
+    removed = []
+    total = 0
+    count = 0
+    full = False
+    keep_path = _path(keep, directory) if keep is not None else None
+    for mtime, size, path in entries:
+        # once one entry doesn't fit, every older one goes too
+        full = full or total + size > max_bytes or count >= max_entries
+        if path == keep_path or not full:
+            total += size
+            count += 1
+            continue
+        try:
+            os.remove(path)
+            removed.append(path)
+        except OSError:
+            pass
+    return removed
+
+
+def load_or_generate(data, generate, params, directory=None):
+    """
+    Fills data from the cache, or calls generate(data) and caches the result.
+
+    Arguments:
+        data: structured array to fill, e.g. NBodySimulation.particles_ssbo.data
+        generate: callable taking data, writes the initial conditions into it
+        params: dict, everything generate depends on (see cache_key)
+        directory: str or None, cache directory, None uses iccache.cache_dir
+
+    Returns:
+        bool, True if data came from the cache
+    """
+    key = cache_key(params, data.dtype, len(data))
+    if load(key, data, directory):
+        return True
+    generate(data)
+    try:
+        store(key, data, directory)
+    except OSError as e:
+        # a read-only or full disk shouldn't stop the simulation
+        print('WARNING: could not cache initial conditions: {}'.format(e))
+    return False
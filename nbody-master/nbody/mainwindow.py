@@ -6,12 +6,16 @@ from simulationview import SimulationView
 
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, playback=None):
+        """
+        Arguments:
+            playback: str or None, snapshot file to replay instead of running the simulation
+        """
         super().__init__()
 
         self.setWindowTitle('CS 4732 Final Project — N-Body Simulator — Daniel Beckwith')
 
-        self.sim_view = SimulationView(self)
+        self.sim_view = SimulationView(self, playback)
 
         self.setCentralWidget(self.sim_view)
 
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from OpenGL.GL import *
+
+from profiler import PROFILER
+from sim import NBodySimulation
+import snapshot
+from gl_util import *
+
+
+class SnapshotPlayback(object):
+    """
+    Replays a particle snapshot file in place of NBodySimulation.
+    Has the attributes SimulationView uses for drawing (particles_ssbo, num_particles, collision_overlap),
+    and update(dt) advances the playback instead of the simulation.
+    """
+
+    frame_rate = 30.0 # snapshot frames shown per second at speed 1
+    prefetch = 16 # frames read ahead of the current one
+    min_speed = 1.0 / 64 # slowest playback speed
+    max_speed = 64.0 # fastest playback speed
+
+    def __init__(self, path, loop=True):
+        """
+        Arguments:
+            path: str, snapshot file written with snapshot.particle_writer
+            loop: bool, wrap around at either end of the file instead of stopping
+        """
+        self.player = snapshot.SnapshotPlayer(path, self.prefetch)
+        reader = self.player.reader
+        if not len(reader):
+            raise ValueError('{} has no frames'.format(path))
+        if reader.dtype != NBodySimulation.particle_dtype or len(reader.shape) != 1:
+            raise ValueError('{} does not hold particle frames'.format(path))
+        self.collision_overlap = reader.attrs.get('collision_overlap', NBodySimulation.collision_overlap)
+        self.loop = loop
+        self.speed = 1.0 # playback speed, negative plays backwards
+        self.position = 0.0 # current frame, fractional between frames
+
+        print('Creating playback buffer')
+        # same buffer the simulation draws from, frames are copied straight into the mapped memory
+        self.particles_ssbo = MappedBufferObject(
+            target=GL_SHADER_STORAGE_BUFFER,
+            dtype=reader.dtype,
+            length=reader.shape[0],
+            flags=GL_MAP_READ_BIT | GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT)
+        print('Playing {:,d} frames of up to {:,d} particles'.format(len(reader), reader.shape[0]))
+
+        self.frame = None
+        self.num_particles = 0
+        self._step = 1 # frame increment of the last update, where the prefetcher reads ahead
+        self._show(0)
+
+    @property
+    def num_frames(self):
+        return len(self.player)
+
+    def update(self, dt):
+        """
+        Advances the playback.
+
+        Arguments:
+            dt: float in (0, inf), time in seconds since last update
+        """
+        PROFILER.begin('update')
+
+        PROFILER.begin('update.playback')
+        advance = dt * self.speed * self.frame_rate
+        # prefetch the frames this speed will reach next, at least one frame apart
+        self._step = int(np.copysign(max(1, int(round(abs(advance)))), advance))
+        self.position += advance
+        self._show(int(np.floor(self.position)))
+
+        PROFILER.end('update')
+
+    def seek(self, frame):
+        """
+        Jumps to a frame.
+
+        Arguments:
+            frame: int, frame index, clamped or wrapped to the file
+        """
+        self.position = float(frame)
+        self._show(int(frame))
+
+    def set_speed(self, speed):
+        """
+        Arguments:
+            speed: float, playback speed multiplier, negative plays backwards, clamped to [min_speed, max_speed]
+        """
+        self.speed = np.copysign(np.clip(abs(speed), self.min_speed, self.max_speed), speed)
+
+    def _show(self, frame):
+        """
+        Uploads a frame into particles_ssbo, unless it is already shown.
+        """
+        n = self.num_frames
+        if self.loop:
+            frame %= n
+            self.position %= n
+        else:
+            frame = min(max(frame, 0), n - 1)
+            self.position = min(max(self.position, 0.0), float(n - 1))
+        if frame == self.frame:
+            return
+        # a draw may still be reading the buffer
+        gl_wait()
+        self.num_particles = self.player.read(frame, self.particles_ssbo.data, self._step)
+        self.frame = frame
+
+    def close(self):
+        self.player.close()
@@ -1,159 +1,421 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import functools
+import json
+import queue
 import sys
-import time
+import threading
+from time import perf_counter_ns
 
 import numpy as np
 
 
+# timing statistics of a stage, in seconds
+StageStats = collections.namedtuple('StageStats', ['count', 'mean', 'p50', 'p95', 'p99', 'max'])
+
+
 class Profiler(object):
     """
     Class for profiling an update loop.
+    Every thread has its own stage tree and current stage, so threads can begin and end stages independently;
+    the trees are merged by stage name when reporting.
     """
 
     # separating character between stage name parts
     stage_name_separator = '.'
+    # timings kept per stage, older ones are overwritten so memory stays fixed however long the loop runs
+    capacity = 4096
 
-    def __init__(self):
-        # make root stage
-        self._root_stage = Stage('total', None)
-        self._curr_stage_name = None
+    def __init__(self, capacity=None):
+        """
+        Arguments:
+            capacity: int or None, timings kept per stage and thread, None uses Profiler.capacity
+        """
+        if capacity is not None:
+            self.capacity = capacity
+        # _ThreadStages of the calling thread
+        self._local = threading.local()
+        # _ThreadStages of every thread that used the profiler
+        self._threads = []
+        self._threads_lock = threading.Lock()
+        # TraceRecorder while recording events, see start_trace
+        self._recorder = None
 
-    def begin(self, stage_name=''):
+    def _state(self):
         """
-        Indicate that the given stage is about to begin.
-        If no stage name is given, indicates that the entire loop is about to begin.
+        Stage tree of the calling thread, created on its first use.
+        """
+        try:
+            return self._local.state
+        except AttributeError:
+            state = self._local.state = _ThreadStages(self.capacity)
+            with self._threads_lock:
+                self._threads.append(state)
+            return state
+
+    def handle(self, stage_name=''):
+        """
+        Resolves a stage name to the calling thread's stage, creating it if it doesn't exist.
+        begin() and end() accept the returned stage in place of the name, which skips the name lookup entirely.
 
         Arguments:
             stage_name: str, the stage name, with hierarchical names separated by Profiler.stage_name_separator
+
+        Returns:
+            Stage
+        """
+        return self._handle(self._state(), stage_name)
+
+    def _handle(self, state, stage):
+        """
+        Resolves a stage name, or a stage of another thread, to a stage of the given thread's tree.
+        """
+        if isinstance(stage, Stage):
+            if stage.path[0] is state.root:
+                return stage
+            stage = stage.full_name
+        handle = state.handles.get(stage)
+        if handle is None:
+            handle = state.root
+            for part in stage.split(self.stage_name_separator):
+                sub_stage = handle.get_sub_stage(part)
+                if sub_stage not in state.stages:
+                    state.stages.append(sub_stage)
+                handle = sub_stage
+            state.handles[stage] = handle
+        return handle
+
+    def child(self, name):
+        """
+        Resolves a stage below the calling thread's current stage, e.g. 'step' while in 'update.cpu' is 'update.cpu.step'.
+
+        Arguments:
+            name: str, the stage name relative to the current stage
+
+        Returns:
+            Stage
+        """
+        state = self._state()
+        parent = state.curr_path[-1] if state.curr_path else state.root
+        stage = state.children.get((parent, name))
+        if stage is None:
+            full_name = parent.full_name + self.stage_name_separator + name if parent.full_name else name
+            stage = state.children[(parent, name)] = self._handle(state, full_name)
+        return stage
+
+    def begin(self, stage=''):
+        """
+        Indicate that the given stage is about to begin on the calling thread.
+        If no stage is given, indicates that the entire loop is about to begin.
+
+        Arguments:
+            stage: str or Stage, the stage name, with hierarchical names separated by Profiler.stage_name_separator,
+                   or a stage from Profiler.handle
         """
         # capture the current time
-        t = time.time()
-        # parse the name
-        stage_name = self._split_name(stage_name)
+        t = perf_counter_ns()
+        state = self._state()
+        path = (state.handles.get(stage) or self._handle(state, stage)).path
+        curr_path = state.curr_path
+        if len(path) == 1:
+            # the loop was begun explicitly, so the root stage times a whole loop
+            state.loop = True
+
+        # find the common root of the current stage and the new stage
+        common = 0
+        common_max = min(len(path), len(curr_path))
+        while common < common_max and path[common] is curr_path[common]:
+            common += 1
 
         # ensure that the previous stage is ended
-        self._end(t, stage_name)
-
-        # add a begin-time to all stage parts of the new stage name that share a common root with the current stage
-        stage = self._root_stage
-        add_begin = False
-        for i, part in enumerate(stage_name):
-            if i > 0:
-                stage = stage.get_sub_stage(part)
-            if not add_begin and not (self._curr_stage_name and i < len(self._curr_stage_name) and part == self._curr_stage_name[i]):
-                add_begin = True
-            if add_begin:
-                stage.add_begin(t)
+        for s in curr_path[common:]:
+            s._new_end_time = t
+        # add a begin-time to all stage parts of the new stage that aren't shared with the current stage
+        for s in path[common:]:
+            s._new_begin_time = t
+
+        if self._recorder is not None:
+            self._recorder.transition(t, curr_path[common:], path[common:])
 
         # set new current stage
-        self._curr_stage_name = stage_name
+        state.curr_path = path
 
-    def _end(self, t, stage_name):
+    def end(self, stage=''):
         """
-        Ensures that the previous stage has ended properly by adding an end-time to it.
+        Indicate that the given stage has just ended on the calling thread.
+        If no stage is given, indicates that the entire loop has just ended.
 
         Arguments:
-            t: float, the time of the event
-            stage_name: [str], the new parsed stage name
+            stage: str or Stage, the stage name, with hierarchical names separated by Profiler.stage_name_separator,
+                   or a stage from Profiler.handle
+        """
+        # capture event time
+        t = perf_counter_ns()
+        state = self._state()
+        path = (state.handles.get(stage) or self._handle(state, stage)).path
+        curr_path = state.curr_path
+
+        # end every part of the current stage below the ended stage's parent
+        common = 0
+        common_max = min(len(path) - 1, len(curr_path))
+        while common < common_max and path[common] is curr_path[common]:
+            common += 1
+        for s in curr_path[common:]:
+            s._new_end_time = t
+        if self._recorder is not None:
+            self._recorder.transition(t, curr_path[common:], ())
+        # now that this stage is ended, back up the stage hierarchy to its parent
+        state.curr_path = curr_path[:common]
+
+        # if this was the root stage ending, commit all the results from this loop
+        if len(path) == 1:
+            if not state.loop:
+                # the root only wrapped a stage() block outside of any loop, that isn't a loop time
+                state.root._new_begin_time = None
+            state.loop = False
+            # stages that didn't run this loop keep their previous times
+            for s in state.stages:
+                if s._new_begin_time is not None and s._new_end_time is not None:
+                    s.commit()
+
+    def stage(self, stage_name):
+        """
+        Context manager timing a block as a stage on the calling thread.
+        If no stage is running on the thread, the block is also a whole loop, so worker threads commit their times
+        after every block.
+
+            with PROFILER.stage('update.forces'):
+                ...
+
+        Arguments:
+            stage_name: str or Stage, the stage name, with hierarchical names separated by Profiler.stage_name_separator
 
         Returns:
-            int, how many stage parts got new end-times
-        """
-        ended_count = 0
-        if self._curr_stage_name:
-            # add an end-time to all stage parts of the current stage name that share a common root with the new stage
-            stage = self._root_stage
-            add_end = False
-            for i, part in enumerate(self._curr_stage_name):
-                if i > 0:
-                    stage = stage.get_sub_stage(part)
-                if not add_end and not (stage_name and i < len(stage_name) and part == stage_name[i]):
-                    add_end = True
-                if add_end:
-                    stage.add_end(t)
-                    ended_count += 1
-        return ended_count
-
-    def end(self, stage_name=''):
-        """
-        Indicate that the given stage has just ended.
-        If no stage name is given, indicates that the entire loop has just ended.
+            context manager
+        """
+        return _StageBlock(self, stage_name)
+
+    def start_trace(self, trace_path=None, collapsed_path=None):
+        """
+        Starts recording every stage begin and end, until stop_trace().
 
         Arguments:
-            stage_name: str, the stage name, with hierarchical names separated by Profiler.stage_name_separator
+            trace_path: str or None, Chrome trace-event JSON file, opens in chrome://tracing and ui.perfetto.dev
+            collapsed_path: str or None, collapsed-stack text for flamegraph.pl, inferno or speedscope
         """
-        # capture event time
-        t = time.time()
-        # parse stage name
-        stage_name = self._split_name(stage_name)
-        # end the current stage
-        ended_count = self._end(t, stage_name[:-1])
-        # now that this stage is ended, back up stage hierarchy by how many were ended
-        self._curr_stage_name = self._curr_stage_name[:-ended_count]
+        self.stop_trace()
+        self._recorder = TraceRecorder(trace_path, collapsed_path)
 
-        # if this was the root stage ending, commit all the results from this loop
-        if stage_name == [self._root_stage.name]:
-            # only commit if every stage got new times
-            if all(stage.has_new_times for stage in self._root_stage.iter_preorder()):
-                for stage in self._root_stage.iter_preorder():
-                    stage.commit()
+    def stop_trace(self):
+        """
+        Stops recording and finishes writing the trace files.
+        """
+        recorder, self._recorder = self._recorder, None
+        if recorder is not None:
+            recorder.close()
 
-    def _split_name(self, name):
+    def _merged(self):
         """
-        Parses the given stage name into stage parts.
+        Stages of all threads merged by full name.
 
-        Arguments:
-            name: str
+        Returns:
+            stages: dict of str full stage name -> [Stage], in creation order
+            children: dict of str full stage name -> [str], the child stage names
+        """
+        stages = {}
+        children = collections.defaultdict(list)
+        with self._threads_lock:
+            threads = list(self._threads)
+        for state in threads:
+            for stage in state.root.iter_preorder():
+                if stage.full_name not in stages:
+                    stages[stage.full_name] = []
+                    if stage.parent is not None:
+                        children[stage.parent.full_name].append(stage.full_name)
+                stages[stage.full_name].append(stage)
+        return stages, children
+
+    def stats(self):
+        """
+        Timing statistics of every stage, merged over all threads.
+
+        Returns:
+            dict of str full stage name -> StageStats
         """
-        if not name:
-            return [self._root_stage.name]
-        else:
-            return [self._root_stage.name] + name.split(self.stage_name_separator)
+        stages, _ = self._merged()
+        stats = {name: _stats([(s._durations, s._count) for s in group]) for name, group in stages.items()}
+        return {name: st for name, st in stats.items() if st.count}
+
+    def gpu_stats(self):
+        """
+        GPU timing statistics of every stage timed with gl_util.GpuTimer.
+
+        Returns:
+            dict of str full stage name -> StageStats
+        """
+        stages, _ = self._merged()
+        stats = {name: _stats([(s._gpu_durations, s._gpu_count) for s in group]) for name, group in stages.items()}
+        return {name: st for name, st in stats.items() if st.count}
 
     def print_stages(self, file=sys.stdout):
         """
-        Prints out the current stage timings to the given file.
+        Prints out the current stage timings of all threads to the given file.
 
         Arguments:
             file: file-like, the file to print to
         """
+        stats = self.stats()
         # only print if the profiler has been used at all
-        if self._root_stage.used:
-            self._root_stage.print_stages(file)
+        if not stats:
+            return
+        gpu_stats = self.gpu_stats()
+        _, children = self._merged()
+        root = Stage.root_name
+
+        def print_stage(full_name, depth, parent, top):
+            st = stats.get(full_name)
+            if st is None:
+                # never committed, but its children may have been, e.g. a root only worker threads used
+                for child in children[full_name]:
+                    print_stage(child, depth, parent, top)
+                return
+            name = full_name.rsplit(self.stage_name_separator, 1)[-1] if full_name else root
+            _print_stage(file, depth, name, st, gpu_stats.get(full_name), parent, top)
+            parent = (name, st.mean)
+            for child in children[full_name]:
+                print_stage(child, depth + 1, parent, top or parent)
+
+        print_stage('', 0, None, None)
 
     def reset(self):
         """
-        Resets the timing values of all stages.
+        Resets the timing values of all stages of all threads.
         """
-        # only reset if the profiler has been used at all
-        if self._root_stage.used:
-            for stage in self._root_stage.iter_preorder():
+        with self._threads_lock:
+            threads = list(self._threads)
+        for state in threads:
+            for stage in state.stages:
                 stage.reset()
 
+class _ThreadStages(object):
+    """
+    Stage tree and current stage of one thread.
+    """
+
+    def __init__(self, capacity):
+        # make root stage
+        self.root = Stage(Stage.root_name, None, capacity)
+        # every stage in creation order, parents before children
+        self.stages = [self.root]
+        # stage name -> stage, so names are only parsed the first time they are used
+        self.handles = {'': self.root}
+        # (parent stage, name) -> stage, for Profiler.child
+        self.children = {}
+        # stages from the root down to the current stage
+        self.curr_path = ()
+        # whether the root stage was begun explicitly since the last loop ended, i.e. times a whole loop
+        self.loop = False
+
+class _StageBlock(object):
+    """
+    Context manager returned by Profiler.stage.
+    """
+
+    __slots__ = ('profiler', 'stage', 'outermost')
+
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+
+    def __enter__(self):
+        # without a running stage, the block is the thread's whole loop and commits when it ends
+        self.outermost = not self.profiler._state().curr_path
+        self.profiler.begin(self.stage)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.end(self.stage)
+        if self.outermost:
+            self.profiler.end()
+
+def profiled(stage_name=None, profiler=None):
+    """
+    Decorator timing every call of a function as a profiler stage.
+    Without a name, the stage is named after the function and nested under whatever stage is running when it is
+    called, e.g. cpu.step called during 'update.cpu' is timed as 'update.cpu.step'.
+
+        @profiled
+        def step(...):
+
+        @profiled('bench.direct')
+        def run_direct(...):
+
+    Arguments:
+        stage_name: str or None, absolute stage name, None for a stage named after the function below the current one
+        profiler: Profiler or None, None uses PROFILER
+
+    Returns:
+        decorator
+    """
+    if callable(stage_name):
+        return profiled()(stage_name)
+
+    def decorate(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            p = profiler or PROFILER
+            with _StageBlock(p, p.child(name) if stage_name is None else stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
 class Stage(object):
     """
     Class representing a single profiler stage.
+    Timings are kept in fixed-size ring buffers of nanosecond integers.
     """
-    def __init__(self, name, parent):
+
+    # name of the root stage of every thread
+    root_name = 'total'
+
+    def __init__(self, name, parent, capacity):
         self.name = name
         self.parent = parent
+        # stages from the root down to this one, compared by identity when stages begin and end
+        self.path = (parent.path if parent is not None else ()) + (self,)
+        # dotted name below the root, '' for the root
+        self.full_name = Profiler.stage_name_separator.join(s.name for s in self.path[1:])
 
         # child stages, both in creation order and in a lookup dict
         self._sub_stage_order = []
         self._sub_stage_names = {}
 
+        # ring buffers of committed begin times and durations in nanoseconds
+        self._begin_times = np.zeros(capacity, dtype=np.int64)
+        self._durations = np.zeros(capacity, dtype=np.int64)
+        # ring buffer of GPU durations in nanoseconds, filled asynchronously by gl_util.GpuTimer
+        self._gpu_durations = np.zeros(capacity, dtype=np.int64)
+
         self.reset()
 
     def add_begin(self, t):
         """
         Record a new beginning time for this stage.
+
+        Arguments:
+            t: int, time.perf_counter_ns() of the event
         """
         self._new_begin_time = t
 
     def add_end(self, t):
         """
         Record a new ending time for this stage.
+
+        Arguments:
+            t: int, time.perf_counter_ns() of the event
         """
         self._new_end_time = t
 
@@ -166,32 +428,46 @@ class Stage(object):
 
     def commit(self):
         """
-        Commits saved timings.
+        Commits saved timings, overwriting the oldest ones once the ring buffer is full.
         """
-        self._begin_times.append(self._new_begin_time)
-        self._end_times.append(self._new_end_time)
+        i = self._count % len(self._durations)
+        self._begin_times[i] = self._new_begin_time
+        self._durations[i] = self._new_end_time - self._new_begin_time
+        self._count += 1
         self._new_begin_time = None
         self._new_end_time = None
-        self._avg_time = None
+        self._stats = None
 
     def reset(self):
         """
         Resets the stage, forgetting any saved timings.
         """
-        self._begin_times = []
+        # total commits since the last reset, the ring buffer holds the last min(_count, capacity)
+        self._count = 0
+        self._gpu_count = 0
         self._new_begin_time = None
-
-        self._end_times = []
         self._new_end_time = None
+        self._stats = None
+        self._gpu_stats = None
 
-        self._avg_time = None
+    def add_gpu_time(self, ns):
+        """
+        Records the GPU time of one run of this stage.
+        GPU times arrive frames after the CPU times, so they are kept apart from the CPU commits.
+
+        Arguments:
+            ns: int, GPU duration in nanoseconds
+        """
+        self._gpu_durations[self._gpu_count % len(self._gpu_durations)] = ns
+        self._gpu_count += 1
+        self._gpu_stats = None
 
     def get_sub_stage(self, name):
         """
         Gets a child stage of this stage, creating it if it doesn't exist.
         """
         if name not in self._sub_stage_names:
-            stage = Stage(name, self)
+            stage = Stage(name, self, len(self._durations))
             self._sub_stage_names[name] = stage
             self._sub_stage_order.append(stage)
             return stage
@@ -203,7 +479,7 @@ class Stage(object):
         """
         Indicates if this stage has been used since being last reset.
         """
-        return self._begin_times and self._end_times
+        return self._count > 0
 
     @property
     def sub_stages(self):
@@ -212,37 +488,44 @@ class Stage(object):
         """
         yield from self._sub_stage_order
 
+    @property
+    def durations(self):
+        """
+        Kept durations in nanoseconds, oldest first.
+        """
+        n = len(self._durations)
+        if self._count <= n:
+            return self._durations[:self._count].copy()
+        return np.roll(self._durations, -(self._count % n))
+
+    def stats(self):
+        """
+        Gets the timing statistics of the kept durations.
+
+        Returns:
+            StageStats, times in seconds
+        """
+        if self._stats is None:
+            self._stats = _stats([(self._durations, self._count)])
+        return self._stats
+
+    def gpu_stats(self):
+        """
+        Gets the timing statistics of the kept GPU durations.
+
+        Returns:
+            StageStats, times in seconds, count is 0 if the stage has no GPU times
+        """
+        if self._gpu_stats is None:
+            self._gpu_stats = _stats([(self._gpu_durations, self._gpu_count)])
+        return self._gpu_stats
+
     @property
     def avg_time(self):
         """
         Gets the average elapsed time for this stage.
         """
-        if self._avg_time is None:
-            self._avg_time = np.mean(np.subtract(self._end_times, self._begin_times))
-        return self._avg_time
-
-    def print_stages(self, file=sys.stdout, depth=0):
-        """
-        Prints this stage hierarchy's timings to the given file.
-        """
-        for _ in range(depth):
-            file.write('\t')
-        file.write(self.name)
-        file.write(': ')
-        file.write(_format_time(self.avg_time))
-        if self.parent is not None:
-            file.write(' ({:.2%} of {:s}'.format(self.avg_time / self.parent.avg_time, self.parent.name))
-            if self.parent.parent is not None:
-                root = self
-                while root.parent is not None:
-                    root = root.parent
-                file.write(', {:.2%} of {:s}'.format(self.avg_time / root.avg_time, root.name))
-            file.write(')')
-        else:
-            file.write(' ({:.3g} UPS)'.format(1 / self.avg_time))
-        file.write('\n')
-        for sub_stage in self.sub_stages:
-            sub_stage.print_stages(file, depth + 1)
+        return self.stats().mean
 
     def iter_preorder(self):
         """
@@ -252,6 +535,196 @@ class Stage(object):
         for sub_stage in self.sub_stages:
             yield from sub_stage.iter_preorder()
 
+class TraceRecorder(object):
+    """
+    Streams profiler events to trace files.
+    Events are buffered in fixed-size chunks and written by a background thread, so memory stays bounded however long
+    the recording runs. The Chrome trace gets every begin and end; the collapsed stacks are summed up while writing and
+    only the totals per stack are kept until close.
+    """
+
+    # events per chunk handed to the writer thread
+    chunk_size = 1 << 14
+    # chunks waiting to be written before the profiled thread waits for the writer
+    queue_size = 4
+
+    def __init__(self, trace_path=None, collapsed_path=None):
+        """
+        Arguments:
+            trace_path: str or None, Chrome trace-event JSON file
+            collapsed_path: str or None, collapsed-stack flamegraph text file
+        """
+        self.collapsed_path = collapsed_path
+        self._trace = open(trace_path, 'w') if trace_path else None
+        self._start_time = perf_counter_ns()
+        self._events = []
+        # guards _events and the writes to _thread_names, every profiled thread records into the same chunk
+        self._events_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        # per thread: open stages as [stage, begin time, time spent in child stages]
+        self._stacks = {}
+        # ';'-joined stack -> self time in nanoseconds
+        self._collapsed = collections.defaultdict(int)
+        self._first_event = True
+        # thread ids seen by the writer, and the names of all threads seen by transition
+        self._threads = set()
+        self._thread_names = {}
+        # stage -> (begin event prefix, end event prefix, collapsed stack)
+        self._names = {}
+        if self._trace is not None:
+            self._trace.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+        self._thread = threading.Thread(target=self._run, name='profiler-trace', daemon=True)
+        self._thread.start()
+
+    def transition(self, t, ended, begun):
+        """
+        Records the stages a begin() or end() call ended and began.
+
+        Arguments:
+            t: int, perf_counter_ns() of the call
+            ended: tuple of Stage, outermost first
+            begun: tuple of Stage, outermost first
+        """
+        tid = threading.get_ident()
+        # chunks are queued under the lock as well, so the writer sees every thread's events in order
+        with self._events_lock:
+            if tid not in self._thread_names:
+                self._thread_names[tid] = threading.current_thread().name
+            events = self._events
+            # innermost stages end first
+            for s in reversed(ended):
+                events.append((t, tid, s, False))
+            for s in begun:
+                events.append((t, tid, s, True))
+            if len(events) >= self.chunk_size:
+                self._queue.put(events)
+                self._events = []
+
+    def _run(self):
+        while True:
+            events = self._queue.get()
+            if events is None:
+                break
+            self._write(events)
+
+    def _write(self, events):
+        lines = []
+        start_time = self._start_time
+        for t, tid, stage, is_begin in events:
+            if tid not in self._threads:
+                self._threads.add(tid)
+                lines.append(json.dumps({
+                    'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                    # read without _events_lock: transition may hold it while waiting on a full queue, and it
+                    # stores the name before queuing the thread's first event, so the entry is already there
+                    'args': {'name': self._thread_names.get(tid, str(tid))}}))
+            names = self._names.get(stage)
+            if names is None:
+                # JSON event prefixes and collapsed stack of the stage, built once per stage
+                name = json.dumps(stage.full_name or stage.name)
+                names = self._names[stage] = (
+                    '{"name": %s, "ph": "B", "pid": 1, "tid": ' % name,
+                    '{"name": %s, "ph": "E", "pid": 1, "tid": ' % name,
+                    ';'.join(s.name for s in stage.path))
+            lines.append('%s%d, "ts": %.3f}' % (names[0 if is_begin else 1], tid, (t - start_time) / 1000))
+
+            # collapsed stacks count the time a stage runs outside of its child stages
+            stack = self._stacks.get(tid)
+            if stack is None:
+                stack = self._stacks[tid] = []
+            if is_begin:
+                stack.append([stage, t, 0])
+                continue
+            while stack:
+                top, begin_time, child_time = stack.pop()
+                elapsed = t - begin_time
+                self._collapsed[self._names[top][2]] += elapsed - child_time
+                if stack:
+                    stack[-1][2] += elapsed
+                if top is stage:
+                    break
+
+        if self._trace is not None and lines:
+            if not self._first_event:
+                self._trace.write(',\n')
+            self._trace.write(',\n'.join(lines))
+            self._first_event = False
+
+    def close(self):
+        """
+        Writes the remaining events and closes the files.
+        """
+        with self._events_lock:
+            if self._events:
+                self._queue.put(self._events)
+                self._events = []
+        self._queue.put(None)
+        self._thread.join()
+        if self._trace is not None:
+            self._trace.write('\n]}\n')
+            self._trace.close()
+        if self.collapsed_path:
+            with open(self.collapsed_path, 'w') as f:
+                for stack, ns in sorted(self._collapsed.items()):
+                    # whole microseconds, the sample unit flamegraph tools expect
+                    if ns >= 1000:
+                        f.write('{:s} {:d}\n'.format(stack, ns // 1000))
+
+def _stats(rings):
+    """
+    Statistics of ring buffers of nanosecond durations.
+
+    Arguments:
+        rings: [(array of int, int)], ring buffers and the total durations added to each,
+               a buffer holds the last min(count, len(durations))
+
+    Returns:
+        StageStats, times in seconds
+    """
+    count = sum(count for _, count in rings)
+    if not count:
+        return StageStats(0, np.nan, np.nan, np.nan, np.nan, np.nan)
+    d = np.concatenate([durations[:min(count, len(durations))] for durations, count in rings])
+    p50, p95, p99 = np.percentile(d, [50, 95, 99]) * 1e-9
+    return StageStats(count, d.mean() * 1e-9, p50, p95, p99, d.max() * 1e-9)
+
+def _print_stage(file, depth, name, stats, gpu_stats, parent, root):
+    """
+    Prints one line of Profiler.print_stages.
+
+    Arguments:
+        file: file-like, the file to print to
+        depth: int, indentation
+        name: str, the stage name
+        stats, gpu_stats: StageStats, gpu_stats None if the stage has no GPU times
+        parent, root: (str name, float mean) or None, the stages to print percentages of
+    """
+    for _ in range(depth):
+        file.write('\t')
+    file.write(name)
+    file.write(': ')
+    file.write(_format_time(stats.mean))
+    if parent is not None:
+        file.write(' ({:.2%} of {:s}'.format(stats.mean / parent[1], parent[0]))
+        if root is not None and root is not parent:
+            file.write(', {:.2%} of {:s}'.format(stats.mean / root[1], root[0]))
+        file.write(')')
+    else:
+        file.write(' ({:.3g} UPS)'.format(1 / stats.mean))
+    file.write(' [p50 {:s}, p95 {:s}, p99 {:s}, max {:s}]'.format(
+        _format_time(stats.p50),
+        _format_time(stats.p95),
+        _format_time(stats.p99),
+        _format_time(stats.max)))
+    if gpu_stats is not None:
+        file.write(' GPU: {:s} [p50 {:s}, p95 {:s}, p99 {:s}, max {:s}]'.format(
+            _format_time(gpu_stats.mean),
+            _format_time(gpu_stats.p50),
+            _format_time(gpu_stats.p95),
+            _format_time(gpu_stats.p99),
+            _format_time(gpu_stats.max)))
+    file.write('\n')
+
 def _format_time(t):
     t, micros = divmod(int(t * 1000000), 1000000)
     t, secs = divmod(t, 60)
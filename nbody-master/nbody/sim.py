@@ -3,13 +3,35 @@
 import os
 
 import numpy as np
-from pyrr import Vector3
-from OpenGL.GL import *
-from OpenGL.GL import shaders
 
 from profiler import PROFILER
-import util
-from gl_util import *
+import collision
+import cpu
+import galaxy
+import iccache
+
+# OpenGL.GL, OpenGL.GL.shaders and gl_util, imported by _load_gl() when a 'gl' backend simulation is created
+# the 'cpu' backend never imports PyOpenGL, which keeps importing this module cheap
+GL = None
+shaders = None
+gl_util = None
+
+
+def _load_gl():
+    """
+    Imports PyOpenGL and gl_util on first use.
+    Returns False if PyOpenGL is not installed.
+    """
+    global GL, shaders, gl_util
+    if GL is None:
+        try:
+            from OpenGL import GL as gl
+            from OpenGL.GL import shaders as gl_shaders
+        except ImportError:
+            return False
+        import gl_util as util
+        GL, shaders, gl_util = gl, gl_shaders, util
+    return True
 
 
 class NBodySimulation(object):
@@ -21,109 +43,124 @@ class NBodySimulation(object):
     work_group_size = 256 # compute shader work group size
     max_particles = work_group_size * num_galaxies * 20 # total starting particles
     collision_overlap = 0.25 # max overlap allowed between particles before they collide
+    merge_collisions = None # merge colliding particles on the CPU after every update, None does on the 'cpu' backend only since on 'gl' it waits for the GPU every frame
     gravity_constant = 100.0
     starting_area_radius = 100.0 # maximum distance from origin galaxies can spawn
     center_star_mass = 1.0e1 # mass of center star of galaxies
     center_star_radius = 5.0 # radius of center star of galaxies
     galaxy_star_mass_factor = 1.0e-5 # mass factor for oribiting stars
 
-    def __init__(self):
-        print('Compiling compute shader')
-        with open(os.path.join(os.path.dirname(__file__), 'particle.comp'), 'r') as f:
-            shader = shaders.compileShader(f.read(), GL_COMPUTE_SHADER)
-        self.shader = shaders.compileProgram(shader)
-        glUseProgram(self.shader)
-
-        # assign uniform constant
-        glUniform1f(glGetUniformLocation(self.shader, 'gravity_constant'), self.gravity_constant)
-        # save variable uniform locations
-        self.num_particles_loc = glGetUniformLocation(self.shader, 'num_particles')
-        self.dt_loc = glGetUniformLocation(self.shader, 'dt')
-
-        print('Creating compute buffer')
-        # create persistant memory-mapped buffer to share memory with GPU and allow fast transfer
-        self.particles_ssbo = MappedBufferObject(
-            target=GL_SHADER_STORAGE_BUFFER,
-            dtype=np.dtype([
-                ('position', np.float32, 3),
-                ('mass', np.float32, 1),
-                ('velocity', np.float32, 3),
-                ('radius', np.float32, 1)]),
-            length=self.max_particles,
-            flags=GL_MAP_READ_BIT | GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT)
+    # particle buffer layout, two vec4 per particle in particle.comp, same as particle_dtype in with_numba/particles.py
+    particle_dtype = np.dtype([
+        ('position', np.float32, 3),
+        ('mass', np.float32),
+        ('velocity', np.float32, 3),
+        ('radius', np.float32)])
+    backends = ('gl', 'cpu') # 'gl' runs particle.comp, 'cpu' runs the equivalent cpu.step and needs no OpenGL context
+    compare_rtol = 1e-4 # relative tolerance when comparing the GL step against the CPU step
+    wait_for_draw = None # callable or None, set by a renderer drawing from the particle buffer, the 'cpu' backend calls it before writing the buffer
+    cache_initial_conditions = True # keep generated particles in iccache.cache_dir and reuse them on restarts
+
+    def __init__(self, backend='gl', compare=False, seed=None, num_particles=None, num_galaxies=None):
+        """
+        Arguments:
+            backend: str in NBodySimulation.backends, which engine runs update()
+            compare: bool, with the 'gl' backend, also run every step on the CPU from the same state and check that they agree
+            seed: int or None, seed of the initial conditions, None draws one from numpy.random (seeded by --seed)
+            num_particles: int or None, overrides NBodySimulation.max_particles, rounded down to a multiple of num_galaxies
+            num_galaxies: int or None, overrides NBodySimulation.num_galaxies
+        """
+        if num_particles is not None:
+            self.max_particles = num_particles
+        if num_galaxies is not None:
+            self.num_galaxies = num_galaxies
+        if seed is None:
+            seed = np.random.randint(0, 2 ** 32 - 1, dtype=np.int64)
+        self.seed = int(seed)
+        if backend not in self.backends:
+            raise ValueError('Unknown backend {!r}, expected one of {}'.format(backend, self.backends))
+        if backend == 'gl' and not _load_gl():
+            raise RuntimeError("the 'gl' backend needs PyOpenGL")
+        self.backend = backend
+        if self.merge_collisions is None:
+            # keep the GL pipeline asynchronous unless merging is asked for
+            self.merge_collisions = backend != 'gl'
+        self.compare = compare and backend == 'gl'
+        # (ok, position_error, velocity_error) of the last comparison, see cpu.compare
+        self.last_comparison = None
+
+        if backend == 'gl':
+            print('Compiling compute shader')
+            with open(os.path.join(os.path.dirname(__file__), 'particle.comp'), 'r') as f:
+                shader = shaders.compileShader(f.read(), GL.GL_COMPUTE_SHADER)
+            self.shader = shaders.compileProgram(shader)
+            GL.glUseProgram(self.shader)
+
+            # assign uniform constant
+            GL.glUniform1f(GL.glGetUniformLocation(self.shader, 'gravity_constant'), self.gravity_constant)
+            # save variable uniform locations
+            self.num_particles_loc = GL.glGetUniformLocation(self.shader, 'num_particles')
+            self.dt_loc = GL.glGetUniformLocation(self.shader, 'dt')
+
+            print('Creating compute buffer')
+            # create persistant memory-mapped buffer to share memory with GPU and allow fast transfer
+            self.particles_ssbo = gl_util.MappedBufferObject(
+                target=GL.GL_SHADER_STORAGE_BUFFER,
+                dtype=self.particle_dtype,
+                length=self.max_particles,
+                flags=GL.GL_MAP_READ_BIT | GL.GL_MAP_WRITE_BIT | GL.GL_MAP_PERSISTENT_BIT | GL.GL_MAP_COHERENT_BIT)
+        else:
+            print('Creating host buffer')
+            # same layout as the GL buffer, so initial conditions and everything reading the data are unchanged
+            self.particles_ssbo = cpu.HostBuffer(
+                dtype=self.particle_dtype,
+                length=self.max_particles)
         print('Compute buffer size: {:,d} bytes'.format(self.particles_ssbo.data.nbytes))
 
-        self.num_particles = len(self.particles_ssbo.data)
         # divide total particles amoung galaxies
-        self.num_stars_per_galaxy = self.num_particles // self.num_galaxies
+        self.num_stars_per_galaxy = len(self.particles_ssbo.data) // self.num_galaxies
+        if not self.num_stars_per_galaxy:
+            raise ValueError('{:,d} particles are too few for {:,d} galaxies'.format(
+                len(self.particles_ssbo.data),
+                self.num_galaxies))
+        # particles left over by the split are never generated, leave them out of the simulation
+        self.num_particles = self.num_stars_per_galaxy * self.num_galaxies
         print('Creating {:,d} galaxies with {:,d} stars each ({:,d} particles total)'.format(
             self.num_galaxies,
             self.num_stars_per_galaxy,
             self.num_particles))
 
-        # determine galaxy positions first
-        # this way, if the star creation is altered, the same random seed will still give the same galaxy positions
-        galaxy_positions = np.empty((self.num_galaxies, 3), dtype=np.float)
-        for pos in galaxy_positions:
-            pos[:] = util.rand_spherical(self.starting_area_radius)
-        galaxy_positions = iter(galaxy_positions)
-
-        # generate particles
-        particles = iter(self.particles_ssbo.data)
-        for _ in range(self.num_galaxies):
-            center_star = next(particles)
-            center_star['position'] = next(galaxy_positions)
-            center_star['mass'] = self.center_star_mass
-            center_star['velocity'] = 0.0
-            center_star['radius'] = self.center_star_radius
-
-            # center star is included in count, so num_stars_per_galaxy - 1
-            for _ in range(self.num_stars_per_galaxy - 1):
-                star = next(particles)
-
-                # mass is center * mass factor
-                star['mass'] = center_star['mass'] * self.galaxy_star_mass_factor
-                # radius is scaled so orbiting stars have same density as center stars
-                star['radius'] = np.cbrt(star['mass'] / center_star['mass']) * center_star['radius']
-
-                # determine star positions
-                # we want them to be randomly distributed in a disk around the center star
-                # there should also be a random height perturbation from the disk
-                # which is based on the radius from the center
-
-                # position theta
-                pt = np.random.uniform(0, 2 * np.pi)
-
-                # position radius, higher chance of being closer
-                pr = np.random.lognormal(sigma=0.5)
-                # scale by center star radius
-                pr = util.lerp(
-                    pr,
-                    0, 1,
-                    center_star['radius'] * 0.5, center_star['radius'] * 1.0)
-
-                # position height, first unscale radius
-                ph = pr / center_star['radius']
-                # height envelope increases exponentially as radius gets smaller
-                ph = np.exp(-ph) * center_star['radius'] / 3
-                # right now ph is the max/min height, so pick random in that range
-                ph = np.random.uniform(-ph, ph)
-
-                # make position vector
-                pos = Vector3([
-                    pr * np.cos(pt),
-                    ph,
-                    pr * np.sin(pt)])
-
-                # calculate velocity needed to stay in orbit
-                vel = np.sqrt(self.gravity_constant * (star['mass'] + center_star['mass']) / pos.length)
-                # velocity direction is perpendicular to position
-                vel = vel * Vector3([-pos.z, pos.y, pos.x]).normalised
-
-                star['position'] = center_star['position'] + pos
-                star['velocity'] = vel
-
-        glUseProgram(0)
+        # generate galaxies straight into the particle buffer, or load them from a previous run with the same parameters
+        params = dict(
+            version=galaxy.version,
+            num_galaxies=self.num_galaxies,
+            seed=self.seed,
+            gravity_constant=self.gravity_constant,
+            starting_area_radius=self.starting_area_radius,
+            center_star_mass=self.center_star_mass,
+            center_star_radius=self.center_star_radius,
+            galaxy_star_mass_factor=self.galaxy_star_mass_factor,
+            chunk_size=galaxy.chunk_size)
+        generate = lambda data: galaxy.generate(
+            data,
+            self.num_galaxies,
+            self.seed,
+            self.gravity_constant,
+            self.starting_area_radius,
+            self.center_star_mass,
+            self.center_star_radius,
+            self.galaxy_star_mass_factor)
+        if self.cache_initial_conditions:
+            if iccache.load_or_generate(self.particles_ssbo.data, generate, params):
+                print('Loaded initial conditions from cache')
+        else:
+            generate(self.particles_ssbo.data)
+        # a zero mass body has zero radius, two of them at the same point turn the whole system into NaN
+        if not (self.particles_ssbo.data['mass'][:self.num_particles] > 0).all():
+            raise ValueError('initial conditions contain bodies without mass')
+
+        if backend == 'gl':
+            GL.glUseProgram(0)
 
 
 
@@ -136,25 +173,76 @@ class NBodySimulation(object):
         """
         PROFILER.begin('update')
 
-        glUseProgram(self.shader)
+        if self.backend == 'cpu':
+            PROFILER.begin('update.cpu')
+            if self.wait_for_draw is not None:
+                # a draw may still be reading the buffer
+                self.wait_for_draw()
+            cpu.step(self.particles_ssbo.data, self.num_particles, self.gravity_constant, dt)
+        else:
+            if self.compare:
+                # keep the starting state to replay the step on the CPU
+                gl_util.gl_wait()
+                expected = self.particles_ssbo.data[:self.num_particles].copy()
+
+            self._update_gl(dt)
+
+            if self.compare:
+                PROFILER.begin('update.compare')
+                gl_util.gl_wait()
+                cpu.step(expected, len(expected), self.gravity_constant, dt)
+                self.last_comparison = cpu.compare(
+                    expected,
+                    self.particles_ssbo.data[:self.num_particles],
+                    self.compare_rtol)
+                ok, position_error, velocity_error = self.last_comparison
+                if not ok:
+                    print('WARNING: GL and CPU steps differ, relative position error {:.3g}, velocity error {:.3g}'.format(
+                        position_error,
+                        velocity_error))
+
+        if self.merge_collisions:
+            PROFILER.begin('update.collisions')
+            if self.backend == 'gl':
+                # the only point where update waits for the compute shader
+                gl_util.gl_wait()
+            # buffer is persistently mapped and coherent, so merge in place on the CPU
+            # merged particles are compacted to the front, which shrinks num_particles for the next update and draw
+            self.num_particles = collision.collide(
+                self.particles_ssbo.data,
+                self.num_particles,
+                self.collision_overlap)
+
+        PROFILER.end('update')
+
+    def _update_gl(self, dt):
+        """
+        Runs one step of particle.comp on the GPU.
+        Returns without waiting for the GPU, call gl_wait() before reading the particle buffer.
+
+        Arguments:
+            dt: float in (0, inf), timestep
+        """
+        GL.glUseProgram(self.shader)
 
         PROFILER.begin('update.uniforms')
         # update variable uniforms, number of particles and timestep
-        glUniform1ui(self.num_particles_loc, self.num_particles)
-        glUniform1f(self.dt_loc, dt)
+        GL.glUniform1ui(self.num_particles_loc, self.num_particles)
+        GL.glUniform1f(self.dt_loc, dt)
 
         PROFILER.begin('update.shader')
+        gl_util.GPU_TIMER.begin('update.shader')
         # bind particle data buffer to shader buffer 0
-        glBindBufferBase(self.particles_ssbo.target, 0, self.particles_ssbo._buf_id)
-        # dispatch compute shader with max_particles / work_group_size workers
+        GL.glBindBufferBase(self.particles_ssbo.target, 0, self.particles_ssbo._buf_id)
+        # dispatch compute shader with enough work groups to cover the live particles
         # compute shader will calculate gravity forces and update particle data
-        glDispatchCompute(self.max_particles // self.work_group_size, 1, 1)
-        # glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
-        # glMemoryBarrier(GL_BUFFER_UPDATE_BARRIER_BIT)
+        GL.glDispatchCompute(-(-self.num_particles // self.work_group_size), 1, 1)
+        # make the shader's writes visible to the draw call reading the buffer as vertex attributes
+        GL.glMemoryBarrier(GL.GL_VERTEX_ATTRIB_ARRAY_BARRIER_BIT | GL.GL_CLIENT_MAPPED_BUFFER_BARRIER_BIT)
+        gl_util.GPU_TIMER.end('update.shader')
 
-        glUseProgram(0)
+        GL.glUseProgram(0)
 
-        # wait for compute shader to finish
-        gl_sync()
-
-        PROFILER.end('update')
+        # don't wait for the compute shader here, only fence it
+        # whatever reads the mapped buffer on the CPU next waits on the fence first, see gl_wait
+        gl_util.gl_lock()
@@ -16,6 +16,7 @@ from PyQt5.QtCore import Qt, QSize, QTimer
 from PyQt5.QtWidgets import QOpenGLWidget
 
 from sim import NBodySimulation
+from playback import SnapshotPlayback
 from profiler import PROFILER
 import util
 from gl_util import *
@@ -23,15 +24,24 @@ from gl_util import *
 
 class SimulationView(QOpenGLWidget):
     """
-    Qt Widget that runs and displays the N-body simulation.
+    Qt Widget that runs and displays the N-body simulation, or replays a recorded one.
+
+    Playback keys: left/right seek one second, up/down double/halve the speed, R reverses, home restarts.
     """
 
     fps = 60 # target FPs
     profiler_print_interval = 1.0 # seconds between printing profiler info
 
-    def __init__(self, parent):
+    def __init__(self, parent, playback=None):
+        """
+        Arguments:
+            parent: QWidget
+            playback: str or None, snapshot file to replay instead of running the simulation
+        """
         super().__init__(parent)
 
+        self.playback = playback
+
         # focus widget for keyboard controls
         self.setFocusPolicy(Qt.StrongFocus)
         self.setFocus(True)
@@ -60,8 +70,15 @@ class SimulationView(QOpenGLWidget):
 
         print_gl_version()
 
-        print('Initializing sim')
-        self.sim = NBodySimulation()
+        if self.playback:
+            print('Initializing playback')
+            # stands in for the simulation, update() shows recorded frames instead of simulating them
+            self.sim = SnapshotPlayback(self.playback)
+        else:
+            print('Initializing sim')
+            self.sim = NBodySimulation()
+            # paintGL draws straight from the particle buffer, a CPU update has to wait for it
+            self.sim.wait_for_draw = gl_wait
 
         print('Setting OpenGL options')
         glEnable(GL_BLEND)
@@ -146,6 +163,9 @@ class SimulationView(QOpenGLWidget):
 
         PROFILER.begin()
 
+        # GPU stage times from a few frames ago that are ready now
+        GPU_TIMER.collect()
+
         # only update simulation if not paused
         if not self.paused:
             self.sim.update(dt)
@@ -189,7 +209,10 @@ class SimulationView(QOpenGLWidget):
         PROFILER.begin('render.sort')
         # sort particles by distance from the camera so they render in the proper order
         # particles closest to the camera should be drawn last
-        p = self.sim.particles_ssbo.data
+        # only the live particles, merged particles past num_particles stay at the end of the buffer
+        # the GPU may still be running the compute shader that writes the buffer
+        gl_wait()
+        p = self.sim.particles_ssbo.data[:self.sim.num_particles]
         # p[:]['position'] - self.camera.eye makes an array of particle displacements
         # np.square squares each x, y, z of each displacement
         # np.sum(..., axis=1) sums each squared x, y, z of each displacement
@@ -200,12 +223,14 @@ class SimulationView(QOpenGLWidget):
         p[:] = p[np.argsort(-np.sum(np.square(p[:]['position'] - self.camera.eye), axis=1))]
 
         PROFILER.begin('render.draw')
+        GPU_TIMER.begin('render.draw')
         # instanced rendering
         # this draws the same set of verticies for each particle,
         # much faster and more memory efficient than supplying verticies for each particle
         glDrawArraysInstanced(GL_TRIANGLE_STRIP, 0, self.sprite_data_vbo.length, self.sim.num_particles)
-        # wait for drawing to finish
-        gl_sync()
+        GPU_TIMER.end('render.draw')
+        # fence the draw instead of waiting for it, the next CPU write to the buffer waits on it
+        gl_lock()
 
         glBindVertexArray(0)
         glUseProgram(0)
@@ -273,6 +298,22 @@ class SimulationView(QOpenGLWidget):
         if event.key() == Qt.Key_Space:
             # toggle pause
             self.paused = not self.paused
+        elif self.playback:
+            player = self.sim
+            if event.key() in (Qt.Key_Left, Qt.Key_Right):
+                # seek one second of playback at speed 1
+                direction = 1 if event.key() == Qt.Key_Right else -1
+                player.seek(player.frame + direction * int(player.frame_rate))
+                super().update()
+            elif event.key() == Qt.Key_Up:
+                player.set_speed(player.speed * 2)
+            elif event.key() == Qt.Key_Down:
+                player.set_speed(player.speed / 2)
+            elif event.key() == Qt.Key_R:
+                player.set_speed(-player.speed)
+            elif event.key() == Qt.Key_Home:
+                player.seek(0)
+                super().update()
 
 class Camera(object):
     """
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+# file layout
+#   header:  magic, frame count, header JSON length, header JSON, zero padded to header_size bytes
+#   chunks:  each chunk holds chunk_frames frames as an index block followed by a record block
+#            index block: chunk_frames entries of index_dtype
+#            record block: chunk_frames fixed-size records of the store's dtype and shape
+# frames are only counted in the header once their record and index entry are written,
+# so a reader never sees a partially written frame
+magic = b'NBSNAP01'
+header_size = 4096
+format_version = 1
+
+# one index entry per frame
+index_dtype = np.dtype([
+    ('step', '<i8'), # simulation step the frame was taken at
+    ('time', '<f8'), # simulation time the frame was taken at
+    ('count', '<i8')]) # number of valid leading elements of the record, e.g. num_particles
+
+# byte offsets of the header fields
+_count_offset = len(magic)
+_json_len_offset = _count_offset + 8
+_json_offset = _json_len_offset + 8
+
+
+class _Layout(object):
+    """
+    Byte offsets of frames in a snapshot file.
+    """
+
+    def __init__(self, dtype, shape, chunk_frames):
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.chunk_frames = chunk_frames
+        self.record_nbytes = self.dtype.itemsize * int(np.prod(self.shape, dtype=np.int64))
+        self.index_nbytes = index_dtype.itemsize * chunk_frames
+        self.chunk_nbytes = self.index_nbytes + self.record_nbytes * chunk_frames
+
+    def chunk_offset(self, chunk):
+        return header_size + chunk * self.chunk_nbytes
+
+    def map_chunk(self, f, chunk, mode):
+        """
+        Maps one chunk of the file.
+
+        Returns:
+            index: (chunk_frames,) memmap of index_dtype
+            records: (chunk_frames, *shape) memmap of the record dtype
+        """
+        offset = self.chunk_offset(chunk)
+        index = np.memmap(f, dtype=index_dtype, mode=mode, offset=offset, shape=(self.chunk_frames,))
+        records = np.memmap(
+            f,
+            dtype=self.dtype,
+            mode=mode,
+            offset=offset + self.index_nbytes,
+            shape=(self.chunk_frames,) + self.shape)
+        return index, records
+
+
+class SnapshotWriter(object):
+    """
+    Appends fixed-size frames to a memory-mapped snapshot file from a background thread.
+
+    Frames are either particle snapshots (records of the particle dtype, e.g. particles_ssbo.data, with the number of
+    live particles stored as the frame count) or grid fields (e.g. the float32 array read back from a TextureBuffer or
+    Slab surface, or any engine array).
+    write() only copies the frame into a bounded queue, all disk work happens on the writer thread.
+    """
+
+    def __init__(self, path, dtype, shape, chunk_frames=64, queue_size=8, on_full='drop', attrs=None):
+        """
+        Arguments:
+            path: str, file to create, an existing file is overwritten
+            dtype: numpy.dtype, dtype of every record
+            shape: tuple of int, shape of every record
+            chunk_frames: int, frames per file chunk, the file grows by one chunk at a time
+            queue_size: int, maximum frames waiting to be written
+            on_full: 'drop' or 'block', what write() does when the queue is full;
+                     'drop' never stalls the caller and counts the frame in dropped
+            attrs: dict or None, JSON-serializable metadata stored in the header, e.g. simulation constants
+        """
+        if on_full not in ('drop', 'block'):
+            raise ValueError("on_full must be 'drop' or 'block', got {!r}".format(on_full))
+        self.path = path
+        self.layout = _Layout(dtype, shape, chunk_frames)
+        self.on_full = on_full
+        self.dropped = 0
+        self.written = 0
+
+        header = json.dumps({
+            'version': format_version,
+            'dtype': np.lib.format.dtype_to_descr(self.layout.dtype),
+            'shape': list(self.layout.shape),
+            'chunk_frames': chunk_frames,
+            'attrs': attrs or {},
+        }).encode('utf-8')
+        if _json_offset + len(header) > header_size:
+            raise ValueError('snapshot header too large ({:d} bytes)'.format(len(header)))
+
+        self._file = open(path, 'w+b')
+        self._file.write(magic)
+        self._file.write(np.int64(0).tobytes())
+        self._file.write(np.int64(len(header)).tobytes())
+        self._file.write(header)
+        self._file.truncate(header_size)
+        self._file.flush()
+        self._count = np.memmap(self._file, dtype='<i8', mode='r+', offset=_count_offset, shape=(1,))
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, data, step=0, time=0.0, count=None):
+        """
+        Queues a frame. data is copied, so the caller can keep modifying it right away.
+
+        Arguments:
+            data: array of the store's dtype, with the record shape, or for particle stores any leading part of it
+            step: int, simulation step
+            time: float, simulation time
+            count: int or None, number of valid leading elements, None uses len(data)
+
+        Returns:
+            bool, False if the frame was dropped because the queue was full
+        """
+        if self._error is not None:
+            raise RuntimeError('snapshot writer failed') from self._error
+        data = np.asarray(data)
+        if count is None:
+            count = len(data)
+        # copy on the calling thread, the source may be a mapped GL buffer that changes next frame
+        frame = (np.array(data, dtype=self.layout.dtype, copy=True), int(step), float(time), int(count))
+        try:
+            self._queue.put(frame, block=self.on_full == 'block')
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _run(self):
+        layout = self.layout
+        chunk = -1
+        index = records = None
+        frame_id = 0
+        try:
+            while True:
+                frame = self._queue.get()
+                if frame is None:
+                    break
+                data, step, time, count = frame
+                c, k = divmod(frame_id, layout.chunk_frames)
+                if c != chunk:
+                    if records is not None:
+                        index.flush()
+                        records.flush()
+                    # grow the file by one chunk and map it
+                    self._file.truncate(layout.chunk_offset(c + 1))
+                    index, records = layout.map_chunk(self._file, c, 'r+')
+                    chunk = c
+                n = len(data) if data.ndim else 1
+                if data.shape == layout.shape:
+                    records[k] = data
+                else:
+                    records[k, :n] = data
+                    records[k, n:] = 0
+                index[k] = (step, time, count)
+                frame_id += 1
+                # publish the frame only after its data is in place
+                self._count[0] = frame_id
+                self.written = frame_id
+        except BaseException as e:
+            self._error = e
+            # keep draining so write() never blocks forever on a dead writer
+            while self._queue.get() is not None:
+                pass
+        finally:
+            if records is not None:
+                index.flush()
+                records.flush()
+            self._count.flush()
+
+    def close(self):
+        """
+        Writes all queued frames and closes the file.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._file.close()
+        if self.dropped:
+            print('WARNING: {:d} snapshot frames were dropped because the writer fell behind'.format(self.dropped))
+        if self._error is not None:
+            raise RuntimeError('snapshot writer failed') from self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SnapshotReader(object):
+    """
+    Random access to the frames of a snapshot file.
+    Frames are memory-mapped one chunk at a time on first access, so opening a file and reading a frame only touches
+    that frame's pages. Files that are still being written can be read; refresh() picks up new frames.
+    """
+
+    def __init__(self, path):
+        """
+        Arguments:
+            path: str, snapshot file
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        head = self._file.read(header_size)
+        if head[:len(magic)] != magic:
+            raise ValueError('{} is not a snapshot file'.format(path))
+        json_len = int(np.frombuffer(head, '<i8', 1, _json_len_offset)[0])
+        header = json.loads(head[_json_offset:_json_offset + json_len].decode('utf-8'))
+        if header['version'] > format_version:
+            raise ValueError('snapshot format version {} is newer than supported ({})'.format(
+                header['version'],
+                format_version))
+        self.attrs = header['attrs']
+        self.layout = _Layout(
+            np.lib.format.descr_to_dtype(_to_descr(header['dtype'])),
+            header['shape'],
+            header['chunk_frames'])
+        self._chunks = {}
+        self._num_frames = 0
+        self.refresh()
+
+    @property
+    def dtype(self):
+        return self.layout.dtype
+
+    @property
+    def shape(self):
+        return self.layout.shape
+
+    def refresh(self):
+        """
+        Re-reads the frame count, for files that are still being written.
+
+        Returns:
+            int, the number of frames
+        """
+        self._file.seek(_count_offset)
+        count = int(np.frombuffer(self._file.read(8), '<i8')[0])
+        # never count frames whose chunk isn't fully in the file yet
+        size = os.fstat(self._file.fileno()).st_size
+        complete_chunks = max(size - header_size, 0) // self.layout.chunk_nbytes
+        self._num_frames = min(count, complete_chunks * self.layout.chunk_frames)
+        return self._num_frames
+
+    def __len__(self):
+        return self._num_frames
+
+    def _chunk(self, c):
+        if c not in self._chunks:
+            self._chunks[c] = self.layout.map_chunk(self._file, c, 'r')
+        return self._chunks[c]
+
+    def _locate(self, i):
+        if i < 0:
+            i += self._num_frames
+        if not 0 <= i < self._num_frames:
+            raise IndexError('frame {} out of range ({} frames)'.format(i, self._num_frames))
+        return divmod(i, self.layout.chunk_frames)
+
+    def __getitem__(self, i):
+        """
+        Read-only view of frame i. No data is read until it is used.
+        Particle frames (1D records) are trimmed to their count of valid elements.
+        """
+        c, k = self._locate(i)
+        index, records = self._chunk(c)
+        if len(self.layout.shape) == 1:
+            return records[k, :index[k]['count']]
+        return records[k]
+
+    def info(self, i):
+        """
+        Index entry of frame i.
+
+        Returns:
+            step: int
+            time: float
+            count: int
+        """
+        c, k = self._locate(i)
+        entry = self._chunk(c)[0][k]
+        return int(entry['step']), float(entry['time']), int(entry['count'])
+
+    def times(self):
+        """
+        Simulation times of all frames, from the index blocks only.
+        """
+        return np.array([self.info(i)[1] for i in range(len(self))])
+
+    def close(self):
+        self._chunks.clear()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SnapshotPlayer(object):
+    """
+    Reads frames ahead of playback on a background thread.
+    Frames are prefetched into a ring of preallocated arrays, so showing a frame is a single copy from memory
+    instead of a read from disk, and playback allocates nothing per frame.
+    """
+
+    def __init__(self, reader, prefetch=8):
+        """
+        Arguments:
+            reader: SnapshotReader, or str path of a snapshot file
+            prefetch: int, number of frames kept ahead of the current one, including it
+        """
+        if not isinstance(reader, SnapshotReader):
+            reader = SnapshotReader(reader)
+        self.reader = reader
+        self.prefetch = prefetch
+        # frames that missed the ring and were read synchronously
+        self.misses = 0
+
+        self._ring = np.empty((prefetch,) + reader.shape, dtype=reader.dtype)
+        # frame held by each slot, -1 for empty or being loaded
+        self._slot_frame = np.full(prefetch, -1, dtype=np.int64)
+        self._slot_count = np.zeros(prefetch, dtype=np.int64)
+        # frames the ring should hold, in the order they will be shown
+        self._wanted = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='snapshot-prefetch', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self.reader)
+
+    def read(self, i, out, step=1):
+        """
+        Copies frame i into out and schedules the frames after it.
+
+        Arguments:
+            i: int, frame to show
+            out: array of the snapshot dtype, at least as long as the frame, e.g. the mapped particles_ssbo.data
+            step: int, frame increment of the playback, negative when playing backwards, schedules i + k * step
+
+        Returns:
+            int, number of elements copied, the particle count for particle frames
+        """
+        n = len(self.reader)
+        i = i % n if i < 0 else i
+        wanted = [f for f in (i + k * step for k in range(self.prefetch)) if 0 <= f < n]
+        if step == 0:
+            wanted = [i]
+        with self._cond:
+            # the slot of frame i can't be picked for loading while i is wanted, so it is safe to copy outside the lock
+            self._wanted = wanted
+            slots = np.flatnonzero(self._slot_frame == i)
+            self._cond.notify()
+        if len(slots):
+            slot = slots[0]
+            count = self._slot_count[slot]
+            out[:count] = self._ring[slot, :count]
+            return int(count)
+
+        self.misses += 1
+        frame = self.reader[i]
+        out[:len(frame)] = frame
+        return len(frame)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    loaded = set(self._slot_frame.tolist())
+                    todo = [f for f in self._wanted if f not in loaded]
+                    if todo:
+                        break
+                    self._cond.wait()
+                frame = todo[0]
+                # replace a slot holding a frame that is no longer wanted
+                wanted = set(self._wanted)
+                slot = next(s for s in range(self.prefetch) if self._slot_frame[s] not in wanted)
+                self._slot_frame[slot] = -1
+
+            data = self.reader[frame]
+            self._ring[slot, :len(data)] = data
+
+            with self._cond:
+                self._slot_frame[slot] = frame
+                self._slot_count[slot] = len(data)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.reader.close()
+
+
+def _to_descr(descr):
+    """
+    Turns a dtype description back from its JSON form (lists instead of tuples).
+    """
+    if isinstance(descr, str):
+        return descr
+    # fields are (name, type) or (name, type, shape), type may itself be a nested description
+    return [(field[0], _to_descr(field[1])) + tuple(tuple(s) for s in field[2:]) for field in descr]
+
+
+def particle_writer(path, data, **kwargs):
+    """
+    Snapshot writer for a particle buffer such as NBodySimulation.particles_ssbo.data.
+    Frames hold up to len(data) particles; write(data[:num_particles]) stores the live ones.
+    """
+    return SnapshotWriter(path, data.dtype, data.shape, **kwargs)
+
+
+def field_writer(path, shape, dtype=np.float32, **kwargs):
+    """
+    Snapshot writer for grid fields, e.g. (height, width, depth) float32 texture readbacks.
+    """
+    return SnapshotWriter(path, dtype, shape, **kwargs)
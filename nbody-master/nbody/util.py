@@ -1,46 +1,61 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from pyrr import Vector3
 
 
-def rand_spherical(r):
+def _vector3(*args):
+    # pyrr is only needed for the scalar Vector3 results, the array paths used by galaxy run without importing it
+    from pyrr import Vector3
+    return Vector3(*args)
+
+def rand_spherical(r, size=None, rng=np.random):
     """
     Creates a random vector uniformly distributed on a sphere of given radius.
 
     Arguments:
         r: float, the radius of the sphere
+        size: int or None, number of vectors to create at once
+        rng: numpy.random.Generator or the numpy.random module, the source of random numbers
 
     Returns:
-        Vector3
+        Vector3 if size is None, otherwise (size, 3) array of float
     """
-    r1, r2, r3 = np.random.random(3)
-    r1 *= 2 * np.pi
+    if size is None:
+        r1, r2, r3 = rng.random(3)
+    else:
+        r1, r2, r3 = rng.random((3, size))
+    r1 = r1 * 2 * np.pi
     r2_sqrt = 2 * np.sqrt(r2 * (1 - r2))
-    r3 *= r
+    r3 = r3 * r
     x = r3 * np.cos(r1) * r2_sqrt
     y = r3 * np.sin(r1) * r2_sqrt
     z = r3 * (1 - 2 * r2)
-    return Vector3([x, y, z])
+    if size is None:
+        return _vector3([x, y, z])
+    return np.stack([x, y, z], axis=-1)
 
 def from_spherical(r, t, p):
     """
     Creates a vector in Cartesian coordinates in the same location as the given spherical coordinates.
 
     Arguments:
-        r: float, the radius of the point
-        t: float, the theta angle of the point in radians
-        p: float, the phi angle of the point in radians
+        r: float or array of float, the radius of the point
+        t: float or array of float, the theta angle of the point in radians
+        p: float or array of float, the phi angle of the point in radians
 
     Returns:
-        Vector3
+        Vector3 if all arguments are scalars, otherwise (..., 3) array of float
     """
-    if not r: return Vector3()
+    if np.ndim(r) or np.ndim(t) or np.ndim(p):
+        r, t, p = np.broadcast_arrays(r, t, p)
+        sin_p = np.sin(p)
+        return np.stack([r * np.cos(t) * sin_p, r * np.sin(t) * sin_p, r * np.cos(p)], axis=-1)
+    if not r: return _vector3()
     sin_p = np.sin(p)
     x = r * np.cos(t) * sin_p
     y = r * np.sin(t) * sin_p
     z = r * np.cos(p)
-    return Vector3([x, y, z])
+    return _vector3([x, y, z])
 
 def to_spherical(v):
     """
@@ -63,15 +78,16 @@ def to_spherical(v):
 def lerp(x, old_min, old_max, new_min, new_max):
     """
     Linearly interpolates between the ranges given.
+    Works element-wise on arrays as well.
 
     Arguments:
-        x: number, the value to interpolate
+        x: number or array, the value to interpolate
         old_min: number, the minimum to interpolate from
         old_max: number, the maximum to interpolate from
         new_min: number, the minimum to interpolate to
         new_max: number, the maximum to interpolate to
 
     Returns:
-        number, the interpolated value
+        number or array, the interpolated value
     """
     return (x - old_min) / (old_max - old_min) * (new_max - new_min) + new_min
@@ -0,0 +1,388 @@
+"""
+Registry of force and integration backends, with first-use autotuning.
+
+Every force backend implements the accelerations(positions, weights,
+**params) contract of direct.accelerations (softened 1 / r^2 direct sum,
+G = 1) and declares the parameters worth tuning:
+
+    direct      numba i-block / j-tile kernel     block_size, tile_size
+    symmetric   Newton's third law, pairs once    block_size
+    numpy       run_numpy_nbody, small N only     -
+    cuda        tiled CUDA kernel, (n, 2) f32     tile_size
+    gl          compute shader, (n, 2) f32        local_size
+    barnes_hut  tree, approximate                 theta, leaf_size
+    pm          particle-mesh, approximate        grid_size, assignment
+
+fmm is left out, its 2D force is the logarithmic-potential one of
+gravity.py rather than the 1 / r^2 sum. Approximate backends only take
+part when a tolerance is given, and then only with parameters whose
+measured p99 relative error (direct.force_error) stays within it.
+
+accelerations(positions, weights) with backend='auto' looks up the
+fastest (backend, params) for the problem's bucket, N rounded up to a
+power of two together with dtype, dim, tolerance and the host. The first
+call in a bucket times every available candidate on the actual inputs,
+and the winner is stored in a JSON tuning file (tuning_file), so later
+processes on the same host go straight to it.
+
+Integrators are registered by name as well; step() runs one with the
+tuned force.
+"""
+
+from __future__ import division
+
+import itertools
+import json
+import math
+import os
+import platform
+import time
+from collections import OrderedDict, namedtuple
+
+import numba
+import numpy as np
+
+from . import barnes_hut, direct, integrators as _integrators, pm
+
+Backend = namedtuple('Backend', [
+    'name', 'function',
+    'params',     # {name: candidate values}, or callable(dim) -> that dict
+    'dims', 'dtypes',
+    'exact',      # False for approximations, see tolerance
+    'max_n',      # largest N worth tuning, None for no limit
+    'available'])  # callable() -> bool
+
+# (backend name, params dict, seconds per call) of a tuned bucket
+Choice = namedtuple('Choice', ['backend', 'params', 'seconds'])
+
+# local tuning database, WITH_NUMBA_TUNING_FILE overrides
+tuning_file = os.environ.get('WITH_NUMBA_TUNING_FILE') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'with_numba', 'tuning.json')
+
+# timed calls per candidate after a warm-up call, the fastest counts
+repeat = 3
+
+# a candidate whose first timed call is this many times slower than the
+# best so far can't win and is not timed further
+give_up = 4.0
+
+# smallest N bucket, below it every size shares one choice
+min_bucket = 256
+
+registry = OrderedDict()
+integrators = OrderedDict()
+
+# tuned choices by bucket key, mirrors the tuning file
+_choices = {}
+_loaded = False
+
+
+def register(name, function, params=None, dims=(2, 3),
+             dtypes=(np.float32, np.float64), exact=True, max_n=None,
+             available=None):
+    """
+    Add a force backend. function(positions, weights, **params) must
+    return the accelerations shaped like positions.
+    """
+    registry[name] = Backend(name, function, params or {}, tuple(dims),
+                             tuple(np.dtype(t) for t in dtypes), exact,
+                             max_n, available or (lambda: True))
+
+
+def register_integrator(name, function, takes_force=True):
+    """
+    Add an integrator step(positions, velocities, weights, dt, acc=None,
+    [force=]); takes_force=False for ones with their own force evaluation,
+    step(positions, velocities, weights, dt, *state) returning the state
+    tuple for the next step.
+    """
+    integrators[name] = (function, takes_force)
+
+
+# -- CUDA -------------------------------------------------------------------
+
+def _cuda_available():
+    try:
+        from numba import cuda
+        return cuda.is_available()
+    except Exception:
+        return False
+
+
+def cuda_accelerations(positions, weights, tile_size=128, out=None):
+    """
+    accelerations(positions, weights) for (n, 2) float32 bodies on the GPU
+    with bench_cuda.calculate_forces, padded with zero weights to whole
+    tiles. Transfers both ways are part of every call.
+    """
+    from numba import cuda
+    from . import bench_cuda
+    n = len(weights)
+    padded = -(-n // tile_size) * tile_size
+    p = np.zeros((padded, 2), np.float32)
+    p[:n] = positions
+    w = np.zeros(padded, np.float32)
+    w[:n] = weights
+    d_acc = cuda.device_array((padded, 2), np.float32)
+    bench_cuda.calculate_forces[padded // tile_size, tile_size, 0,
+                                bench_cuda.shared_bytes(tile_size)](
+        cuda.to_device(p), cuda.to_device(w), d_acc)
+    acc = d_acc.copy_to_host()[:n]
+    if out is None:
+        return acc.astype(np.asarray(positions).dtype, copy=False)
+    out[:] = acc
+    return out
+
+
+def _gl_available():
+    from . import glcompute
+    try:
+        glcompute.context()
+        return True
+    except glcompute.ContextError:
+        return False
+
+
+def _gl_accelerations(positions, weights, local_size=256):
+    from . import glcompute
+    return glcompute.accelerations(positions, weights, local_size)
+
+
+register('direct', direct.accelerations,
+         dict(block_size=(32, 64, 128), tile_size=(256, 512, 1024)))
+register('symmetric', direct.symmetric_accelerations,
+         dict(block_size=(256, 512, 1024)))
+register('numpy', lambda positions, weights: direct.run_numpy_nbody(
+    np.asarray(positions), np.asarray(weights)), max_n=4096)
+register('cuda', cuda_accelerations, dict(tile_size=(64, 128, 256)),
+         dims=(2,), dtypes=(np.float32,), available=_cuda_available)
+register('gl', _gl_accelerations, dict(local_size=(64, 128, 256)),
+         dims=(2,), dtypes=(np.float32,), available=_gl_available)
+register('barnes_hut', barnes_hut.accelerations,
+         dict(theta=(0.3, 0.5, 0.7), leaf_size=(8, 16, 32)), exact=False)
+register('pm', pm.accelerations,
+         lambda dim: dict(grid_size=(64, 128, 256, 512) if dim == 2
+                          else (32, 64, 128), assignment=pm.assignments),
+         exact=False)
+
+register_integrator('leapfrog', _integrators.leapfrog_step)
+register_integrator('velocity_verlet', _integrators.velocity_verlet_step)
+register_integrator('hermite', _integrators.hermite_step, takes_force=False)
+
+
+# -- tuning -----------------------------------------------------------------
+
+def host():
+    """
+    The host part of the tuning key.
+    """
+    return '{}/{}/{}cpu/{}threads'.format(
+        platform.node(), platform.machine(), os.cpu_count(),
+        numba.config.NUMBA_NUM_THREADS)
+
+
+def bucket(n):
+    """
+    Upper end of the power-of-two N bucket that n falls in.
+    """
+    return max(min_bucket, 1 << int(math.ceil(math.log(max(n, 1), 2))))
+
+
+def _key(n, dim, dtype, tolerance):
+    return '{}|n<={}|{}|{}d|tol={}'.format(host(), bucket(n),
+                                           np.dtype(dtype).name, dim,
+                                           tolerance)
+
+
+def _load():
+    global _loaded
+    if not _loaded:
+        _choices.update(_read())
+        _loaded = True
+
+
+def _read():
+    try:
+        with open(tuning_file) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return dict((key, Choice(e['backend'], e['params'], e['seconds']))
+                for key, e in data.get('choices', {}).items())
+
+
+def _store(key, choice, candidates):
+    # merge with what other processes wrote meanwhile, then replace the
+    # file atomically
+    choices = _read()
+    choices[key] = choice
+    data = dict(version=1, choices=dict(
+        (k, dict(c._asdict(), **({'candidates': candidates}
+                                 if k == key else {})))
+        for k, c in choices.items()))
+    directory = os.path.dirname(tuning_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '{}.{}.tmp'.format(tuning_file, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp, tuning_file)
+
+
+def forget():
+    """
+    Drop the in-memory choices, the tuning file is read again on next use.
+    """
+    global _loaded
+    _choices.clear()
+    _loaded = False
+
+
+def candidates(n, dim, dtype, tolerance=None):
+    """
+    (backend, params) pairs that apply to a problem, available ones only.
+    """
+    dtype = np.dtype(dtype)
+    for backend in registry.values():
+        if dim not in backend.dims or dtype not in backend.dtypes:
+            continue
+        if not backend.exact and tolerance is None:
+            continue
+        if backend.max_n is not None and n > backend.max_n:
+            continue
+        if not backend.available():
+            continue
+        grid = backend.params(dim) if callable(backend.params) \
+            else backend.params
+        names = sorted(grid)
+        for values in itertools.product(*(grid[k] for k in names)):
+            yield backend, dict(zip(names, values))
+
+
+def _describe(name, params):
+    return '{}({})'.format(name, ', '.join(
+        '{}={}'.format(k, v) for k, v in sorted(params.items())))
+
+
+def tune(positions, weights, tolerance=None, log=None):
+    """
+    Time every candidate on these inputs and store the fastest for their
+    bucket. Returns the Choice.
+    """
+    positions = np.asarray(positions)
+    n, dim = positions.shape
+    key = _key(n, dim, positions.dtype, tolerance)
+    best = None
+    timings = []
+    for backend, params in candidates(n, dim, positions.dtype, tolerance):
+        call = lambda: backend.function(positions, weights, **params)
+        # the warm-up call may compile, so it isn't timed
+        acc = call()
+        entry = dict(backend=backend.name, params=params)
+        if not backend.exact:
+            err = direct.force_error(positions, weights, acc, n_samples=100)
+            entry['error'] = err.p99
+            if not err.p99 <= tolerance:
+                entry['rejected'] = 'error'
+                timings.append(entry)
+                if log is not None:
+                    log('  {:<48s} p99 error {:.2e}, rejected'.format(
+                        _describe(backend.name, params), err.p99))
+                continue
+        start = time.perf_counter()
+        call()
+        seconds = time.perf_counter() - start
+        if best is None or seconds < give_up * best.seconds:
+            for _ in range(repeat - 1):
+                t0 = time.perf_counter()
+                call()
+                seconds = min(seconds, time.perf_counter() - t0)
+        entry['seconds'] = seconds
+        timings.append(entry)
+        if log is not None:
+            log('  {:<48s} {:>10.3f} ms'.format(
+                _describe(backend.name, params), seconds * 1000))
+        if best is None or seconds < best.seconds:
+            best = Choice(backend.name, params, seconds)
+    if best is None:
+        raise ValueError('no backend handles {} bodies of {} in {}D{}'.format(
+            n, positions.dtype, dim, '' if tolerance is None
+            else ' within {}'.format(tolerance)))
+    _load()
+    _choices[key] = best
+    _store(key, best, timings)
+    if log is not None:
+        log('{} -> {}'.format(key, _describe(best.backend, best.params)))
+    return best
+
+
+def choose(positions, weights, tolerance=None, log=None):
+    """
+    The tuned Choice for these inputs' bucket, tuning on them first if
+    the bucket has none yet.
+    """
+    positions = np.asarray(positions)
+    n, dim = positions.shape
+    _load()
+    choice = _choices.get(_key(n, dim, positions.dtype, tolerance))
+    if choice is None or choice.backend not in registry:
+        choice = tune(positions, weights, tolerance, log)
+    return choice
+
+
+def accelerations(positions, weights, backend='auto', tolerance=None,
+                  **params):
+    """
+    Accelerations through the registry. backend='auto' uses the tuned
+    choice for the problem (tuning on first use), tolerance admits the
+    approximate backends. A named backend runs with its own defaults
+    unless params are given.
+    """
+    if backend == 'auto':
+        choice = choose(positions, weights, tolerance)
+        backend, params = choice.backend, dict(choice.params, **params)
+    return registry[backend].function(positions, weights, **params)
+
+
+def force(backend='auto', tolerance=None, **params):
+    """
+    A force(positions, weights) function for the integrators.
+    """
+    return lambda positions, weights: accelerations(
+        positions, weights, backend, tolerance, **params)
+
+
+def step(positions, velocities, weights, dt, integrator='leapfrog',
+         acc=None, backend='auto', tolerance=None):
+    """
+    One step of a registered integrator with the given (by default the
+    tuned) force backend. Pass back what the previous step returned as
+    acc: the accelerations, or the state tuple of integrators with their
+    own forces ((acc, jerk) for hermite). Those don't use the registry,
+    so backend and tolerance must be left at their defaults.
+    """
+    function, takes_force = integrators[integrator]
+    if takes_force:
+        return function(positions, velocities, weights, dt, acc,
+                        force=force(backend, tolerance))
+    if backend != 'auto' or tolerance is not None:
+        raise ValueError('{} evaluates its own forces, it has no backend '
+                         'or tolerance'.format(integrator))
+    if acc is None:
+        return function(positions, velocities, weights, dt)
+    if not isinstance(acc, tuple):
+        raise TypeError('{} needs the state tuple its last step returned '
+                        'as acc'.format(integrator))
+    return function(positions, velocities, weights, dt, *acc)
+
+
+if __name__ == "__main__":
+    print('Tuning into {}'.format(tuning_file))
+    for dim in (2, 3):
+        for n_bodies in (1024, 16384):
+            rs = np.random.RandomState(0)
+            p = rs.uniform(-1.0, 1.0, (n_bodies, dim)).astype(np.float32)
+            w = rs.uniform(1.0, 2.0, n_bodies).astype(np.float32)
+            for tolerance in (None, 1e-2):
+                print('{}D n={} tolerance={}'.format(dim, n_bodies, tolerance))
+                tune(p, w, tolerance, log=print)
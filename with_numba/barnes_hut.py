@@ -0,0 +1,334 @@
+"""
+Barnes-Hut tree gravity on the CPU.
+
+A quadtree for (n, 2) positions (make_nbody_samples) and an octree for
+(n, 3) positions (the 'position' / 'mass' fields of NBodySimulation), with
+the same accelerations(positions, weights) contract as run_cpu_nbody plus an
+opening angle theta. theta = 0 opens every cell and reproduces the direct
+sum; 0.5 - 0.7 is the usual speed / accuracy trade-off.
+
+The tree is built from Morton-sorted bodies, so every node owns a
+contiguous range [start, end) of the sorted order and all node data lives in
+flat arrays. Nodes are created one level at a time with a parallel count /
+scan / fill pass, and the mass moments are reduced bottom-up level by level.
+"""
+
+from __future__ import division
+
+import math
+from collections import namedtuple
+
+import numpy as np
+from numba import njit, prange
+
+from . import direct
+
+eps_2 = direct.eps_2
+
+# bits of Morton code per axis, so codes fit in an int64
+morton_bits = {2: 31, 3: 21}
+
+# bodies per leaf before a node is split
+leaf_size = 8
+
+# bodies handled per parallel chunk during traversal (one stack per chunk)
+chunk_size = 256
+
+
+@njit(cache=True, inline='always')
+def _spread_2(v):
+    v &= 0x7fffffff
+    v = (v | (v << 16)) & 0x0000ffff0000ffff
+    v = (v | (v << 8)) & 0x00ff00ff00ff00ff
+    v = (v | (v << 4)) & 0x0f0f0f0f0f0f0f0f
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+@njit(cache=True, inline='always')
+def _spread_3(v):
+    v &= 0x1fffff
+    v = (v | (v << 32)) & 0x1f00000000ffff
+    v = (v | (v << 16)) & 0x1f0000ff0000ff
+    v = (v | (v << 8)) & 0x100f00f00f00f00f
+    v = (v | (v << 4)) & 0x10c30c30c30c30c3
+    v = (v | (v << 2)) & 0x1249249249249249
+    return v
+
+
+@njit(cache=True, parallel=True)
+def _morton_codes(x, y, z, lo, scale, dim, bits, codes):
+    top = (1 << bits) - 1
+    for i in prange(x.shape[0]):
+        qx = min(max(np.int64((x[i] - lo[0]) * scale), 0), top)
+        qy = min(max(np.int64((y[i] - lo[1]) * scale), 0), top)
+        if dim == 2:
+            codes[i] = _spread_2(qx) | (_spread_2(qy) << 1)
+        else:
+            qz = min(max(np.int64((z[i] - lo[2]) * scale), 0), top)
+            codes[i] = (_spread_3(qx) | (_spread_3(qy) << 1)
+                        | (_spread_3(qz) << 2))
+
+
+@njit(cache=True, inline='always')
+def _key_end(codes, pos, end, shift, mask, key):
+    # first index in [pos, end) whose child key is past key
+    hi = end
+    while pos < hi:
+        mid = (pos + hi) // 2
+        if (codes[mid] >> shift) & mask <= key:
+            pos = mid + 1
+        else:
+            hi = mid
+    return pos
+
+
+@njit(cache=True, parallel=True)
+def _count_children(codes, start, end, level, dim, bits, leaf_size, counts):
+    shift = dim * (bits - 1 - level)
+    mask = (1 << dim) - 1
+    for m in prange(start.shape[0]):
+        s = start[m]
+        e = end[m]
+        c = 0
+        if e - s > leaf_size and level < bits:
+            while s < e:
+                s = _key_end(codes, s, e, shift, mask, (codes[s] >> shift) & mask)
+                c += 1
+        counts[m] = c
+
+
+@njit(cache=True, parallel=True)
+def _fill_children(codes, start, end, level, dim, bits, counts, offsets,
+                   child_start, child_end):
+    shift = dim * (bits - 1 - level)
+    mask = (1 << dim) - 1
+    for m in prange(start.shape[0]):
+        if counts[m] == 0:
+            continue
+        s = start[m]
+        e = end[m]
+        c = offsets[m]
+        while s < e:
+            nxt = _key_end(codes, s, e, shift, mask, (codes[s] >> shift) & mask)
+            child_start[c] = s
+            child_end[c] = nxt
+            c += 1
+            s = nxt
+
+
+@njit(cache=True, parallel=True)
+def _node_moments(lo, hi, start, end, child_first, child_count,
+                  x, y, z, w, mass, com):
+    for m in prange(lo, hi):
+        mt = 0.0
+        cx = 0.0
+        cy = 0.0
+        cz = 0.0
+        if child_count[m] == 0:
+            for j in range(start[m], end[m]):
+                mt += w[j]
+                cx += w[j] * x[j]
+                cy += w[j] * y[j]
+                cz += w[j] * z[j]
+        else:
+            for c in range(child_first[m], child_first[m] + child_count[m]):
+                mt += mass[c]
+                cx += mass[c] * com[c, 0]
+                cy += mass[c] * com[c, 1]
+                cz += mass[c] * com[c, 2]
+        mass[m] = mt
+        if mt != 0.0:
+            com[m, 0] = cx / mt
+            com[m, 1] = cy / mt
+            com[m, 2] = cz / mt
+        else:
+            com[m, 0] = x[start[m]]
+            com[m, 1] = y[start[m]]
+            com[m, 2] = z[start[m]]
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _traverse(x, y, z, w, start, end, child_first, child_count, mass, com,
+              size, theta_2, eps_2, chunk_size, stack_size, out):
+    n = x.shape[0]
+    n_chunks = (n + chunk_size - 1) // chunk_size
+    for b in prange(n_chunks):
+        stack = np.empty(stack_size, np.int64)
+        for i in range(b * chunk_size, min((b + 1) * chunk_size, n)):
+            xi = x[i]
+            yi = y[i]
+            zi = z[i]
+            axi = 0.0
+            ayi = 0.0
+            azi = 0.0
+            stack[0] = 0
+            top = 1
+            while top > 0:
+                top -= 1
+                m = stack[top]
+                if child_count[m] == 0:
+                    for j in range(start[m], end[m]):
+                        rx = x[j] - xi
+                        ry = y[j] - yi
+                        rz = z[j] - zi
+                        sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+                        s = w[j] / (sqr_dist * math.sqrt(sqr_dist))
+                        axi += rx * s
+                        ayi += ry * s
+                        azi += rz * s
+                    continue
+                rx = com[m, 0] - xi
+                ry = com[m, 1] - yi
+                rz = com[m, 2] - zi
+                sqr_dist = rx * rx + ry * ry + rz * rz
+                if size[m] * size[m] < theta_2 * sqr_dist:
+                    sqr_dist += eps_2
+                    s = mass[m] / (sqr_dist * math.sqrt(sqr_dist))
+                    axi += rx * s
+                    ayi += ry * s
+                    azi += rz * s
+                else:
+                    for c in range(child_first[m], child_first[m] + child_count[m]):
+                        stack[top] = c
+                        top += 1
+            out[i, 0] = axi
+            out[i, 1] = ayi
+            out[i, 2] = azi
+
+
+Tree = namedtuple('Tree', [
+    'dim',          # 2 for a quadtree, 3 for an octree
+    'order',        # sorted index -> original body index
+    'x', 'y', 'z', 'w',  # bodies in Morton order (z is zero in 2D)
+    'start', 'end',      # body range [start, end) of each node
+    'child_first', 'child_count',
+    'level_offsets',     # nodes of level l are level_offsets[l]:level_offsets[l + 1]
+    'mass', 'com', 'size'])
+
+
+def build_tree(positions, weights, leaf_size=leaf_size):
+    """
+    Build a quadtree (n, 2) or octree (n, 3) over the given bodies.
+    """
+    positions = np.asarray(positions)
+    n, dim = positions.shape
+    if dim not in morton_bits:
+        raise ValueError('positions must be (n, 2) or (n, 3), got {}'
+                         .format(positions.shape))
+    bits = morton_bits[dim]
+
+    comps = direct.split_components(positions, weights, np.float64)
+    if dim == 2:
+        comps.insert(2, np.zeros(n))
+    x, y, z, w = comps
+
+    # bounding cube of all bodies, slightly enlarged so the max lands inside
+    lo = np.array([x.min(), y.min(), z.min()])
+    extent = max(x.max() - lo[0], y.max() - lo[1], z.max() - lo[2])
+    extent = extent * (1 + 1e-6) if extent > 0 else 1.0
+    codes = np.empty(n, np.int64)
+    _morton_codes(x, y, z, lo, (1 << bits) / extent, dim, bits, codes)
+
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    x, y, z, w = x[order], y[order], z[order], w[order]
+
+    starts = [np.zeros(1, np.int64)]
+    ends = [np.full(1, n, np.int64)]
+    child_first = []
+    child_count = []
+    level_offsets = [0]
+    level = 0
+    while True:
+        s, e = starts[-1], ends[-1]
+        counts = np.empty(len(s), np.int64)
+        _count_children(codes, s, e, level, dim, bits, leaf_size, counts)
+        offsets = np.cumsum(counts) - counts
+        level_offsets.append(level_offsets[-1] + len(s))
+        child_first.append(np.where(counts > 0, level_offsets[-1] + offsets, -1))
+        child_count.append(counts)
+        total = int(counts.sum())
+        if total == 0:
+            break
+        cs = np.empty(total, np.int64)
+        ce = np.empty(total, np.int64)
+        _fill_children(codes, s, e, level, dim, bits, counts, offsets, cs, ce)
+        starts.append(cs)
+        ends.append(ce)
+        level += 1
+
+    start = np.concatenate(starts)
+    end = np.concatenate(ends)
+    child_first = np.concatenate(child_first)
+    child_count = np.concatenate(child_count)
+    n_nodes = len(start)
+    mass = np.empty(n_nodes)
+    com = np.empty((n_nodes, 3))
+    for l in range(len(level_offsets) - 2, -1, -1):
+        _node_moments(level_offsets[l], level_offsets[l + 1], start, end,
+                      child_first, child_count, x, y, z, w, mass, com)
+    size = np.empty(n_nodes)
+    for l in range(len(level_offsets) - 1):
+        size[level_offsets[l]:level_offsets[l + 1]] = extent / (1 << l)
+
+    return Tree(dim, order, x, y, z, w, start, end, child_first, child_count,
+                np.array(level_offsets), mass, com, size)
+
+
+def tree_accelerations(tree, theta=0.5, eps_2=eps_2, chunk_size=chunk_size):
+    """
+    Accelerations of the bodies in a built tree, in original body order.
+    """
+    stack_size = (len(tree.level_offsets) + 1) * (1 << tree.dim)
+    acc = np.empty((len(tree.x), 3))
+    _traverse(tree.x, tree.y, tree.z, tree.w, tree.start, tree.end,
+              tree.child_first, tree.child_count, tree.mass, tree.com,
+              tree.size, float(theta) ** 2, float(eps_2), chunk_size,
+              stack_size, acc)
+    out = np.empty_like(acc[:, :tree.dim])
+    out[tree.order] = acc[:, :tree.dim]
+    return out
+
+
+def accelerations(positions, weights, theta=0.5, eps_2=eps_2, out=None,
+                  leaf_size=leaf_size):
+    """
+    Compute gravitational accelerations of all bodies with a Barnes-Hut tree.
+    """
+    positions = np.asarray(positions)
+    tree = build_tree(positions, weights, leaf_size)
+    acc = tree_accelerations(tree, theta, eps_2)
+    if out is None:
+        out = np.empty(positions.shape, dtype=positions.dtype)
+    out[:] = acc
+    return out
+
+
+# error against the exact direct sum, sampled for large N
+force_error = direct.force_error
+
+
+if __name__ == "__main__":
+    import time
+
+    for dim in (2, 3):
+        # compile outside the timed region
+        accelerations(np.random.RandomState(0).uniform(-1, 1, (100, dim)),
+                      np.ones(100))
+        for n_bodies in (10 ** 4, 10 ** 5, 10 ** 6):
+            rs = np.random.RandomState(0)
+            p = rs.uniform(-1.0, 1.0, (n_bodies, dim)).astype(np.float32)
+            w = rs.uniform(1.0, 2.0, n_bodies).astype(np.float32)
+            for theta in (0.3, 0.5, 0.7):
+                t0 = time.perf_counter()
+                tree = build_tree(p, w)
+                t1 = time.perf_counter()
+                acc = tree_accelerations(tree, theta)
+                t2 = time.perf_counter()
+                err = force_error(p, w, acc)
+                print('{}D n={:>8d} theta={:.1f}  build {:>8.1f} ms  '
+                      'forces {:>9.1f} ms  rms err {:.2e}  max err {:.2e}'.format(
+                          dim, n_bodies, theta, (t1 - t0) * 1000,
+                          (t2 - t1) * 1000, err.rms, err.max))
@@ -1,98 +1,112 @@
 """
 Benchmarks for the CUDA backend.
+
+The kernels are defined at the top level with cache=True: they compile on
+first launch, or load from numba's on-disk cache, so importing this module
+needs no GPU and later processes skip the compilation.
 """
 
 from __future__ import division
 
 import math
 import sys
-from numba import cuda
 import numpy as np
 from numba import cuda, float32, float64
 
-def _jit_setup1():
-    from numba import cuda, float32, float64
+from . import direct
 
 
-    def addmul(x, y, out):
-        i = cuda.threadIdx.x + cuda.blockIdx.x * cuda.blockDim.x
-        if i >= x.shape[0]:
-            return
-        out[i] = x[i] + y[i] * math.fabs(x[i])
+def addmul(x, y, out):
+    i = cuda.threadIdx.x + cuda.blockIdx.x * cuda.blockDim.x
+    if i >= x.shape[0]:
+        return
+    out[i] = x[i] + y[i] * math.fabs(x[i])
 
-    addmul_f32 = cuda.jit()(addmul)
-    addmul_f64 = cuda.jit()(addmul)
+addmul_f32 = cuda.jit(cache=True)(addmul)
+addmul_f64 = cuda.jit(cache=True)(addmul)
 
 
-    def no_op():
-        pass
+@cuda.jit(cache=True)
+def no_op():
+    pass
 
 
-    # N-body simulation.  We actually only run the step which computes the
-    # accelerations from the positions and weights of the bodies (updating
-    # speeds and positions is relatively uninteresting).
+# N-body simulation.  We actually only run the step which computes the
+# accelerations from the positions and weights of the bodies (updating
+# speeds and positions is relatively uninteresting).
 
-    # CUDA version adapted from http://http.developer.nvidia.com/GPUGems3/gpugems3_ch31.html
+# CUDA version adapted from http://http.developer.nvidia.com/GPUGems3/gpugems3_ch31.html
 
-    eps_2 = np.float32(1e-6)
-    zero = np.float32(0.0)
-    one = np.float32(1.0)
+eps_2 = np.float32(1e-6)
+zero = np.float32(0.0)
+one = np.float32(1.0)
 
-    @cuda.jit(device=True, inline=True)
-    def body_body_interaction(xi, yi, xj, yj, wj, axi, ayi):
-        """
-        Compute the influence of body j on the acceleration of body i.
-        """
-        rx = xj - xi
-        ry = yj - yi
-        sqr_dist = rx * rx + ry * ry + eps_2
-        sixth_dist = sqr_dist * sqr_dist * sqr_dist
-        inv_dist_cube = one / math.sqrt(sixth_dist)
-        s = wj * inv_dist_cube
-        axi += rx * s
-        ayi += ry * s
-        return axi, ayi
+@cuda.jit(device=True, inline=True)
+def body_body_interaction(xi, yi, xj, yj, wj, axi, ayi):
+    """
+    Compute the influence of body j on the acceleration of body i.
+    """
+    rx = xj - xi
+    ry = yj - yi
+    sqr_dist = rx * rx + ry * ry + eps_2
+    sixth_dist = sqr_dist * sqr_dist * sqr_dist
+    inv_dist_cube = one / math.sqrt(sixth_dist)
+    s = wj * inv_dist_cube
+    axi += rx * s
+    ayi += ry * s
+    return axi, ayi
+
+@cuda.jit(device=True, inline=True)
+def tile_calculation(xi, yi, axi, ayi, xs, ys, weights):
+    """
+    Compute the contribution of this block's tile to the acceleration
+    of body i.
+    """
+    for j in range(cuda.blockDim.x):
+        axi, ayi = body_body_interaction(xi, yi, xs[j], ys[j], weights[j],
+                                         axi, ayi)
+    return axi, ayi
 
-    @cuda.jit(device=True, inline=True)
-    def tile_calculation(xi, yi, axi, ayi, positions, weights):
-        """
-        Compute the contribution of this block's tile to the acceleration
-        of body i.
-        """
-        for j in range(cuda.blockDim.x):
-            xj = positions[j,0]
-            yj = positions[j,1]
-            wj = weights[j]
-            axi, ayi = body_body_interaction(xi, yi, xj, yj, wj, axi, ayi)
-        return axi, ayi
 
-    globals().update(locals())
+# default bodies per tile, one thread per body of the tile
+tile_size = 128
 
 
-tile_size = 128
+def shared_bytes(tile):
+    """
+    Dynamic shared memory calculate_forces needs for tiles of tile bodies.
+    """
+    return 3 * 4 * tile
+
 
-# Don't JIT this function at the top-level as it breaks until Numba 0.16.
+@cuda.jit(cache=True)
 def calculate_forces(positions, weights, accelerations):
     """
     Calculate accelerations produced on all bodies by mutual gravitational
-    forces.
+    forces. The tile is the block size, so one cached kernel serves every
+    tile size: launch it with shared_bytes(blockdim) of dynamic shared
+    memory, on a number of bodies that is a multiple of blockdim.
     """
-    sh_positions = cuda.shared.array((tile_size, 2), float32)
-    sh_weights = cuda.shared.array(tile_size, float32)
+    tile = cuda.blockDim.x
+    # dynamic shared arrays all start at the same address, so one array is
+    # split into the x, y and weight rows of the tile
+    sh = cuda.shared.array(0, float32)
+    sh_x = sh[:tile]
+    sh_y = sh[tile:2 * tile]
+    sh_weights = sh[2 * tile:3 * tile]
     i = cuda.grid(1)
+    k = cuda.threadIdx.x
     axi = float32(0.0)
     ayi = float32(0.0)
     xi = positions[i,0]
     yi = positions[i,1]
-    for j in range(0, len(weights), tile_size):
-        index = (j // tile_size) * cuda.blockDim.x + cuda.threadIdx.x
-        sh_index = cuda.threadIdx.x
-        sh_positions[sh_index,0] = positions[index,0]
-        sh_positions[sh_index,1] = positions[index,1]
-        sh_weights[sh_index] = weights[index]
+    for j in range(0, len(weights), tile):
+        sh_x[k] = positions[j + k,0]
+        sh_y[k] = positions[j + k,1]
+        sh_weights[k] = weights[j + k]
         cuda.syncthreads()
         axi, ayi = tile_calculation(xi, yi, axi, ayi,
-                                    sh_positions, sh_weights)
+                                    sh_x, sh_y, sh_weights)
         cuda.syncthreads()
     accelerations[i,0] = axi
     accelerations[i,1] = ayi
@@ -100,10 +114,9 @@ def calculate_forces(positions, weights, accelerations):
 
 class NBodyCUDARunner:
 
-    def __init__(self, positions, weights):
-        self.calculate_forces = cuda.jit(
-            argtypes=(float32[:,:], float32[:], float32[:,:])
-            )(calculate_forces)
+    def __init__(self, positions, weights, tile=tile_size):
+        self.calculate_forces = calculate_forces
+        self.tile = tile
         self.accelerations = np.zeros_like(positions)
         self.n_bodies = len(weights)
         self.stream = cuda.stream()
@@ -113,9 +126,10 @@ class NBodyCUDARunner:
         self.stream.synchronize()
 
     def run(self):
-        blockdim = tile_size
+        blockdim = self.tile
         griddim = int(math.ceil(self.n_bodies / blockdim))
-        self.calculate_forces[griddim, blockdim, self.stream](
+        self.calculate_forces[griddim, blockdim, self.stream,
+                              shared_bytes(blockdim)](
             self.d_pos, self.d_wei, self.d_acc)
         self.stream.synchronize()
 
@@ -126,19 +140,7 @@ class NBodyCUDARunner:
 
 
 def run_cpu_nbody(positions, weights):
-    accelerations = np.zeros_like(positions)
-    n = weights.size
-    for j in range(n):
-        # Compute influence of j'th body on all bodies
-        r = positions[j] - positions
-        rx = r[:,0]
-        ry = r[:,1]
-        sqr_dist = rx * rx + ry * ry + eps_2
-        sixth_dist = sqr_dist * sqr_dist * sqr_dist
-        inv_dist_cube = one / np.sqrt(sixth_dist)
-        s = weights[j] * inv_dist_cube
-        accelerations += (r.transpose() * s).transpose()
-    return accelerations
+    return direct.accelerations(positions, weights, eps_2)
 
 def make_nbody_samples(n_bodies):
     positions = np.random.RandomState(0).uniform(-1.0, 1.0, (n_bodies, 2))
@@ -171,34 +173,29 @@ args = (callResultGold, putResultGold, stockPrice, optionStrike,
         optionYears, RISKFREE, VOLATILITY)
 
 
-def _jit_setup2():
-    from numba import cuda
-
-    @cuda.jit(device=True, inline=True)
-    def cnd_cuda(d):
-        K = 1.0 / (1.0 + 0.2316419 * math.fabs(d))
-        ret_val = (RSQRT2PI * math.exp(-0.5 * d * d) *
-                (K * (A1 + K * (A2 + K * (A3 + K * (A4 + K * A5))))))
-        if d > 0:
-            ret_val = 1.0 - ret_val
-        return ret_val
-
-    @cuda.jit()
-    def black_scholes_cuda(callResult, putResult, S, X, T, R, V):
-        i = cuda.threadIdx.x + cuda.blockIdx.x * cuda.blockDim.x
-        if i >= S.shape[0]:
-            return
-        sqrtT = math.sqrt(T[i])
-        d1 = (math.log(S[i] / X[i]) + (R + 0.5 * V * V) * T[i]) / (V * sqrtT)
-        d2 = d1 - V * sqrtT
-        cndd1 = cnd_cuda(d1)
-        cndd2 = cnd_cuda(d2)
+@cuda.jit(device=True, inline=True)
+def cnd_cuda(d):
+    K = 1.0 / (1.0 + 0.2316419 * math.fabs(d))
+    ret_val = (RSQRT2PI * math.exp(-0.5 * d * d) *
+            (K * (A1 + K * (A2 + K * (A3 + K * (A4 + K * A5))))))
+    if d > 0:
+        ret_val = 1.0 - ret_val
+    return ret_val
 
-        expRT = math.exp((-1. * R) * T[i])
-        callResult[i] = (S[i] * cndd1 - X[i] * expRT * cndd2)
-        putResult[i] = (X[i] * expRT * (1.0 - cndd2) - S[i] * (1.0 - cndd1))
+@cuda.jit(cache=True)
+def black_scholes_cuda(callResult, putResult, S, X, T, R, V):
+    i = cuda.threadIdx.x + cuda.blockIdx.x * cuda.blockDim.x
+    if i >= S.shape[0]:
+        return
+    sqrtT = math.sqrt(T[i])
+    d1 = (math.log(S[i] / X[i]) + (R + 0.5 * V * V) * T[i]) / (V * sqrtT)
+    d2 = d1 - V * sqrtT
+    cndd1 = cnd_cuda(d1)
+    cndd2 = cnd_cuda(d2)
 
-    globals().update(locals())
+    expRT = math.exp((-1. * R) * T[i])
+    callResult[i] = (S[i] * cndd1 - X[i] * expRT * cndd2)
+    putResult[i] = (X[i] * expRT * (1.0 - cndd2) - S[i] * (1.0 - cndd1))
 
 
 class Synthetic:
@@ -208,7 +205,7 @@ class Synthetic:
     n = 4 * 256 * 1024
 
     def setup(self):
-        self.no_op = cuda.jit(argtypes=())(no_op)
+        self.no_op = no_op
         self.stream = cuda.stream()
         self.f32 = np.zeros(self.n, dtype=np.float32)
         self.d_f32 = cuda.to_device(self.f32, self.stream)
@@ -284,6 +281,9 @@ class NBody:
         self.positions, self.weights = make_nbody_samples(self.n_bodies)
         self.runner = NBodyCUDARunner(self.positions, self.weights)
 
+    def time_numpy_nbody(self):
+        direct.run_numpy_nbody(self.positions, self.weights)
+
     def time_cpu_nbody(self):
         run_cpu_nbody(self.positions, self.weights)
 
@@ -323,8 +323,10 @@ class DataTransfer:
 
 
 def setup():
-    _jit_setup1()
-    _jit_setup2()
+    """
+    asv setup hook, the kernels compile (or load from the cache) on first
+    launch; with_numba.precompile builds them up front.
+    """
 
 
 n_bodies = 1000
@@ -0,0 +1,18 @@
+"""
+Benchmark suite for the CPU and GPU engines.
+
+    python -m with_numba.benchmarks --quick -o results.json
+    python -m with_numba.benchmarks --quick --baseline results.json
+
+Workloads (see workloads.py): direct-sum nbody over 1k..1M bodies, pm
+over 128..2048 grids, blackscholes, the addmul / reduce kernels of
+bench_cuda.Synthetic, the exp threading demo, CUDA transfers and the
+import time of the engine modules (imports.py). Each has NumPy, numba
+serial and numba parallel variants where it runs on the CPU; 'cuda' and
+'gl' variants are skipped on hosts without a device or context. Results
+hold wall time, throughput (interactions/s for nbody) and peak RSS per
+case, see harness.py.
+"""
+
+from .harness import compare, load, run, save
+from .workloads import Skip, Workload, by_name, workloads
@@ -0,0 +1,81 @@
+"""
+python -m with_numba.benchmarks [options]
+
+Runs the benchmark sweeps, writes the results as JSON and, given a
+baseline, exits with status 1 when any case regressed.
+"""
+
+from __future__ import division
+
+import argparse
+import sys
+
+from . import harness
+from .workloads import workloads, by_name
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m with_numba.benchmarks',
+        description='Time every workload and variant over size sweeps.')
+    parser.add_argument('-w', '--workload', nargs='+', choices=sorted(by_name),
+                        help='workloads to run (default: all)')
+    parser.add_argument('-v', '--variant', nargs='+',
+                        help='variants to run, e.g. numpy numba-parallel '
+                             'cuda (default: all)')
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        help='sizes to run instead of the sweeps')
+    parser.add_argument('--quick', action='store_true',
+                        help='short sweeps, for CI')
+    parser.add_argument('--repeat', type=int, default=harness.repeat,
+                        help='timed calls per case, the fastest counts '
+                             '(default: %(default)s)')
+    parser.add_argument('--budget', type=float, default=harness.budget,
+                        help='seconds a case may take before the rest of '
+                             'its sweep is skipped, 0 for no limit '
+                             '(default: %(default)s)')
+    parser.add_argument('-o', '--output', help='JSON file for the results')
+    parser.add_argument('--baseline',
+                        help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=harness.threshold,
+                        help='relative slowdown that counts as a regression '
+                             '(default: %(default)s)')
+    parser.add_argument('--list', action='store_true',
+                        help='list the workloads and their variants and exit')
+    args = parser.parse_args(argv)
+
+    selected = [by_name[name] for name in args.workload] \
+        if args.workload else workloads
+    if args.list:
+        for w in selected:
+            print('{:<14s} {:<12s} {}'.format(
+                w.name, w.unit, ' '.join(v for v, _ in w.variants)))
+        return 0
+
+    baseline = harness.load(args.baseline) if args.baseline else None
+    report = harness.run(selected, variants=args.variant, sizes=args.sizes,
+                         quick=args.quick, repeat=args.repeat,
+                         budget=args.budget or None)
+    if args.output:
+        harness.save(report, args.output)
+        print('Wrote {}'.format(args.output))
+    if baseline is None:
+        return 0
+
+    if baseline['host'] != report['host']:
+        print('Warning: the baseline was measured on a different host')
+    comparison = harness.compare(report, baseline, args.threshold)
+    for title, changes in (('Regressions', comparison.regressions),
+                           ('Improvements', comparison.improvements)):
+        if changes:
+            print('{} (over {:.0%}):'.format(title, args.threshold))
+            for change in changes:
+                print('  ' + harness.format_change(change))
+    print('{} regressed, {} improved, {} unchanged, {} not run'.format(
+        len(comparison.regressions), len(comparison.improvements),
+        len(comparison.unchanged), len(comparison.missing)))
+    return 1 if comparison.regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+Timing, peak memory and baseline comparison for the benchmark workloads.
+
+Every case (workload, variant, size) is set up, called once untimed (JIT
+compilation, first touch of the inputs, device warm-up) and then timed
+`repeat` times; the best call is its wall time. The seconds spent in
+numba's compiler during setup and the first call are kept apart as
+compile_time. Peak RSS is the resident high-water mark of the case: on
+Linux it is reset before every case through /proc/self/clear_refs,
+elsewhere it is the process-wide ru_maxrss and only ever grows.
+
+Sweeps go from small to large sizes. Once the wall time predicted for the
+next size, from the last one and the workload's exponent, would take the
+case over the time budget, the rest of the sweep is recorded as skipped,
+so the default 1k..1M sweeps end where each variant gets too slow.
+"""
+
+from __future__ import division
+
+import gc
+import json
+import os
+import platform
+import sys
+import time
+from collections import namedtuple
+
+import numba
+import numpy as np
+
+from ..precompile import CompileTimer
+from .workloads import Skip
+
+# timed calls per case, the fastest is reported
+repeat = 3
+
+# seconds one case (warm-up and timed calls) may be predicted to take
+budget = 30.0
+
+# relative slowdown against the baseline that counts as a regression
+threshold = 0.1
+
+# (key, baseline seconds, new seconds, new / baseline) of compare()
+Change = namedtuple('Change', ['key', 'baseline', 'time', 'ratio'])
+Comparison = namedtuple('Comparison', ['regressions', 'improvements',
+                                       'unchanged', 'missing'])
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    """
+    Resident set high-water mark in bytes.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere but on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def host():
+    """
+    What the numbers were measured on, stored with the results.
+    """
+    return dict(
+        node=platform.node(),
+        machine=platform.machine(),
+        processor=platform.processor(),
+        system=platform.platform(),
+        cpu_count=os.cpu_count(),
+        numba_threads=numba.config.NUMBA_NUM_THREADS,
+        python=platform.python_version(),
+        numpy=np.__version__,
+        numba=numba.__version__)
+
+
+def run_case(workload, variant, setup, size, repeat=repeat):
+    """
+    Time one case. Returns its result dict, with status 'skipped' and the
+    reason when setup raised Skip.
+    """
+    result = dict(workload=workload.name, variant=variant, size=size,
+                  unit=workload.unit, work=workload.work(size))
+    gc.collect()
+    _reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        with CompileTimer() as compile_timer:
+            run = setup(size)
+            run()
+    except Skip as e:
+        result.update(status='skipped', reason=str(e))
+        return result
+    warmup = time.perf_counter() - start
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t0)
+    best = min(times)
+    result.update(status='ok', wall_time=best, times=times, warmup=warmup,
+                  compile_time=compile_timer.seconds,
+                  rate=result['work'] / best, peak_rss=peak_rss())
+    return result
+
+
+def format_result(r):
+    head = '{:<14s} {:<16s} {:>9d}'.format(r['workload'], r['variant'],
+                                           r['size'])
+    if r['status'] != 'ok':
+        return '{}  skipped: {}'.format(head, r['reason'])
+    return '{}  {:>10.3f} ms  {:>9.3g} {}/s  peak {:>7.1f} MB'.format(
+        head, r['wall_time'] * 1000, r['rate'], r['unit'],
+        r['peak_rss'] / 2 ** 20)
+
+
+def run(workloads, variants=None, sizes=None, quick=False, repeat=repeat,
+        budget=budget, log=print):
+    """
+    Run the sweeps of workloads, optionally only the named variants or the
+    given sizes. budget=None never skips. Returns the JSON-ready dict with
+    the host and one result per case.
+    """
+    results = []
+    for workload in workloads:
+        for variant, setup in workload.variants:
+            if variants and variant not in variants:
+                continue
+            skip = None
+            last = None
+            for size in sizes or (workload.quick if quick else workload.full):
+                if skip is None and budget and last is not None:
+                    predicted = last['wall_time'] * \
+                        (size / last['size']) ** workload.exponent
+                    if predicted * (repeat + 1) > budget:
+                        skip = 'over the {:g} s budget from size {} on, ' \
+                               'predicted {:.3g} s per call'.format(
+                                   budget, size, predicted)
+                if skip is not None:
+                    result = dict(workload=workload.name, variant=variant,
+                                  size=size, unit=workload.unit,
+                                  work=workload.work(size), status='skipped',
+                                  reason=skip)
+                else:
+                    result = run_case(workload, variant, setup, size, repeat)
+                    if result['status'] == 'ok':
+                        last = result
+                    else:
+                        # a missing device won't appear at a larger size
+                        skip = result['reason']
+                results.append(result)
+                if log is not None:
+                    log(format_result(result))
+    return dict(host=host(), time=time.time(), results=results)
+
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _key(r):
+    return r['workload'], r['variant'], r['size']
+
+
+def compare(report, baseline, threshold=threshold):
+    """
+    Compare the wall times of report against a baseline report, case by
+    case. A case more than threshold slower is a regression, more than
+    threshold faster an improvement; missing lists the keys of baseline
+    cases that ran but have no result in report.
+    """
+    new = dict((_key(r), r) for r in report['results'] if r['status'] == 'ok')
+    regressions, improvements, unchanged, missing = [], [], [], []
+    for old in baseline['results']:
+        if old['status'] != 'ok':
+            continue
+        key = _key(old)
+        if key not in new:
+            missing.append(key)
+            continue
+        change = Change(key, old['wall_time'], new[key]['wall_time'],
+                        new[key]['wall_time'] / old['wall_time'])
+        if change.ratio > 1 + threshold:
+            regressions.append(change)
+        elif change.ratio < 1 / (1 + threshold):
+            improvements.append(change)
+        else:
+            unchanged.append(change)
+    return Comparison(regressions, improvements, unchanged, missing)
+
+
+def format_change(change):
+    return '{:<14s} {:<16s} {:>9d}  {:>10.3f} ms -> {:>10.3f} ms  ' \
+           '{:+6.1f}%'.format(*change.key + (change.baseline * 1000,
+                                              change.time * 1000,
+                                              (change.ratio - 1) * 100))
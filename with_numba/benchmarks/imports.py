@@ -0,0 +1,111 @@
+"""
+Import cost of the engine modules.
+
+measure() imports one module in a fresh interpreter, so nothing is shared
+with the process running the benchmarks, and reports how long the import
+took, which optional backends it loaded and what it printed. Importing a
+compute module must be cheap and side-effect free: CUDA, OpenGL, Qt and
+matplotlib are imported by the functions that use them, demos run from
+main(). The 'import' workload times every module listed here and fails
+when one of them breaks that:
+
+    python -m with_numba.benchmarks -w import
+"""
+
+from __future__ import division
+
+import json
+import os
+import subprocess
+import sys
+from collections import namedtuple
+
+# packages only the backends that use them may import
+lazy = ('numba.cuda', 'OpenGL', 'PyQt5', 'moderngl', 'matplotlib')
+
+_root = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+# directory of the flat modules of the nbody app
+app_path = os.path.join(_root, 'nbody-master', 'nbody')
+
+# (variant, module, sys.path entry, lazy packages it may load anyway);
+# bench_cuda defines its kernels at the top level, so they can be cached
+modules = [
+    ('direct', 'with_numba.direct', _root, ()),
+    ('barnes_hut', 'with_numba.barnes_hut', _root, ()),
+    ('fmm', 'with_numba.fmm', _root, ()),
+    ('pm', 'with_numba.pm', _root, ()),
+    ('integrators', 'with_numba.integrators', _root, ()),
+    ('ensemble', 'with_numba.ensemble', _root, ()),
+    ('particles', 'with_numba.particles', _root, ()),
+    ('precision', 'with_numba.precision', _root, ()),
+    ('executor', 'with_numba.executor', _root, ()),
+    ('backends', 'with_numba.backends', _root, ()),
+    ('glcompute', 'with_numba.glcompute', _root, ()),
+    ('precompile', 'with_numba.precompile', _root, ()),
+    ('nbody', 'with_numba.nbody', _root, ()),
+    ('gravity', 'with_numba.gravity', _root, ()),
+    ('bench_cuda', 'with_numba.bench_cuda', _root, ('numba.cuda',)),
+    ('app-sim', 'sim', app_path, ()),
+    ('app-headless', 'headless', app_path, ()),
+]
+
+# seconds: the import statement alone, without the interpreter start-up
+# lazy: lazy packages in sys.modules afterwards
+# output: what the import wrote to stdout and stderr
+ImportTime = namedtuple('ImportTime', ['module', 'seconds', 'lazy', 'output'])
+
+_probe = """
+import io, json, sys, time
+captured = io.StringIO()
+sys.stdout = sys.stderr = captured
+start = time.perf_counter()
+try:
+    import {module}
+    error = missing = None
+except Exception as e:
+    error = '{{}}: {{}}'.format(type(e).__name__, e)
+    missing = isinstance(e, ModuleNotFoundError)
+seconds = time.perf_counter() - start
+sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+loaded = sorted(m for m in {lazy!r}
+                if any(k == m or k.startswith(m + '.') for k in sys.modules))
+print(json.dumps(dict(seconds=seconds, lazy=loaded, error=error,
+                      missing=missing, output=captured.getvalue())))
+"""
+
+
+def measure(module, path=_root):
+    """
+    Import module in a new interpreter with path first on sys.path.
+    Raises ImportError when a dependency is not installed, RuntimeError
+    when the import fails otherwise.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [path] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    out = subprocess.check_output(
+        [sys.executable, '-c', _probe.format(module=module, lazy=lazy)],
+        cwd=path, env=env)
+    r = json.loads(out.decode().splitlines()[-1])
+    if r['missing']:
+        raise ImportError('importing {} failed: {}'.format(module, r['error']))
+    if r['error'] is not None:
+        raise RuntimeError('importing {} raised {}'.format(module, r['error']))
+    return ImportTime(module, r['seconds'], r['lazy'], r['output'])
+
+
+def check(result, allowed=()):
+    """
+    Raises AssertionError when the import loaded a lazy package it
+    shouldn't or printed anything.
+    """
+    unexpected = [m for m in result.lazy if m not in allowed]
+    if unexpected:
+        raise AssertionError('importing {} loads {}'.format(
+            result.module, ', '.join(unexpected)))
+    if result.output:
+        raise AssertionError('importing {} prints {!r}'.format(
+            result.module, result.output[:200]))
+
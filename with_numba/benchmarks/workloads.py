@@ -0,0 +1,446 @@
+"""
+Benchmark workloads.
+
+A workload is one computation swept over a range of sizes, run by several
+variants. A variant is a setup function setup(size) -> run: setup does all
+the untimed work (inputs, uploads, sanity checks) and run() is one timed
+call. Every workload with a CPU implementation has the same three CPU
+variants:
+
+    numpy            vectorized NumPy reference
+    numba-serial     the numba kernel on a single thread
+    numba-parallel   the same kernel on all numba threads
+
+plus device variants ('cuda', 'gl') whose setup raises Skip when there is
+no CUDA device or no OpenGL context, so the suite runs unchanged on
+GPU-less hosts.
+"""
+
+from __future__ import division
+
+import math
+import os
+import threading
+from collections import namedtuple
+
+import numba
+import numpy as np
+from numba import njit, prange
+
+from .. import direct, executor, pm
+from . import imports
+
+
+class Skip(Exception):
+    """
+    Raised by a variant setup that can't run on this host.
+    """
+
+
+# unit: what work(size) counts, throughput is reported as unit / s
+# exponent: growth of the run time with size, used to predict the next
+# size of a sweep against the time budget
+# quick / full: size sweeps for --quick and the default run
+# variants: (name, setup) pairs in the order they run
+Workload = namedtuple('Workload', ['name', 'unit', 'work', 'exponent',
+                                   'quick', 'full', 'variants'])
+
+# bodies of the particle-mesh workload, whose sweep is over grid sizes
+pm_bodies = 1 << 18
+
+# Black-Scholes market parameters, as in bench_cuda
+RISKFREE = 0.02
+VOLATILITY = 0.30
+A1 = 0.31938153
+A2 = -0.356563782
+A3 = 1.781477937
+A4 = -1.821255978
+A5 = 1.330274429
+RSQRT2PI = 0.39894228040143267793994605993438
+
+_cuda = None
+
+
+def cuda_module():
+    """
+    bench_cuda with its kernels compiled, or Skip without a CUDA device.
+    """
+    global _cuda
+    if _cuda is None:
+        try:
+            from numba import cuda
+            available = cuda.is_available()
+        except Exception as e:
+            raise Skip('numba.cuda is not usable: {}'.format(e))
+        if not available:
+            raise Skip('no CUDA device')
+        from .. import bench_cuda
+        bench_cuda.setup()
+        _cuda = bench_cuda
+    return _cuda
+
+
+def _threads(n, f):
+    # run f on n numba threads, the setting is per calling thread
+    def run():
+        previous = numba.get_num_threads()
+        numba.set_num_threads(n)
+        try:
+            return f()
+        finally:
+            numba.set_num_threads(previous)
+    return run
+
+
+def _serial(setup):
+    return lambda size: _threads(1, setup(size))
+
+
+def _check(positions, weights, acc, rtol=1e-3):
+    err = direct.force_error(positions, weights, acc, n_samples=100)
+    if not err.max < rtol:
+        raise AssertionError('accelerations are off by up to {:.2e}'
+                             .format(err.max))
+
+
+# -- direct-sum N-body ------------------------------------------------------
+
+def bodies(n):
+    """
+    The (n, 2) float32 positions and weights of bench_cuda.make_nbody_samples.
+    """
+    positions = np.random.RandomState(0).uniform(-1.0, 1.0, (n, 2))
+    weights = np.random.RandomState(0).uniform(1.0, 2.0, n)
+    return positions.astype(np.float32), weights.astype(np.float32)
+
+
+def _nbody_numpy(n):
+    p, w = bodies(n)
+    return lambda: direct.run_numpy_nbody(p, w)
+
+
+def _nbody_numba(n):
+    p, w = bodies(n)
+    out = np.empty_like(p)
+    return lambda: direct.accelerations(p, w, out=out)
+
+
+def _nbody_cuda(n):
+    bench = cuda_module()
+    p, w = bodies(n)
+    runner = bench.NBodyCUDARunner(p, w)
+    runner.run()
+    _check(p, w, runner.results())
+    return runner.run
+
+
+def _nbody_gl(n):
+    from .. import glcompute
+    p, w = bodies(n)
+    try:
+        runner = glcompute.Runner(p, w)
+    except glcompute.ContextError as e:
+        raise Skip(str(e))
+    runner.run()
+    _check(p, w, runner.results())
+    return runner.run
+
+
+# -- particle-mesh ----------------------------------------------------------
+
+def _pm(grid):
+    p, w = pm._plummer(pm_bodies, 2)
+    return lambda: pm.accelerations(p, w, grid)
+
+
+# -- Black-Scholes ----------------------------------------------------------
+
+def options(n):
+    """
+    Call / put outputs and the stock price, strike and years inputs of n
+    options, drawn like bench_cuda's.
+    """
+    return (np.zeros(n), np.zeros(n),
+            np.random.RandomState(0).uniform(5.0, 30.0, n),
+            np.random.RandomState(1).uniform(1.0, 100.0, n),
+            np.random.RandomState(2).uniform(0.25, 10.0, n))
+
+
+def _cnd_numpy(d):
+    k = 1.0 / (1.0 + 0.2316419 * np.abs(d))
+    ret = (RSQRT2PI * np.exp(-0.5 * d * d) *
+           (k * (A1 + k * (A2 + k * (A3 + k * (A4 + k * A5))))))
+    return np.where(d > 0, 1.0 - ret, ret)
+
+
+def black_scholes_numpy(call, put, s, x, t, r, v):
+    sqrt_t = np.sqrt(t)
+    d1 = (np.log(s / x) + (r + 0.5 * v * v) * t) / (v * sqrt_t)
+    d2 = d1 - v * sqrt_t
+    cndd1 = _cnd_numpy(d1)
+    cndd2 = _cnd_numpy(d2)
+    exp_rt = np.exp(-r * t)
+    call[:] = s * cndd1 - x * exp_rt * cndd2
+    put[:] = x * exp_rt * (1.0 - cndd2) - s * (1.0 - cndd1)
+
+
+@njit(cache=True, inline='always')
+def _cnd(d):
+    k = 1.0 / (1.0 + 0.2316419 * math.fabs(d))
+    ret = (RSQRT2PI * math.exp(-0.5 * d * d) *
+           (k * (A1 + k * (A2 + k * (A3 + k * (A4 + k * A5))))))
+    if d > 0:
+        ret = 1.0 - ret
+    return ret
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def black_scholes(call, put, s, x, t, r, v):
+    for i in prange(s.shape[0]):
+        sqrt_t = math.sqrt(t[i])
+        d1 = (math.log(s[i] / x[i]) + (r + 0.5 * v * v) * t[i]) / (v * sqrt_t)
+        d2 = d1 - v * sqrt_t
+        cndd1 = _cnd(d1)
+        cndd2 = _cnd(d2)
+        exp_rt = math.exp(-r * t[i])
+        call[i] = s[i] * cndd1 - x[i] * exp_rt * cndd2
+        put[i] = x[i] * exp_rt * (1.0 - cndd2) - s[i] * (1.0 - cndd1)
+
+
+def _black_scholes_numpy(n):
+    args = options(n) + (RISKFREE, VOLATILITY)
+    return lambda: black_scholes_numpy(*args)
+
+
+def _black_scholes_numba(n):
+    args = options(n) + (RISKFREE, VOLATILITY)
+    return lambda: black_scholes(*args)
+
+
+def _black_scholes_cuda(n):
+    bench = cuda_module()
+    stream = bench.cuda.stream()
+    arrays = [bench.cuda.to_device(a, stream) for a in options(n)]
+    griddim = int(math.ceil(n / 512))
+
+    def run():
+        bench.black_scholes_cuda[griddim, 512, stream](
+            *(arrays + [RISKFREE, VOLATILITY]))
+        stream.synchronize()
+    return run
+
+
+# -- synthetic (bench_cuda.Synthetic) ---------------------------------------
+
+@njit(cache=True, parallel=True, fastmath=True)
+def addmul(x, y, out):
+    for i in prange(x.shape[0]):
+        out[i] = x[i] + y[i] * math.fabs(x[i])
+
+
+@njit(cache=True, parallel=True)
+def sum_reduce(x):
+    total = x.dtype.type(0)
+    for i in prange(x.shape[0]):
+        total += x[i]
+    return total
+
+
+def _vector(n, dtype):
+    return np.random.RandomState(0).uniform(-1.0, 1.0, n).astype(dtype)
+
+
+def _addmul_setups(dtype):
+    def numpy_setup(n):
+        x = _vector(n, dtype)
+        out = np.empty_like(x)
+        return lambda: np.add(x, x * np.abs(x), out=out)
+
+    def numba_setup(n):
+        x = _vector(n, dtype)
+        out = np.empty_like(x)
+        return lambda: addmul(x, x, out)
+
+    def cuda_setup(n):
+        bench = cuda_module()
+        kernel = bench.addmul_f32 if dtype == np.float32 else bench.addmul_f64
+        stream = bench.cuda.stream()
+        d_x = bench.cuda.to_device(_vector(n, dtype), stream)
+        griddim = int(math.ceil(n / 512))
+
+        def run():
+            kernel[griddim, 512, stream](d_x, d_x, d_x)
+            stream.synchronize()
+        return run
+    return numpy_setup, numba_setup, cuda_setup
+
+
+def _reduce_setups(dtype):
+    def numpy_setup(n):
+        x = _vector(n, dtype)
+        return x.sum
+
+    def numba_setup(n):
+        x = _vector(n, dtype)
+        return lambda: sum_reduce(x)
+
+    def cuda_setup(n):
+        bench = cuda_module()
+        cuda = bench.cuda
+        stream = cuda.stream()
+        d_x = cuda.to_device(_vector(n, dtype), stream)
+        res = cuda.to_device(np.zeros(1, dtype))
+        reduce_ = cuda.reduce(lambda a, b: a + b)
+
+        def run():
+            reduce_(d_x, res=res, stream=stream)
+            stream.synchronize()
+        return run
+    return numpy_setup, numba_setup, cuda_setup
+
+
+# -- exp (the threading demo of the old benchmark.py) ----------------------
+
+@njit(cache=True, nogil=True, fastmath=True)
+def exp_kernel(result, a, b):
+    for i in range(len(result)):
+        result[i] = math.exp(2.1 * a[i] + 3.2 * b[i])
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def exp_parallel(result, a, b):
+    for i in prange(len(result)):
+        result[i] = math.exp(2.1 * a[i] + 3.2 * b[i])
+
+
+def _exp_inputs(n):
+    rs = np.random.RandomState(0)
+    return np.empty(n), rs.rand(n), rs.rand(n)
+
+
+def _exp_numpy(n):
+    result, a, b = _exp_inputs(n)
+    return lambda: np.exp(2.1 * a + 3.2 * b, out=result)
+
+
+def _exp_numba(n):
+    args = _exp_inputs(n)
+    return lambda: exp_parallel(*args)
+
+
+def _exp_threads(n):
+    # one Python thread per equal chunk, exp_kernel releases the GIL
+    args = _exp_inputs(n)
+    n_threads = os.cpu_count() or 1
+    chunk = -(-n // n_threads)
+    chunks = [[arg[i * chunk:(i + 1) * chunk] for arg in args]
+              for i in range(n_threads)]
+
+    def run():
+        threads = [threading.Thread(target=exp_kernel, args=c)
+                   for c in chunks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return run
+
+
+def _exp_pool(n):
+    # the same nogil kernel on the persistent KernelPool
+    pool = executor.default_pool()
+    result, a, b = _exp_inputs(n)
+    return lambda: pool.map(exp_kernel, result, a, b)
+
+
+# -- host <-> device transfers (bench_cuda.DataTransfer) -------------------
+
+def _to_device(n):
+    bench = cuda_module()
+    stream = bench.cuda.stream()
+    data = np.zeros(n)
+
+    def run():
+        bench.cuda.to_device(data, stream)
+        stream.synchronize()
+    return run
+
+
+def _from_device(n):
+    bench = cuda_module()
+    stream = bench.cuda.stream()
+    data = np.zeros(n)
+    d_data = bench.cuda.to_device(data, stream)
+
+    def run():
+        d_data.copy_to_host(data, stream)
+        stream.synchronize()
+    return run
+
+
+# -- import time -----------------------------------------------------------
+
+def _import_setup(module, path, allowed):
+    def setup(size):
+        try:
+            imports.check(imports.measure(module, path), allowed)
+        except ImportError as e:
+            raise Skip(str(e))
+        return lambda: imports.measure(module, path)
+    return setup
+
+
+def _cpu_variants(numpy_setup, numba_setup):
+    return [('numpy', numpy_setup),
+            ('numba-serial', _serial(numba_setup)),
+            ('numba-parallel', numba_setup)]
+
+
+_bodies_sweep = tuple(1 << k for k in range(10, 21, 2))
+_vector_sweep = (1 << 16, 1 << 20, 1 << 24)
+
+
+def _make_workloads():
+    workloads = [
+        Workload('nbody', 'interactions', lambda n: n * n, 2,
+                 _bodies_sweep[:2], _bodies_sweep,
+                 _cpu_variants(_nbody_numpy, _nbody_numba)
+                 + [('cuda', _nbody_cuda), ('gl', _nbody_gl)]),
+        # PM has no NumPy reference, the FFTs are numpy.fft in every variant
+        Workload('pm', 'cells', lambda g: g * g, 2,
+                 (128, 256), (128, 256, 512, 1024, 2048),
+                 [('numba-serial', _serial(_pm)), ('numba-parallel', _pm)]),
+        Workload('blackscholes', 'options', lambda n: n, 1,
+                 (1 << 14,), (1 << 14, 1 << 18, 1 << 22),
+                 _cpu_variants(_black_scholes_numpy, _black_scholes_numba)
+                 + [('cuda', _black_scholes_cuda)]),
+    ]
+    for dtype, suffix in ((np.float32, 'f32'), (np.float64, 'f64')):
+        for name, setups in (('addmul', _addmul_setups(dtype)),
+                             ('reduce', _reduce_setups(dtype))):
+            numpy_setup, numba_setup, cuda_setup = setups
+            workloads.append(Workload(
+                '{}-{}'.format(name, suffix), 'elements', lambda n: n, 1,
+                (1 << 20,), _vector_sweep,
+                _cpu_variants(numpy_setup, numba_setup)
+                + [('cuda', cuda_setup)]))
+    workloads += [
+        Workload('exp', 'elements', lambda n: n, 1,
+                 (10 ** 6,), (10 ** 5, 10 ** 6, 10 ** 7),
+                 _cpu_variants(_exp_numpy, _exp_numba)
+                 + [('numba-threads', _exp_threads),
+                    ('numba-pool', _exp_pool)]),
+        Workload('transfer', 'bytes', lambda n: 8 * n, 1,
+                 (512, 512 * 1024), (512, 512 * 1024, 16 * 1024 * 1024),
+                 [('cuda-to-device', _to_device),
+                  ('cuda-from-device', _from_device)]),
+        # a fresh interpreter importing one module per call, see imports.py
+        Workload('import', 'imports', lambda n: n, 1, (1,), (1,),
+                 [(variant, _import_setup(module, path, allowed))
+                  for variant, module, path, allowed in imports.modules]),
+    ]
+    return workloads
+
+
+workloads = _make_workloads()
+by_name = dict((w.name, w) for w in workloads)
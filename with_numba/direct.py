@@ -0,0 +1,503 @@
+"""
+Direct-sum (all-pairs) gravity on the CPU.
+
+Same contract as run_cpu_nbody: accelerations(positions, weights) returns
+an array shaped like positions where body i gets
+
+    sum_j w_j * (p_j - p_i) / (|p_j - p_i|^2 + eps_2) ** 1.5
+
+Works for the (n, 2) layout of make_nbody_samples and for the (n, 3)
+'position' / 'mass' fields of NBodySimulation.particles_ssbo.data (strided
+views are fine, they are packed once before the kernel runs). A
+particles.ParticleSet can be passed instead of positions and weights; its
+SoA rows go to the kernel as they are and the result lands in its
+acceleration rows.
+"""
+
+from __future__ import division
+
+import math
+from collections import namedtuple
+
+import numba
+import numpy as np
+from numba import njit, prange
+
+from .particles import ParticleSet
+
+eps_2 = np.float32(1e-6)
+
+# bodies per i-block and j-tile. A j-tile of x, y, z, w float32 is 8 KB at
+# 512, which stays in L1 while the whole i-block sweeps over it.
+# The kernels use error_model='numpy': with the default Python error model
+# every division carries a ZeroDivisionError check that stops LLVM from
+# vectorizing the j loop. For the same reason the j loops run over tile
+# views from 0, so the index is known to be non-negative and needs no
+# wraparound handling.
+block_size = 64
+tile_size = 512
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model='numpy')
+def _accelerations_2d(x, y, w, eps_2, block_size, tile_size, out):
+    n = x.shape[0]
+    n_blocks = (n + block_size - 1) // block_size
+    for b in prange(n_blocks):
+        i0 = b * block_size
+        i1 = min(i0 + block_size, n)
+        for i in range(i0, i1):
+            out[i, 0] = 0.0
+            out[i, 1] = 0.0
+        for j0 in range(0, n, tile_size):
+            j1 = min(j0 + tile_size, n)
+            xt = x[j0:j1]
+            yt = y[j0:j1]
+            wt = w[j0:j1]
+            for i in range(i0, i1):
+                xi = x[i]
+                yi = y[i]
+                axi = x.dtype.type(0.0)
+                ayi = x.dtype.type(0.0)
+                for j in range(xt.shape[0]):
+                    rx = xt[j] - xi
+                    ry = yt[j] - yi
+                    sqr_dist = rx * rx + ry * ry + eps_2
+                    s = wt[j] / (sqr_dist * math.sqrt(sqr_dist))
+                    axi += rx * s
+                    ayi += ry * s
+                out[i, 0] += axi
+                out[i, 1] += ayi
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model='numpy')
+def _accelerations_3d(x, y, z, w, eps_2, block_size, tile_size, out):
+    n = x.shape[0]
+    n_blocks = (n + block_size - 1) // block_size
+    for b in prange(n_blocks):
+        i0 = b * block_size
+        i1 = min(i0 + block_size, n)
+        for i in range(i0, i1):
+            out[i, 0] = 0.0
+            out[i, 1] = 0.0
+            out[i, 2] = 0.0
+        for j0 in range(0, n, tile_size):
+            j1 = min(j0 + tile_size, n)
+            xt = x[j0:j1]
+            yt = y[j0:j1]
+            zt = z[j0:j1]
+            wt = w[j0:j1]
+            for i in range(i0, i1):
+                xi = x[i]
+                yi = y[i]
+                zi = z[i]
+                axi = x.dtype.type(0.0)
+                ayi = x.dtype.type(0.0)
+                azi = x.dtype.type(0.0)
+                for j in range(xt.shape[0]):
+                    rx = xt[j] - xi
+                    ry = yt[j] - yi
+                    rz = zt[j] - zi
+                    sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+                    s = wt[j] / (sqr_dist * math.sqrt(sqr_dist))
+                    axi += rx * s
+                    ayi += ry * s
+                    azi += rz * s
+                out[i, 0] += axi
+                out[i, 1] += ayi
+                out[i, 2] += azi
+
+
+def split_components(positions, weights, dtype=None):
+    """
+    Pack (n, dim) positions and (n,) weights into contiguous per-axis arrays.
+    """
+    positions = np.asarray(positions)
+    if dtype is None:
+        dtype = positions.dtype
+    comps = [np.ascontiguousarray(positions[:, k], dtype=dtype)
+             for k in range(positions.shape[1])]
+    comps.append(np.ascontiguousarray(weights, dtype=dtype))
+    return comps
+
+
+def accelerations(positions, weights=None, eps_2=eps_2, out=None,
+                  block_size=block_size, tile_size=tile_size, precision=None,
+                  groups=None):
+    """
+    Compute gravitational accelerations of all bodies by direct summation.
+    precision picks one of the accumulation modes of precision.modes; None
+    sums in the dtype of positions. groups gives every body's galaxy for
+    precision='relative'. positions may be a ParticleSet, then
+    weights are its masses and out defaults to its accelerations.
+    """
+    if isinstance(positions, ParticleSet):
+        if out is None:
+            out = positions.accelerations
+        positions, weights = positions.positions, positions.mass
+    if precision is not None:
+        from . import precision as _precision
+        return _precision.accelerations(positions, weights, precision, eps_2,
+                                        out, groups)
+    positions = np.asarray(positions)
+    n, dim = positions.shape
+    if out is None:
+        out = np.empty((n, dim), dtype=positions.dtype)
+    comps = split_components(positions, weights)
+    eps_2 = positions.dtype.type(eps_2)
+    if dim == 2:
+        _accelerations_2d(comps[0], comps[1], comps[2], eps_2,
+                          block_size, tile_size, out)
+    elif dim == 3:
+        _accelerations_3d(comps[0], comps[1], comps[2], comps[3], eps_2,
+                          block_size, tile_size, out)
+    else:
+        raise ValueError('positions must be (n, 2) or (n, 3), got {}'
+                         .format(positions.shape))
+    return out
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model='numpy')
+def _symmetric_2d(x, y, w, eps_2, block_size, pair_i, pair_j, ax, ay):
+    n = x.shape[0]
+    n_workers = ax.shape[0]
+    for t in prange(n_workers):
+        # private copy of the j-tile and of the reaction forces on it
+        tx = np.empty(block_size, x.dtype)
+        ty = np.empty(block_size, x.dtype)
+        tw = np.empty(block_size, x.dtype)
+        gx = np.empty(block_size, x.dtype)
+        gy = np.empty(block_size, x.dtype)
+        for i in range(n):
+            ax[t, i] = 0.0
+            ay[t, i] = 0.0
+        for k in range(t, pair_i.shape[0], n_workers):
+            i0 = pair_i[k] * block_size
+            i1 = min(i0 + block_size, n)
+            j0 = pair_j[k] * block_size
+            m = min(j0 + block_size, n) - j0
+            for jj in range(m):
+                tx[jj] = x[j0 + jj]
+                ty[jj] = y[j0 + jj]
+                tw[jj] = w[j0 + jj]
+                gx[jj] = 0.0
+                gy[jj] = 0.0
+            for i in range(i0, i1):
+                xi = x[i]
+                yi = y[i]
+                wi = w[i]
+                # on a diagonal block only pairs with j > i count; the
+                # masking is kept out of the off-diagonal loop so that one
+                # vectorizes cleanly
+                diag = i - j0 if i0 == j0 else -1
+                axi = x.dtype.type(0.0)
+                ayi = x.dtype.type(0.0)
+                if diag < 0:
+                    for jj in range(m):
+                        rx = tx[jj] - xi
+                        ry = ty[jj] - yi
+                        sqr_dist = rx * rx + ry * ry + eps_2
+                        s = x.dtype.type(1.0) / (sqr_dist * math.sqrt(sqr_dist))
+                        fx = rx * s
+                        fy = ry * s
+                        axi += tw[jj] * fx
+                        ayi += tw[jj] * fy
+                        gx[jj] -= wi * fx
+                        gy[jj] -= wi * fy
+                else:
+                    for jj in range(m):
+                        rx = tx[jj] - xi
+                        ry = ty[jj] - yi
+                        sqr_dist = rx * rx + ry * ry + eps_2
+                        s = x.dtype.type(1.0) / (sqr_dist * math.sqrt(sqr_dist))
+                        if jj <= diag:
+                            s = x.dtype.type(0.0)
+                        fx = rx * s
+                        fy = ry * s
+                        axi += tw[jj] * fx
+                        ayi += tw[jj] * fy
+                        gx[jj] -= wi * fx
+                        gy[jj] -= wi * fy
+                ax[t, i] += axi
+                ay[t, i] += ayi
+            for jj in range(m):
+                ax[t, j0 + jj] += gx[jj]
+                ay[t, j0 + jj] += gy[jj]
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model='numpy')
+def _symmetric_3d(x, y, z, w, eps_2, block_size, pair_i, pair_j, ax, ay, az):
+    n = x.shape[0]
+    n_workers = ax.shape[0]
+    for t in prange(n_workers):
+        tx = np.empty(block_size, x.dtype)
+        ty = np.empty(block_size, x.dtype)
+        tz = np.empty(block_size, x.dtype)
+        tw = np.empty(block_size, x.dtype)
+        gx = np.empty(block_size, x.dtype)
+        gy = np.empty(block_size, x.dtype)
+        gz = np.empty(block_size, x.dtype)
+        for i in range(n):
+            ax[t, i] = 0.0
+            ay[t, i] = 0.0
+            az[t, i] = 0.0
+        for k in range(t, pair_i.shape[0], n_workers):
+            i0 = pair_i[k] * block_size
+            i1 = min(i0 + block_size, n)
+            j0 = pair_j[k] * block_size
+            m = min(j0 + block_size, n) - j0
+            for jj in range(m):
+                tx[jj] = x[j0 + jj]
+                ty[jj] = y[j0 + jj]
+                tz[jj] = z[j0 + jj]
+                tw[jj] = w[j0 + jj]
+                gx[jj] = 0.0
+                gy[jj] = 0.0
+                gz[jj] = 0.0
+            for i in range(i0, i1):
+                xi = x[i]
+                yi = y[i]
+                zi = z[i]
+                wi = w[i]
+                diag = i - j0 if i0 == j0 else -1
+                axi = x.dtype.type(0.0)
+                ayi = x.dtype.type(0.0)
+                azi = x.dtype.type(0.0)
+                if diag < 0:
+                    for jj in range(m):
+                        rx = tx[jj] - xi
+                        ry = ty[jj] - yi
+                        rz = tz[jj] - zi
+                        sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+                        s = x.dtype.type(1.0) / (sqr_dist * math.sqrt(sqr_dist))
+                        fx = rx * s
+                        fy = ry * s
+                        fz = rz * s
+                        axi += tw[jj] * fx
+                        ayi += tw[jj] * fy
+                        azi += tw[jj] * fz
+                        gx[jj] -= wi * fx
+                        gy[jj] -= wi * fy
+                        gz[jj] -= wi * fz
+                else:
+                    for jj in range(m):
+                        rx = tx[jj] - xi
+                        ry = ty[jj] - yi
+                        rz = tz[jj] - zi
+                        sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+                        s = x.dtype.type(1.0) / (sqr_dist * math.sqrt(sqr_dist))
+                        if jj <= diag:
+                            s = x.dtype.type(0.0)
+                        fx = rx * s
+                        fy = ry * s
+                        fz = rz * s
+                        axi += tw[jj] * fx
+                        ayi += tw[jj] * fy
+                        azi += tw[jj] * fz
+                        gx[jj] -= wi * fx
+                        gy[jj] -= wi * fy
+                        gz[jj] -= wi * fz
+                ax[t, i] += axi
+                ay[t, i] += ayi
+                az[t, i] += azi
+            for jj in range(m):
+                ax[t, j0 + jj] += gx[jj]
+                ay[t, j0 + jj] += gy[jj]
+                az[t, j0 + jj] += gz[jj]
+
+
+@njit(cache=True, parallel=True)
+def _reduce_workers(buf, out, k):
+    for i in prange(buf.shape[1]):
+        a = buf[0, i]
+        for t in range(1, buf.shape[0]):
+            a += buf[t, i]
+        out[i, k] = a
+
+
+def symmetric_accelerations(positions, weights, eps_2=eps_2, out=None,
+                            block_size=tile_size, n_workers=None):
+    """
+    Same result as accelerations(), but every pair is evaluated once and
+    applied to both bodies (Newton's third law), which halves the force
+    evaluations. Block pairs (bi <= bj) are dealt round-robin to n_workers
+    private accumulation buffers that are summed at the end.
+    """
+    positions = np.asarray(positions)
+    n, dim = positions.shape
+    if dim not in (2, 3):
+        raise ValueError('positions must be (n, 2) or (n, 3), got {}'
+                         .format(positions.shape))
+    if out is None:
+        out = np.empty((n, dim), dtype=positions.dtype)
+    if n_workers is None:
+        n_workers = numba.get_num_threads()
+    comps = split_components(positions, weights)
+    eps_2 = positions.dtype.type(eps_2)
+    n_blocks = (n + block_size - 1) // block_size
+    pair_i, pair_j = np.triu_indices(n_blocks)
+    bufs = np.empty((dim, n_workers, n), dtype=positions.dtype)
+    if dim == 2:
+        _symmetric_2d(comps[0], comps[1], comps[2], eps_2, block_size,
+                      pair_i, pair_j, bufs[0], bufs[1])
+    else:
+        _symmetric_3d(comps[0], comps[1], comps[2], comps[3], eps_2,
+                      block_size, pair_i, pair_j, bufs[0], bufs[1], bufs[2])
+    for k in range(dim):
+        _reduce_workers(bufs[k], out, k)
+    return out
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model='numpy')
+def _accelerations_at(tx, ty, tz, x, y, z, w, eps_2, out):
+    for i in prange(tx.shape[0]):
+        axi = 0.0
+        ayi = 0.0
+        azi = 0.0
+        for j in range(x.shape[0]):
+            rx = x[j] - tx[i]
+            ry = y[j] - ty[i]
+            rz = z[j] - tz[i]
+            sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+            s = w[j] / (sqr_dist * math.sqrt(sqr_dist))
+            axi += rx * s
+            ayi += ry * s
+            azi += rz * s
+        out[i, 0] = axi
+        out[i, 1] = ayi
+        out[i, 2] = azi
+
+
+def accelerations_at(targets, positions, weights, eps_2=eps_2):
+    """
+    Exact float64 accelerations at a subset of target points, used as the
+    reference when checking approximate engines at large N.
+    """
+    targets = np.asarray(targets)
+    dim = targets.shape[1]
+    t = split_components(targets, np.zeros(len(targets)), np.float64)[:dim]
+    p = split_components(positions, weights, np.float64)
+    if dim == 2:
+        t.append(np.zeros(len(targets)))
+        p.insert(2, np.zeros(len(weights)))
+    out = np.empty((len(targets), 3))
+    _accelerations_at(t[0], t[1], t[2], p[0], p[1], p[2], p[3],
+                      float(eps_2), out)
+    return out[:, :dim]
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model='numpy')
+def _accelerations_jerks(idx, x, y, z, vx, vy, vz, w, eps_2, acc, jerk):
+    for a in prange(idx.shape[0]):
+        i = idx[a]
+        axi = 0.0
+        ayi = 0.0
+        azi = 0.0
+        jxi = 0.0
+        jyi = 0.0
+        jzi = 0.0
+        for j in range(x.shape[0]):
+            rx = x[j] - x[i]
+            ry = y[j] - y[i]
+            rz = z[j] - z[i]
+            ux = vx[j] - vx[i]
+            uy = vy[j] - vy[i]
+            uz = vz[j] - vz[i]
+            sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+            s = w[j] / (sqr_dist * math.sqrt(sqr_dist))
+            rv = 3.0 * (rx * ux + ry * uy + rz * uz) / sqr_dist
+            axi += rx * s
+            ayi += ry * s
+            azi += rz * s
+            jxi += (ux - rv * rx) * s
+            jyi += (uy - rv * ry) * s
+            jzi += (uz - rv * rz) * s
+        acc[a, 0] = axi
+        acc[a, 1] = ayi
+        acc[a, 2] = azi
+        jerk[a, 0] = jxi
+        jerk[a, 1] = jyi
+        jerk[a, 2] = jzi
+
+
+def accelerations_jerks(positions, velocities, weights, eps_2=eps_2,
+                        active=None):
+    """
+    Float64 accelerations and their time derivatives (jerks) by direct
+    summation, for the Hermite integrator. If active is given, only those
+    bodies are evaluated (against all bodies) and the results are
+    (len(active), dim).
+    """
+    positions = np.asarray(positions)
+    n, dim = positions.shape
+    p = split_components(positions, weights, np.float64)
+    v = split_components(velocities, weights, np.float64)[:dim]
+    if dim == 2:
+        p.insert(2, np.zeros(n))
+        v.append(np.zeros(n))
+    if active is None:
+        active = np.arange(n)
+    acc = np.empty((len(active), 3))
+    jerk = np.empty((len(active), 3))
+    _accelerations_jerks(np.asarray(active, np.int64), p[0], p[1], p[2],
+                         v[0], v[1], v[2], p[3], float(eps_2), acc, jerk)
+    return acc[:, :dim], jerk[:, :dim]
+
+
+ForceError = namedtuple('ForceError', ['rms', 'p99', 'max'])
+
+
+def force_error(positions, weights, acc, eps_2=eps_2, n_samples=1000, seed=0,
+                reference=accelerations_at):
+    """
+    Relative error of acc against the exact direct sum, evaluated on at most
+    n_samples randomly chosen bodies so it stays affordable at large N.
+    reference(targets, positions, weights, eps_2) gives the exact values.
+    """
+    positions = np.asarray(positions)
+    n = len(positions)
+    if n_samples is None or n_samples >= n:
+        idx = np.arange(n)
+    else:
+        idx = np.random.RandomState(seed).choice(n, n_samples, replace=False)
+    ref = reference(positions[idx], positions, weights, eps_2)
+    err = (np.linalg.norm(acc[idx] - ref, axis=1)
+           / np.maximum(np.linalg.norm(ref, axis=1), np.finfo(np.float64).tiny))
+    return ForceError(np.sqrt(np.mean(err ** 2)), np.percentile(err, 99),
+                      err.max())
+
+
+def run_numpy_nbody(positions, weights):
+    """
+    Reference implementation, one vectorized pass per body j.
+    """
+    accelerations = np.zeros_like(positions)
+    n = weights.size
+    for j in range(n):
+        # Compute influence of j'th body on all bodies
+        r = positions[j] - positions
+        sqr_dist = np.sum(r * r, axis=1) + eps_2
+        sixth_dist = sqr_dist * sqr_dist * sqr_dist
+        inv_dist_cube = np.float32(1.0) / np.sqrt(sixth_dist)
+        s = weights[j] * inv_dist_cube
+        accelerations += (r.transpose() * s).transpose()
+    return accelerations
+
+
+if __name__ == "__main__":
+    from timeit import repeat
+
+    for n_bodies in (256, 1024, 4096, 16384):
+        rs = np.random.RandomState(0)
+        p = rs.uniform(-1.0, 1.0, (n_bodies, 2)).astype(np.float32)
+        w = rs.uniform(1.0, 2.0, n_bodies).astype(np.float32)
+        ref = accelerations_at(p, p, w)
+        line = 'n={:>6d}'.format(n_bodies)
+        for name, f in (('numpy', run_numpy_nbody),
+                        ('numba', accelerations),
+                        ('symmetric', symmetric_accelerations)):
+            if f is run_numpy_nbody and n_bodies > 4096:
+                continue
+            err = np.max(np.abs(f(p, w) - ref)) / np.max(np.abs(ref))
+            t = min(repeat(lambda: f(p, w), number=1, repeat=3))
+            line += '  {} {:>8.2f} ms (err {:.1e})'.format(name, t * 1000, err)
+        print(line)
@@ -0,0 +1,237 @@
+"""
+Ensemble mode: many independent small N-body systems in one call.
+
+Positions are (batch, n, dim) and masses (batch, n); dim is 2 or 3. The
+whole batch is handled by one parallel numba call with one system per
+thread, so a few hundred bodies per system is enough to keep every core
+busy and the per-call overhead is paid once for the batch instead of once
+per system. Systems with fewer bodies can be padded with zero-mass bodies,
+which feel the others but pull on nothing.
+
+Forces are the softened direct sum of direct.accelerations (G = 1).
+ensemble_leapfrog integrates with kick-drift-kick and reports per-system
+energy and momentum diagnostics.
+"""
+
+from __future__ import division
+
+import math
+from collections import namedtuple
+
+import numpy as np
+from numba import njit, prange
+
+from . import direct
+
+eps_2 = direct.eps_2
+
+EnsembleDiagnostics = namedtuple('EnsembleDiagnostics', [
+    'energy_start', 'energy_end', 'energy_error',  # relative |dE / E|
+    'momentum_drift',  # |P_end - P_start| / (M sqrt(2 |U| / M)) at the start
+    'virial_ratio'])   # 2 K / |U| at the end
+
+
+@njit(cache=True, fastmath=True, error_model='numpy')
+def _system_accelerations(x, y, z, w, eps_2, ax, ay, az):
+    n = x.shape[0]
+    for i in range(n):
+        xi = x[i]
+        yi = y[i]
+        zi = z[i]
+        axi = x.dtype.type(0.0)
+        ayi = x.dtype.type(0.0)
+        azi = x.dtype.type(0.0)
+        for j in range(n):
+            rx = x[j] - xi
+            ry = y[j] - yi
+            rz = z[j] - zi
+            sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+            s = w[j] / (sqr_dist * math.sqrt(sqr_dist))
+            axi += rx * s
+            ayi += ry * s
+            azi += rz * s
+        ax[i] = axi
+        ay[i] = ayi
+        az[i] = azi
+
+
+@njit(cache=True, fastmath=True, error_model='numpy')
+def _system_energies(x, y, z, vx, vy, vz, w, eps_2):
+    n = x.shape[0]
+    kinetic = 0.0
+    potential = 0.0
+    for i in range(n):
+        kinetic += 0.5 * w[i] * (vx[i] * vx[i] + vy[i] * vy[i] + vz[i] * vz[i])
+        u = 0.0
+        for j in range(i + 1, n):
+            rx = x[j] - x[i]
+            ry = y[j] - y[i]
+            rz = z[j] - z[i]
+            u -= w[j] / math.sqrt(rx * rx + ry * ry + rz * rz + eps_2)
+        potential += w[i] * u
+    return kinetic, potential
+
+
+@njit(cache=True, parallel=True)
+def _ensemble_accelerations(pos, w, eps_2, acc):
+    for b in prange(pos.shape[0]):
+        _system_accelerations(pos[b, 0], pos[b, 1], pos[b, 2], w[b], eps_2,
+                              acc[b, 0], acc[b, 1], acc[b, 2])
+
+
+@njit(cache=True, parallel=True)
+def _ensemble_leapfrog(pos, vel, w, dt, n_steps, eps_2, diag):
+    n = pos.shape[2]
+    h = 0.5 * dt
+    for b in prange(pos.shape[0]):
+        x = pos[b, 0]
+        y = pos[b, 1]
+        z = pos[b, 2]
+        vx = vel[b, 0]
+        vy = vel[b, 1]
+        vz = vel[b, 2]
+        ax = np.empty(n, pos.dtype)
+        ay = np.empty(n, pos.dtype)
+        az = np.empty(n, pos.dtype)
+
+        kinetic, potential = _system_energies(x, y, z, vx, vy, vz, w[b], eps_2)
+        diag[b, 0] = kinetic + potential
+        px0 = 0.0
+        py0 = 0.0
+        pz0 = 0.0
+        mass = 0.0
+        for i in range(n):
+            px0 += w[b, i] * vx[i]
+            py0 += w[b, i] * vy[i]
+            pz0 += w[b, i] * vz[i]
+            mass += w[b, i]
+        # total mass times the virial velocity, unlike sum_i m_i |v_i| it
+        # isn't zero for systems starting at rest
+        p_scale = math.sqrt(2.0 * mass * abs(potential))
+
+        _system_accelerations(x, y, z, w[b], eps_2, ax, ay, az)
+        for _ in range(n_steps):
+            for i in range(n):
+                vx[i] += ax[i] * h
+                vy[i] += ay[i] * h
+                vz[i] += az[i] * h
+                x[i] += vx[i] * dt
+                y[i] += vy[i] * dt
+                z[i] += vz[i] * dt
+            _system_accelerations(x, y, z, w[b], eps_2, ax, ay, az)
+            for i in range(n):
+                vx[i] += ax[i] * h
+                vy[i] += ay[i] * h
+                vz[i] += az[i] * h
+
+        kinetic, potential = _system_energies(x, y, z, vx, vy, vz, w[b], eps_2)
+        diag[b, 1] = kinetic + potential
+        px = -px0
+        py = -py0
+        pz = -pz0
+        for i in range(n):
+            px += w[b, i] * vx[i]
+            py += w[b, i] * vy[i]
+            pz += w[b, i] * vz[i]
+        diag[b, 2] = math.sqrt(px * px + py * py + pz * pz) / p_scale if p_scale > 0 else 0.0
+        diag[b, 3] = 2.0 * kinetic / abs(potential) if potential != 0 else 0.0
+
+
+def _to_soa(arr, dtype):
+    # (batch, n, dim) -> (batch, 3, n), zero-padded to three axes
+    batch, n, dim = arr.shape
+    out = np.zeros((batch, 3, n), dtype)
+    out[:, :dim] = np.swapaxes(arr, 1, 2)
+    return out
+
+
+def _check_shapes(positions, masses):
+    if positions.ndim != 3 or positions.shape[2] not in (2, 3):
+        raise ValueError('positions must be (batch, n, 2) or (batch, n, 3), '
+                         'got {}'.format(positions.shape))
+    if masses.shape != positions.shape[:2]:
+        raise ValueError('masses must be (batch, n) = {}, got {}'.format(
+            positions.shape[:2], masses.shape))
+
+
+def ensemble_accelerations(positions, masses, eps_2=eps_2):
+    """
+    Accelerations of every body of every system, shaped like positions.
+    """
+    positions = np.asarray(positions)
+    masses = np.asarray(masses)
+    _check_shapes(positions, masses)
+    dtype = positions.dtype
+    pos = _to_soa(positions, dtype)
+    acc = np.empty_like(pos)
+    _ensemble_accelerations(pos, np.ascontiguousarray(masses, dtype),
+                            dtype.type(eps_2), acc)
+    return np.ascontiguousarray(np.swapaxes(acc, 1, 2)[:, :, :positions.shape[2]])
+
+
+def ensemble_leapfrog(positions, velocities, masses, dt, n_steps, eps_2=eps_2):
+    """
+    Integrate every system n_steps kick-drift-kick steps of size dt.
+    positions and velocities are updated in place; returns
+    EnsembleDiagnostics with one entry per system.
+    """
+    masses = np.asarray(masses)
+    _check_shapes(positions, masses)
+    dim = positions.shape[2]
+    dtype = positions.dtype
+    pos = _to_soa(positions, dtype)
+    vel = _to_soa(velocities, dtype)
+    diag = np.empty((len(pos), 4))
+    _ensemble_leapfrog(pos, vel, np.ascontiguousarray(masses, dtype),
+                       dtype.type(dt), int(n_steps), dtype.type(eps_2), diag)
+    positions[:] = np.swapaxes(pos, 1, 2)[:, :, :dim]
+    velocities[:] = np.swapaxes(vel, 1, 2)[:, :, :dim]
+    energy_error = np.abs(diag[:, 1] / diag[:, 0] - 1)
+    return EnsembleDiagnostics(diag[:, 0], diag[:, 1], energy_error,
+                               diag[:, 2], diag[:, 3])
+
+
+def make_ensemble(batch, n_bodies, dim=3, seed=0):
+    """
+    Cold uniform spheres (or disks in 2D) of unit total mass, one seed per
+    system from a SeedSequence so systems are independent.
+    """
+    children = np.random.SeedSequence(seed).spawn(batch)
+    positions = np.empty((batch, n_bodies, dim), np.float32)
+    for b, child in enumerate(children):
+        rng = np.random.default_rng(child)
+        p = rng.normal(size=(n_bodies, dim))
+        p *= (rng.uniform(size=(n_bodies, 1)) ** (1 / dim)
+              / np.linalg.norm(p, axis=1, keepdims=True))
+        positions[b] = p
+    velocities = np.zeros_like(positions)
+    masses = np.full((batch, n_bodies), 1.0 / n_bodies, np.float32)
+    return positions, velocities, masses
+
+
+if __name__ == "__main__":
+    import time
+
+    batch, n_bodies, n_steps, dt = 512, 256, 10, 1e-3
+    p, v, m = make_ensemble(batch, n_bodies)
+    ensemble_leapfrog(p[:2].copy(), v[:2].copy(), m[:2], dt, 1)
+    ensemble_accelerations(p[:2], m[:2])
+    direct.accelerations(p[0], m[0])
+
+    t0 = time.perf_counter()
+    for b in range(batch):
+        direct.accelerations(p[b], m[b])
+    t1 = time.perf_counter()
+    ensemble_accelerations(p, m)
+    t2 = time.perf_counter()
+    print('forces, {} systems x {} bodies: per-system calls {:.1f} ms, '
+          'ensemble {:.1f} ms'.format(batch, n_bodies, (t1 - t0) * 1000,
+                                      (t2 - t1) * 1000))
+
+    t0 = time.perf_counter()
+    diag = ensemble_leapfrog(p, v, m, dt, n_steps)
+    t1 = time.perf_counter()
+    print('{} leapfrog steps: {:.1f} ms, median |dE/E| {:.1e}, '
+          'max momentum drift {:.1e}'.format(
+              n_steps, (t1 - t0) * 1000, np.median(diag.energy_error),
+              diag.momentum_drift.max()))
@@ -0,0 +1,382 @@
+"""
+Persistent thread pool for nogil numba kernels.
+
+A kernel has the (result, *inputs) signature of a plain serial loop,
+
+    @njit(nogil=True)
+    def kernel(result, a, b):
+        for i in range(len(result)):
+            result[i] = math.exp(2.1 * a[i] + 3.2 * b[i])
+
+and KernelPool runs it over chunks of axis 0 on threads that live as long
+as the pool, instead of starting fresh threads (or a parallel=True region)
+on every call:
+
+    map       every chunk writes its slice of result
+    reduce    every chunk accumulates into its own row of partials, which
+              are combined with a ufunc (np.add, np.maximum, ...) at the end
+
+Chunks are dealt out in contiguous runs to one deque per thread. A thread
+takes from the front of its own deque and, once that is empty, steals
+from the back of the others', so uneven chunks (clustered particles,
+cache misses, a thread descheduled by the OS) don't leave the others idle.
+The calling thread works as one of the threads, so a call never waits on
+a wake-up to make progress.
+
+Chunk sizes come from the measured cost per element of each kernel: the
+first call times a probe chunk on the calling thread, every call refines
+the estimate from the busy time of its chunks. Chunks are sized to take
+about target_chunk_time, and calls expected to finish within inline_time
+run entirely on the calling thread.
+"""
+
+from __future__ import division
+
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# seconds of work per chunk, long enough to amortize the scheduling of
+# the chunk and short enough to balance with stealing
+target_chunk_time = 2e-4
+
+# calls expected to take less than this many seconds don't wake the pool
+inline_time = 5e-5
+
+# fewest elements per chunk, also the size of the first call's probe chunk
+min_chunk = 256
+
+# weight of the newest measurement in the per-element cost estimate
+cost_smoothing = 0.5
+
+
+class _Task(object):
+    """
+    One call spread over the pool: chunk index deques, one per thread.
+    """
+
+    def __init__(self, call, chunks, n_threads):
+        self.call = call
+        self.chunks = chunks
+        # contiguous runs of chunks per thread, neighbours share cache lines
+        per_thread = -(-len(chunks) // n_threads)
+        self.queues = [deque(range(k * per_thread,
+                                   min((k + 1) * per_thread, len(chunks))))
+                       for k in range(n_threads)]
+        self.remaining = len(chunks)
+        self.busy = 0.0
+        self.error = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def _steal(self, index):
+        queues = self.queues
+        for k in range(1, len(queues)):
+            try:
+                return queues[(index + k) % len(queues)].pop()
+            except IndexError:
+                pass
+        return None
+
+    def run(self, index):
+        own = self.queues[index]
+        while True:
+            # deque.popleft / pop are atomic, no lock needed to take a chunk
+            try:
+                c = own.popleft()
+            except IndexError:
+                c = self._steal(index)
+                if c is None:
+                    return
+            start = time.perf_counter()
+            try:
+                if self.error is None:
+                    self.call(c, *self.chunks[c])
+            except BaseException as e:
+                self.error = e
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.busy += elapsed
+                self.remaining -= 1
+                if not self.remaining:
+                    self.done.set()
+
+
+class KernelPool(object):
+    """
+    Runs (result, *inputs) kernels over chunks of axis 0 on persistent
+    threads. Kernels should be compiled with nogil=True, otherwise the
+    chunks run one at a time.
+    """
+
+    def __init__(self, n_threads=None):
+        """
+        n_threads counts the calling thread, None uses every CPU.
+        """
+        self.n_threads = max(1, n_threads or os.cpu_count() or 1)
+        self._threads = []
+        self._cond = threading.Condition()
+        self._task = None
+        self._generation = 0
+        self._closed = False
+        # one call at a time, calls from several threads queue up here
+        self._call_lock = threading.Lock()
+        # seconds per element, keyed by kernel and argument layout
+        self._costs = {}
+
+    def _start(self):
+        for k in range(1, self.n_threads):
+            t = threading.Thread(target=self._worker, args=(k,),
+                                 name='KernelPool-{}'.format(k))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _worker(self, index):
+        generation = 0
+        while True:
+            with self._cond:
+                while self._generation == generation and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                generation = self._generation
+                task = self._task
+            task.run(index)
+
+    def close(self):
+        """
+        Stop the threads. The pool can't be used afterwards.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def cost(self, kernel):
+        """
+        Estimated seconds per element of kernel, per argument layout seen.
+        """
+        return dict((key[1:], cost) for key, cost in self._costs.items()
+                    if key[0] is kernel)
+
+    @staticmethod
+    def _split(n, inputs, shared):
+        # True for the inputs that are cut into chunks along with result
+        sliced = []
+        for k, x in enumerate(inputs):
+            if k in shared or not isinstance(x, np.ndarray) or not x.ndim:
+                sliced.append(False)
+            elif len(x) != n:
+                raise ValueError('input {} has {} rows, expected {} (pass '
+                                 'it in shared= to give it whole to every '
+                                 'chunk)'.format(k, len(x), n))
+            else:
+                sliced.append(True)
+        return sliced
+
+    def _key(self, kernel, result, inputs, sliced):
+        # the per-element cost depends on the row shape of the sliced
+        # arguments and on the size of the shared ones
+        layout = [(result.dtype.str,) + result.shape[1:]]
+        for x, s in zip(inputs, sliced):
+            if isinstance(x, np.ndarray):
+                layout.append((x.dtype.str, s) + x.shape[s:])
+            else:
+                layout.append(type(x).__name__)
+        return (kernel,) + tuple(layout)
+
+    def _run(self, key, n, call, warmup):
+        """
+        Run call(c, lo, hi) over [0, n), sized by the cost estimate of key.
+        """
+        start = 0
+        cost = self._costs.get(key)
+        if cost is None:
+            # compile outside the measurement, then time a probe chunk
+            warmup()
+            start = min(n, min_chunk)
+            t0 = time.perf_counter()
+            call(-1, 0, start)
+            cost = (time.perf_counter() - t0) / max(start, 1)
+            self._costs[key] = cost
+            if start == n:
+                return
+
+        remaining = n - start
+        if self.n_threads == 1 or cost * remaining < inline_time:
+            t0 = time.perf_counter()
+            call(0, start, n)
+            busy = time.perf_counter() - t0
+        else:
+            per_thread = -(-remaining // self.n_threads)
+            chunk = max(min_chunk, min(per_thread,
+                                       int(target_chunk_time / cost)))
+            chunks = [(lo, min(lo + chunk, n))
+                      for lo in range(start, n, chunk)]
+            task = _Task(call, chunks, self.n_threads)
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError('the pool is closed')
+                if not self._threads:
+                    self._start()
+                self._task = task
+                self._generation += 1
+                self._cond.notify_all()
+            task.run(0)
+            task.done.wait()
+            if task.error is not None:
+                raise task.error
+            busy = task.busy
+        measured = busy / remaining
+        self._costs[key] = (1 - cost_smoothing) * cost + \
+            cost_smoothing * measured
+
+    def _partition(self, inputs, sliced, lo, hi):
+        return [x[lo:hi] if s else x for x, s in zip(inputs, sliced)]
+
+    def map(self, kernel, result, *inputs, **kw):
+        """
+        kernel(result[lo:hi], *inputs[lo:hi]) over chunks of result.
+        Inputs whose index is in shared=(...), scalars and 0-d arrays are
+        passed whole to every chunk, all other inputs must have as many
+        rows as result. Returns result.
+        """
+        shared = kw.pop('shared', ())
+        if kw:
+            raise TypeError('unexpected keyword arguments {}'.format(sorted(kw)))
+        n = len(result)
+        sliced = self._split(n, inputs, shared)
+        part = self._partition
+
+        def call(c, lo, hi):
+            kernel(result[lo:hi], *part(inputs, sliced, lo, hi))
+
+        def warmup():
+            kernel(result[:0], *part(inputs, sliced, 0, 0))
+
+        with self._call_lock:
+            self._run(self._key(kernel, result, inputs, sliced), n, call,
+                      warmup)
+        return result
+
+    def reduce(self, kernel, result, *inputs, **kw):
+        """
+        kernel(partial, *inputs[lo:hi]) over chunks of the inputs, where
+        each partial starts at identity and the kernel accumulates its
+        chunk into it. result is set to combine.reduce over the partials.
+        combine is a ufunc (np.add by default); identity defaults to the
+        ufunc's own, as for np.add and np.multiply, and must be given for
+        the others (-np.inf for np.maximum, ...). shared works as in map.
+        Returns result.
+        """
+        combine = kw.pop('combine', np.add)
+        identity = kw.pop('identity', None)
+        shared = kw.pop('shared', ())
+        if kw:
+            raise TypeError('unexpected keyword arguments {}'.format(sorted(kw)))
+        if identity is None:
+            identity = combine.identity
+            if identity is None:
+                raise ValueError('{} has no identity, pass identity='
+                                 .format(combine.__name__))
+        result = np.asarray(result)
+        lengths = [len(x) for k, x in enumerate(inputs)
+                   if k not in shared and isinstance(x, np.ndarray) and x.ndim]
+        if not lengths:
+            raise ValueError('reduce needs at least one input to split')
+        n = lengths[0]
+        sliced = self._split(n, inputs, shared)
+        part = self._partition
+        # one partial per chunk, plus the probe's; more than any call makes
+        partials = {}
+
+        def call(c, lo, hi):
+            partial = np.full(result.shape, identity, result.dtype)
+            kernel(partial, *part(inputs, sliced, lo, hi))
+            partials[c] = partial
+
+        def warmup():
+            kernel(np.full(result.shape, identity, result.dtype),
+                   *part(inputs, sliced, 0, 0))
+
+        with self._call_lock:
+            self._run(self._key(kernel, result, inputs, sliced), n, call,
+                      warmup)
+        # combine in chunk order, so the result doesn't depend on which
+        # thread ran what
+        stacked = np.stack([partials[c] for c in sorted(partials)])
+        result[...] = combine.reduce(stacked, axis=0)
+        return result
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_pool():
+    """
+    The shared KernelPool of the process, created on first use.
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = KernelPool()
+        return _default
+
+
+if __name__ == "__main__":
+    import math
+    from timeit import repeat
+
+    from numba import njit
+
+    @njit(nogil=True, fastmath=True)
+    def exp_kernel(result, a, b):
+        for i in range(len(result)):
+            result[i] = math.exp(2.1 * a[i] + 3.2 * b[i])
+
+    @njit(nogil=True)
+    def sum_kernel(partial, a):
+        for i in range(len(a)):
+            partial[0] += a[i]
+
+    def fresh_threads(result, a, b, n_threads):
+        # the old benchmark.make_multithread: new threads, equal chunks
+        chunk = -(-len(result) // n_threads)
+        threads = [threading.Thread(target=exp_kernel, args=(
+            result[k * chunk:(k + 1) * chunk], a[k * chunk:(k + 1) * chunk],
+            b[k * chunk:(k + 1) * chunk])) for k in range(n_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    pool = KernelPool()
+    for n in (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6):
+        a = np.random.rand(n)
+        b = np.random.rand(n)
+        result = np.empty(n)
+        pool.map(exp_kernel, result, a, b)
+        fresh_threads(result, a, b, pool.n_threads)
+        t_pool = min(repeat(lambda: pool.map(exp_kernel, result, a, b),
+                            number=10, repeat=3)) / 10
+        t_fresh = min(repeat(lambda: fresh_threads(result, a, b,
+                                                   pool.n_threads),
+                             number=10, repeat=3)) / 10
+        total = pool.reduce(sum_kernel, np.zeros(1), a)
+        assert np.isclose(total[0], a.sum())
+        print('n={:>8d}  pool {:>9.1f} us  fresh threads {:>9.1f} us'.format(
+            n, t_pool * 1e6, t_fresh * 1e6))
+    pool.close()
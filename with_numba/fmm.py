@@ -0,0 +1,352 @@
+"""
+2D Fast Multipole Method on the CPU, with positions as complex numbers.
+
+This is the 2D (logarithmic potential) gravity used by gravity.py, where
+body j pulls body i with
+
+    w_j * (p_j - p_i) / |p_j - p_i|^2
+
+With z = x + iy the field of all bodies is -conj(phi'(z)) for the complex
+potential phi(z) = sum_j w_j log(z - z_j), which is what the multipole and
+local expansions of order p approximate (Greengard & Rokhlin 1987). The
+Newtonian 1 / r^2 kernel of run_cpu_nbody is not harmonic in the plane and
+has no such expansion; use barnes_hut for that one.
+
+The tree is a uniform quadtree whose depth is picked from the body count so
+leaves hold about leaf_size bodies. Far field goes P2M, M2M, M2L, L2L and
+is evaluated per leaf; the near field (a leaf and its 8 neighbours) is a
+softened direct sum, so the total cost is O(N p^2). Softening is not
+harmonic, so the far field is unsoftened; with the default eps_2 that caps
+the achievable relative error around 1e-5 whatever the order.
+
+The method assumes bodies spread roughly uniformly over their bounding
+box. There is no adaptive refinement: clustered inputs, such as the
+galaxies of the nbody app, crowd into a few leaves, and the near field
+heads back towards O(N^2). At N = 65536, four clusters of width 0.01 in a
+box of side 2 take 2 s against 0.26 s for uniform bodies. The error also
+grows, since more close pairs cross box boundaries into the unsoftened far
+field. Use barnes_hut, whose tree adapts, for clustered bodies.
+"""
+
+from __future__ import division
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+from . import direct
+
+eps_2 = direct.eps_2
+
+# expansion order, error falls roughly like 0.5 ** order
+order = 16
+
+# target number of bodies per leaf box
+leaf_size = 32
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _accelerations_at(tz, z, w, eps_2, out):
+    for i in prange(tz.shape[0]):
+        a = 0j
+        for j in range(z.shape[0]):
+            r = z[j] - tz[i]
+            sqr_dist = r.real * r.real + r.imag * r.imag + eps_2
+            if sqr_dist > 0.0:
+                a += r * (w[j] / sqr_dist)
+        out[i] = a
+
+
+def accelerations_at(targets, positions, weights, eps_2=eps_2):
+    """
+    Exact float64 2D-gravity accelerations at the given target points.
+    """
+    tz = _to_complex(targets)
+    out = np.empty(len(tz), np.complex128)
+    _accelerations_at(tz, _to_complex(positions),
+                      np.ascontiguousarray(weights, np.float64),
+                      float(eps_2), out)
+    return np.stack([out.real, out.imag], axis=1)
+
+
+def direct_accelerations(positions, weights, eps_2=eps_2):
+    """
+    O(N^2) reference for accelerations(), same kernel and softening.
+    """
+    positions = np.asarray(positions)
+    out = accelerations_at(positions, positions, weights, eps_2)
+    return out.astype(positions.dtype)
+
+
+def _to_complex(positions):
+    positions = np.asarray(positions, np.float64)
+    return positions[:, 0] + 1j * positions[:, 1]
+
+
+def _binomials(n):
+    c = np.zeros((n + 1, n + 1))
+    for k in range(n + 1):
+        c[k, 0] = 1.0
+        for j in range(1, k + 1):
+            c[k, j] = c[k - 1, j - 1] + c[k - 1, j]
+    return c
+
+
+@njit(cache=True, inline='always')
+def _box(level, ix, iy):
+    # index of box (ix, iy) of the given level in the flat expansion arrays
+    return ((1 << (2 * level)) - 1) // 3 + (iy << level) + ix
+
+
+@njit(cache=True, inline='always')
+def _center(level, ix, iy, lo, extent):
+    size = extent / (1 << level)
+    return lo + complex((ix + 0.5) * size, (iy + 0.5) * size)
+
+
+@njit(cache=True, parallel=True)
+def _p2m(levels, z, w, leaf_start, lo, extent, p, mpole):
+    side = 1 << levels
+    for b in prange(side * side):
+        ix = b % side
+        iy = b // side
+        zc = _center(levels, ix, iy, lo, extent)
+        m = _box(levels, ix, iy)
+        for k in range(p + 1):
+            mpole[m, k] = 0j
+        for j in range(leaf_start[b], leaf_start[b + 1]):
+            d = z[j] - zc
+            mpole[m, 0] += w[j]
+            dk = 1.0 + 0j
+            for k in range(1, p + 1):
+                dk *= d
+                mpole[m, k] -= w[j] * dk / k
+
+
+@njit(cache=True, parallel=True)
+def _m2m(level, lo, extent, p, binom, mpole):
+    # gather the four children of every box of this level
+    side = 1 << level
+    for b in prange(side * side):
+        ix = b % side
+        iy = b // side
+        zc = _center(level, ix, iy, lo, extent)
+        m = _box(level, ix, iy)
+        for k in range(p + 1):
+            mpole[m, k] = 0j
+        for c in range(4):
+            cx = 2 * ix + (c & 1)
+            cy = 2 * iy + (c >> 1)
+            mc = _box(level + 1, cx, cy)
+            z0 = _center(level + 1, cx, cy, lo, extent) - zc
+            a0 = mpole[mc, 0]
+            mpole[m, 0] += a0
+            z0l = 1.0 + 0j
+            for l in range(1, p + 1):
+                z0l *= z0
+                s = -a0 * z0l / l
+                # sum_k a_k z0^(l - k) C(l - 1, k - 1)
+                z0p = 1.0 + 0j
+                for k in range(l, 0, -1):
+                    s += mpole[mc, k] * z0p * binom[l - 1, k - 1]
+                    z0p *= z0
+                mpole[m, l] += s
+
+
+@njit(cache=True, parallel=True)
+def _m2l(level, lo, extent, p, binom, mpole, local):
+    side = 1 << level
+    for b in prange(side * side):
+        ix = b % side
+        iy = b // side
+        zc = _center(level, ix, iy, lo, extent)
+        m = _box(level, ix, iy)
+        px = ix >> 1
+        py = iy >> 1
+        # children of the parent's neighbours that are not our neighbours
+        for sy in range(max(2 * (py - 1), 0), min(2 * (py + 2), side)):
+            for sx in range(max(2 * (px - 1), 0), min(2 * (px + 2), side)):
+                if abs(sx - ix) <= 1 and abs(sy - iy) <= 1:
+                    continue
+                ms = _box(level, sx, sy)
+                z0 = _center(level, sx, sy, lo, extent) - zc
+                inv_z0 = 1.0 / z0
+                a0 = mpole[ms, 0]
+                inv_z0l = 1.0 + 0j
+                for l in range(1, p + 1):
+                    inv_z0l *= inv_z0
+                    s = -a0 / l
+                    # sum_k a_k / z0^k C(l + k - 1, k - 1) (-1)^k
+                    inv_z0k = 1.0 + 0j
+                    sign = 1.0
+                    for k in range(1, p + 1):
+                        inv_z0k *= inv_z0
+                        sign = -sign
+                        s += mpole[ms, k] * inv_z0k * (sign * binom[l + k - 1, k - 1])
+                    local[m, l] += s * inv_z0l
+
+
+@njit(cache=True, parallel=True)
+def _l2l(level, lo, extent, p, binom, local):
+    # push every box's local expansion of this level down from its parent
+    side = 1 << level
+    for b in prange(side * side):
+        ix = b % side
+        iy = b // side
+        m = _box(level, ix, iy)
+        mp = _box(level - 1, ix >> 1, iy >> 1)
+        z0 = (_center(level, ix, iy, lo, extent)
+              - _center(level - 1, ix >> 1, iy >> 1, lo, extent))
+        for l in range(1, p + 1):
+            # sum_{k >= l} c_k C(k, l) z0^(k - l)
+            s = 0j
+            z0p = 1.0 + 0j
+            for k in range(l, p + 1):
+                s += local[mp, k] * binom[k, l] * z0p
+                z0p *= z0
+            local[m, l] += s
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _evaluate(levels, z, w, leaf_start, lo, extent, p, eps_2, local, out):
+    side = 1 << levels
+    for b in prange(side * side):
+        ix = b % side
+        iy = b // side
+        zc = _center(levels, ix, iy, lo, extent)
+        m = _box(levels, ix, iy)
+        for i in range(leaf_start[b], leaf_start[b + 1]):
+            zi = z[i]
+            # far field, derivative of the local expansion
+            d = zi - zc
+            dphi = 0j
+            for l in range(p, 0, -1):
+                dphi = dphi * d + l * local[m, l]
+            a = -dphi.conjugate()
+            # near field, direct sum over the 3x3 neighbourhood
+            for ny in range(max(iy - 1, 0), min(iy + 2, side)):
+                for nx in range(max(ix - 1, 0), min(ix + 2, side)):
+                    nb = ny * side + nx
+                    for j in range(leaf_start[nb], leaf_start[nb + 1]):
+                        r = z[j] - zi
+                        sqr_dist = r.real * r.real + r.imag * r.imag + eps_2
+                        if sqr_dist > 0.0:
+                            a += r * (w[j] / sqr_dist)
+            out[i] = a
+
+
+def accelerations(positions, weights, order=order, eps_2=eps_2, out=None,
+                  leaf_size=leaf_size):
+    """
+    Compute 2D-gravity accelerations of all bodies with the FMM.
+    """
+    positions = np.asarray(positions)
+    n, dim = positions.shape
+    if dim != 2:
+        raise ValueError('positions must be (n, 2), got {}'.format(positions.shape))
+    p = int(order)
+    z = _to_complex(positions)
+    w = np.ascontiguousarray(weights, np.float64)
+
+    # uniform quadtree deep enough for about leaf_size bodies per leaf
+    levels = max(2, int(math.ceil(math.log(max(n / leaf_size, 1.0), 4))))
+    side = 1 << levels
+    lo = complex(z.real.min(), z.imag.min())
+    extent = max(z.real.max() - lo.real, z.imag.max() - lo.imag)
+    extent = extent * (1 + 1e-6) if extent > 0 else 1.0
+
+    # bin bodies into leaves, row-major by leaf box
+    ix = np.minimum(((z.real - lo.real) * (side / extent)).astype(np.int64), side - 1)
+    iy = np.minimum(((z.imag - lo.imag) * (side / extent)).astype(np.int64), side - 1)
+    leaf = iy * side + ix
+    sort = np.argsort(leaf, kind='stable')
+    leaf_start = np.zeros(side * side + 1, np.int64)
+    np.cumsum(np.bincount(leaf, minlength=side * side), out=leaf_start[1:])
+    z = z[sort]
+    w = w[sort]
+
+    binom = _binomials(2 * p)
+    n_boxes = ((1 << (2 * (levels + 1))) - 1) // 3
+    mpole = np.empty((n_boxes, p + 1), np.complex128)
+    local = np.zeros((n_boxes, p + 1), np.complex128)
+
+    _p2m(levels, z, w, leaf_start, lo, extent, p, mpole)
+    for level in range(levels - 1, 1, -1):
+        _m2m(level, lo, extent, p, binom, mpole)
+    for level in range(2, levels + 1):
+        if level > 2:
+            _l2l(level, lo, extent, p, binom, local)
+        _m2l(level, lo, extent, p, binom, mpole, local)
+
+    acc = np.empty(n, np.complex128)
+    _evaluate(levels, z, w, leaf_start, lo, extent, p, float(eps_2), local, acc)
+
+    if out is None:
+        out = np.empty(positions.shape, dtype=positions.dtype)
+    out[sort, 0] = acc.real
+    out[sort, 1] = acc.imag
+    return out
+
+
+def force_error(positions, weights, acc, eps_2=eps_2, n_samples=1000, seed=0):
+    """
+    Sampled relative error of acc against the exact 2D-gravity direct sum.
+    """
+    return direct.force_error(positions, weights, acc, eps_2, n_samples, seed,
+                              reference=accelerations_at)
+
+
+def scaling_benchmark(sizes, orders=(8, 16), theta=0.5, direct_limit=1 << 15,
+                      repeat=3):
+    """
+    Print wall time of direct summation, Barnes-Hut and the FMM over the
+    given body counts. Direct sum is only run up to direct_limit bodies and
+    extrapolated as N^2 beyond it. Barnes-Hut uses its own Newtonian kernel,
+    so only its timing is comparable.
+    """
+    from timeit import repeat as timeit_repeat
+    from . import barnes_hut
+
+    def best(f):
+        return min(timeit_repeat(f, number=1, repeat=repeat))
+
+    # compile outside the timed region
+    p, w = _samples(256)
+    direct_accelerations(p, w)
+    barnes_hut.accelerations(p, w, theta)
+    for o in orders:
+        accelerations(p, w, o)
+
+    header = '{:>9s} {:>11s} {:>11s}'.format('n', 'direct', 'bh')
+    for o in orders:
+        header += ' {:>11s} {:>9s}'.format('fmm p={}'.format(o), 'rms err')
+    print(header)
+    t_direct = None
+    n_direct = None
+    for n in sizes:
+        p, w = _samples(n)
+        if n <= direct_limit:
+            t_direct = best(lambda: direct_accelerations(p, w))
+            n_direct = n
+            direct_str = '{:>9.1f}ms'.format(t_direct * 1000)
+        else:
+            direct_str = '~{:>8.0f}ms'.format(t_direct * (n / n_direct) ** 2 * 1000)
+        t_bh = best(lambda: barnes_hut.accelerations(p, w, theta))
+        line = '{:>9d} {:>11s} {:>9.1f}ms'.format(n, direct_str, t_bh * 1000)
+        for o in orders:
+            t = best(lambda: accelerations(p, w, o))
+            err = force_error(p, w, accelerations(p, w, o), n_samples=200)
+            line += ' {:>9.1f}ms {:>9.1e}'.format(t * 1000, err.rms)
+        print(line)
+
+
+def _samples(n_bodies):
+    rs = np.random.RandomState(0)
+    positions = rs.uniform(-1.0, 1.0, (n_bodies, 2)).astype(np.float32)
+    weights = rs.uniform(1.0, 2.0, n_bodies).astype(np.float32)
+    return positions, weights
+
+
+if __name__ == "__main__":
+    scaling_benchmark([1 << k for k in range(10, 21, 2)])
@@ -0,0 +1,206 @@
+"""
+Direct-sum accelerations in an OpenGL compute shader.
+
+The same 2D sum as direct.accelerations on (n, 2) float32 positions: one
+invocation per body, with the j loop tiled through shared memory in tiles
+of one work group. Runs in a surfaceless EGL context, so it needs PyOpenGL
+and a GL 4.3 driver but no display. context() raises ContextError when
+either is missing.
+"""
+
+from __future__ import division
+
+import ctypes
+import os
+
+import numpy as np
+
+from . import direct
+
+gl_version = (4, 3)
+
+# invocations per work group, also the j-tile size
+local_size = 256
+
+_source = """
+#version 430
+layout(local_size_x = {local_size}) in;
+
+// x, y, weight, unused
+layout(std430, binding = 0) readonly buffer Bodies {{ vec4 bodies[]; }};
+layout(std430, binding = 1) writeonly buffer Accelerations {{ vec2 acc[]; }};
+
+uniform uint n;
+uniform float eps_2;
+
+shared vec4 tile[{local_size}];
+
+void main() {{
+    uint i = gl_GlobalInvocationID.x;
+    uint k = gl_LocalInvocationID.x;
+    vec2 p = i < n ? bodies[i].xy : vec2(0.0);
+    vec2 a = vec2(0.0);
+    for (uint j0 = 0u; j0 < n; j0 += {local_size}u) {{
+        // zero weights pad the last tile
+        tile[k] = j0 + k < n ? bodies[j0 + k] : vec4(0.0);
+        barrier();
+        for (uint j = 0u; j < {local_size}u; j++) {{
+            vec2 r = tile[j].xy - p;
+            float d2 = dot(r, r) + eps_2;
+            a += tile[j].z * r * inversesqrt(d2 * d2 * d2);
+        }}
+        barrier();
+    }}
+    if (i < n) {{
+        acc[i] = a;
+    }}
+}}
+"""
+
+
+class ContextError(RuntimeError):
+    """
+    No OpenGL context with compute shaders could be created.
+    """
+
+
+_context = None
+
+# compiled programs by local_size
+_programs = {}
+
+
+def context():
+    """
+    Creates a surfaceless EGL context once and keeps it current.
+    """
+    global _context
+    if _context is not None:
+        return _context
+    # PyOpenGL picks its platform on first import
+    os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+    try:
+        from OpenGL import EGL
+    except ImportError as e:
+        raise ContextError('PyOpenGL is not available: {}'.format(e))
+    try:
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(display, ctypes.pointer(major),
+                                 ctypes.pointer(minor)):
+            raise ContextError('could not initialize EGL')
+        config = EGL.EGLConfig()
+        num_configs = EGL.EGLint()
+        config_attribs = (EGL.EGLint * 5)(
+            EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+            EGL.EGL_NONE)
+        if not EGL.eglChooseConfig(display, config_attribs,
+                                   ctypes.pointer(config), 1,
+                                   ctypes.pointer(num_configs)) \
+                or num_configs.value < 1:
+            raise ContextError('no EGL config supports desktop OpenGL')
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context_attribs = (EGL.EGLint * 7)(
+            EGL.EGL_CONTEXT_MAJOR_VERSION, gl_version[0],
+            EGL.EGL_CONTEXT_MINOR_VERSION, gl_version[1],
+            EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+            EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+            EGL.EGL_NONE)
+        ctx = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT,
+                                   context_attribs)
+        if not ctx or not EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE,
+                                             EGL.EGL_NO_SURFACE, ctx):
+            raise ContextError('no surfaceless OpenGL {}.{} context'
+                               .format(*gl_version))
+    except ContextError:
+        raise
+    except Exception as e:
+        # missing libEGL, no driver, ...
+        raise ContextError('no EGL context: {}'.format(e))
+    _context = display, ctx
+    return _context
+
+
+def program(local_size=local_size):
+    """
+    The compute program for a work group size, compiled once.
+    """
+    if local_size not in _programs:
+        context()
+        from OpenGL import GL
+        from OpenGL.GL import shaders
+        _programs[local_size] = shaders.compileProgram(shaders.compileShader(
+            _source.format(local_size=local_size), GL.GL_COMPUTE_SHADER))
+    return _programs[local_size]
+
+
+class Runner(object):
+    """
+    Bodies uploaded once, for dispatching the shader repeatedly (the GL
+    counterpart of bench_cuda.NBodyCUDARunner).
+    """
+
+    def __init__(self, positions, weights, local_size=local_size):
+        # creates the context before OpenGL.GL is imported
+        self.program = program(local_size)
+        from OpenGL import GL
+        self.local_size = local_size
+        self.n_bodies = n = len(weights)
+        packed = np.zeros((n, 4), np.float32)
+        packed[:, :2] = positions
+        packed[:, 2] = weights
+        self.bodies, self.acc = GL.glGenBuffers(2)
+        GL.glBindBuffer(GL.GL_SHADER_STORAGE_BUFFER, self.bodies)
+        GL.glBufferData(GL.GL_SHADER_STORAGE_BUFFER, packed.nbytes, packed,
+                        GL.GL_STATIC_DRAW)
+        GL.glBindBuffer(GL.GL_SHADER_STORAGE_BUFFER, self.acc)
+        GL.glBufferData(GL.GL_SHADER_STORAGE_BUFFER, n * 8, None,
+                        GL.GL_DYNAMIC_READ)
+        GL.glBindBuffer(GL.GL_SHADER_STORAGE_BUFFER, 0)
+
+    def run(self):
+        from OpenGL import GL
+        GL.glUseProgram(self.program)
+        GL.glBindBufferBase(GL.GL_SHADER_STORAGE_BUFFER, 0, self.bodies)
+        GL.glBindBufferBase(GL.GL_SHADER_STORAGE_BUFFER, 1, self.acc)
+        GL.glUniform1ui(GL.glGetUniformLocation(self.program, 'n'),
+                        self.n_bodies)
+        GL.glUniform1f(GL.glGetUniformLocation(self.program, 'eps_2'),
+                       direct.eps_2)
+        GL.glDispatchCompute(-(-self.n_bodies // self.local_size), 1, 1)
+        GL.glFinish()
+
+    def results(self):
+        from OpenGL import GL
+        GL.glMemoryBarrier(GL.GL_BUFFER_UPDATE_BARRIER_BIT)
+        GL.glBindBuffer(GL.GL_SHADER_STORAGE_BUFFER, self.acc)
+        data = GL.glGetBufferSubData(GL.GL_SHADER_STORAGE_BUFFER, 0,
+                                     self.n_bodies * 8)
+        GL.glBindBuffer(GL.GL_SHADER_STORAGE_BUFFER, 0)
+        return np.frombuffer(data, np.float32).reshape(self.n_bodies, 2).copy()
+
+    def close(self):
+        from OpenGL import GL
+        GL.glDeleteBuffers(2, [self.bodies, self.acc])
+
+
+def accelerations(positions, weights, local_size=local_size, out=None):
+    """
+    accelerations(positions, weights) on the GPU, uploading the bodies and
+    reading the result back on every call.
+    """
+    positions = np.asarray(positions)
+    if positions.ndim != 2 or positions.shape[1] != 2:
+        raise ValueError('positions must be (n, 2), got {}'
+                         .format(positions.shape))
+    runner = Runner(positions, weights, local_size)
+    try:
+        runner.run()
+        acc = runner.results()
+    finally:
+        runner.close()
+    if out is None:
+        return acc.astype(positions.dtype, copy=False)
+    out[:] = acc
+    return out
@@ -0,0 +1,341 @@
+"""
+Time integrators for the CPU engines.
+
+Shared-step schemes work on (n, dim) positions / velocities in place and
+take any force function with the accelerations(positions, weights)
+contract (direct, barnes_hut, fmm, ...):
+
+    leapfrog_step           kick-drift-kick, one force evaluation per step
+    velocity_verlet_step    same cost and order, position-first form
+    hermite_step            4th order predictor-corrector, needs jerks
+
+Each returns the accelerations at the end of the step; passing them back in
+as acc= keeps the cost at one force evaluation per step. advance() runs
+leapfrog or velocity Verlet steps on a particles.ParticleSet in place.
+
+BlockHermite gives every particle its own power-of-two fraction of dt_max,
+picked from |a| / |jerk|. Only the particles due at a block time are
+corrected, all others are just predicted, so a few fast stars near a
+galaxy's center star no longer force the whole disk onto their timestep.
+"""
+
+from __future__ import division
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+from . import direct
+
+eps_2 = direct.eps_2
+
+
+@njit(cache=True, parallel=True)
+def _kick(v, a, h):
+    for i in prange(v.shape[0]):
+        for k in range(v.shape[1]):
+            v[i, k] += a[i, k] * h
+
+
+@njit(cache=True, parallel=True)
+def _drift(x, v, h):
+    for i in prange(x.shape[0]):
+        for k in range(x.shape[1]):
+            x[i, k] += v[i, k] * h
+
+
+@njit(cache=True, parallel=True)
+def _verlet_drift(x, v, a, h):
+    for i in prange(x.shape[0]):
+        for k in range(x.shape[1]):
+            x[i, k] += (v[i, k] + 0.5 * h * a[i, k]) * h
+
+
+@njit(cache=True, parallel=True)
+def _verlet_kick(v, a0, a1, h):
+    for i in prange(v.shape[0]):
+        for k in range(v.shape[1]):
+            v[i, k] += 0.5 * (a0[i, k] + a1[i, k]) * h
+
+
+@njit(cache=True, parallel=True)
+def _predict(x, v, a, j, h, xp, vp):
+    # h is per particle: time since the particle was last corrected
+    for i in prange(x.shape[0]):
+        hi = h[i]
+        for k in range(x.shape[1]):
+            xp[i, k] = x[i, k] + hi * (v[i, k] + hi * (a[i, k] / 2 + hi * j[i, k] / 6))
+            vp[i, k] = v[i, k] + hi * (a[i, k] + hi * j[i, k] / 2)
+
+
+@njit(cache=True, parallel=True)
+def _correct(idx, x, v, a0, j0, a1, j1, h, vp):
+    # vp only provides scratch for the new velocities of the active bodies
+    for m in prange(idx.shape[0]):
+        i = idx[m]
+        hi = h[i]
+        for k in range(x.shape[1]):
+            v1 = v[i, k] + (a0[i, k] + a1[m, k]) * hi / 2 + (j0[i, k] - j1[m, k]) * hi * hi / 12
+            x[i, k] += (v[i, k] + v1) * hi / 2 + (a0[i, k] - a1[m, k]) * hi * hi / 12
+            vp[i, k] = v1
+        for k in range(x.shape[1]):
+            v[i, k] = vp[i, k]
+            a0[i, k] = a1[m, k]
+            j0[i, k] = j1[m, k]
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model='numpy')
+def _potential(x, w, eps_2, out):
+    n, dim = x.shape
+    for i in prange(n):
+        u = 0.0
+        for j in range(i + 1, n):
+            sqr_dist = eps_2
+            for k in range(dim):
+                r = x[j, k] - x[i, k]
+                sqr_dist += r * r
+            u -= w[j] / math.sqrt(sqr_dist)
+        out[i] = u * w[i]
+
+
+def energy(positions, velocities, weights, eps_2=eps_2):
+    """
+    Total (kinetic + softened potential) energy in float64, for checking
+    the conservation of an integrator.
+    """
+    x = np.asarray(positions, np.float64)
+    v = np.asarray(velocities, np.float64)
+    w = np.asarray(weights, np.float64)
+    u = np.empty(len(w))
+    _potential(x, w, float(eps_2), u)
+    return 0.5 * np.sum(w * np.sum(v * v, axis=1)) + u.sum()
+
+
+def leapfrog_step(positions, velocities, weights, dt, acc=None,
+                  force=direct.accelerations):
+    """
+    Advance positions and velocities in place by one kick-drift-kick step.
+    """
+    if acc is None:
+        acc = force(positions, weights)
+    _kick(velocities, acc, 0.5 * dt)
+    _drift(positions, velocities, dt)
+    acc = force(positions, weights)
+    _kick(velocities, acc, 0.5 * dt)
+    return acc
+
+
+def velocity_verlet_step(positions, velocities, weights, dt, acc=None,
+                         force=direct.accelerations):
+    """
+    Advance positions and velocities in place by one velocity Verlet step.
+    """
+    if acc is None:
+        acc = force(positions, weights)
+    _verlet_drift(positions, velocities, acc, dt)
+    acc_new = force(positions, weights)
+    _verlet_kick(velocities, acc, acc_new, dt)
+    return acc_new
+
+
+def advance(particles, dt, n_steps=1, step=leapfrog_step,
+            force=direct.accelerations):
+    """
+    Advance a ParticleSet in place by n_steps of leapfrog_step or
+    velocity_verlet_step, leaving the final accelerations in it.
+    """
+    acc = None
+    for _ in range(n_steps):
+        acc = step(particles.positions, particles.velocities, particles.mass,
+                   dt, acc, force)
+    if acc is not None:
+        particles.accelerations[:] = acc
+    return particles
+
+
+def hermite_step(positions, velocities, weights, dt, acc=None, jerk=None,
+                 eps_2=eps_2):
+    """
+    Advance positions and velocities in place by one 4th order Hermite
+    step. Returns (acc, jerk) at the end of the step.
+    """
+    if acc is None or jerk is None:
+        acc, jerk = direct.accelerations_jerks(positions, velocities,
+                                               weights, eps_2)
+    n = len(positions)
+    h = np.full(n, dt, np.float64)
+    xp = np.empty((n, positions.shape[1]))
+    vp = np.empty_like(xp)
+    _predict(positions, velocities, acc, jerk, h, xp, vp)
+    acc_new, jerk_new = direct.accelerations_jerks(xp, vp, weights, eps_2)
+    # float64 state for the corrector, written back at the end
+    x = np.asarray(positions, np.float64).copy()
+    v = np.asarray(velocities, np.float64).copy()
+    acc = np.array(acc, np.float64)
+    jerk = np.array(jerk, np.float64)
+    _correct(np.arange(n), x, v, acc, jerk, acc_new, jerk_new, h, vp)
+    positions[:] = x
+    velocities[:] = v
+    return acc, jerk
+
+
+class BlockHermite(object):
+    """
+    4th order Hermite integrator with hierarchical power-of-two block
+    timesteps. Particle i steps with dt_max / 2 ** level[i]; level is
+    chosen from eta * |a| / |jerk| and capped at max_level. Time is kept in
+    integer ticks of dt_max / 2 ** max_level so block times are exact.
+    State is float64; positions() / velocities() give the predicted state
+    at the current block time.
+    """
+
+    def __init__(self, positions, velocities, weights, dt_max, max_level=12,
+                 eta=0.02, eps_2=eps_2):
+        self.x = np.array(positions, np.float64)
+        self.v = np.array(velocities, np.float64)
+        self.w = np.ascontiguousarray(weights, np.float64)
+        self.dt_max = float(dt_max)
+        self.max_level = int(max_level)
+        self.eta = eta
+        self.eps_2 = eps_2
+        self.dt_min = self.dt_max / (1 << self.max_level)
+
+        n = len(self.w)
+        self.tick = 0
+        self.last_tick = np.zeros(n, np.int64)
+        self.a, self.j = direct.accelerations_jerks(
+            self.x, self.v, self.w, eps_2)
+        self.level = self._levels(self.a, self.j)
+
+        # particle force evaluations and block steps, for throughput stats
+        self.force_evaluations = n
+        self.block_steps = 0
+
+    @property
+    def time(self):
+        return self.tick * self.dt_min
+
+    def _levels(self, a, j):
+        a_norm = np.sqrt(np.sum(a * a, axis=1))
+        j_norm = np.sqrt(np.sum(j * j, axis=1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dt = self.eta * a_norm / j_norm
+        dt = np.where(np.isfinite(dt) & (dt > 0), dt, self.dt_max)
+        level = np.ceil(np.log2(self.dt_max / dt))
+        return np.clip(level, 0, self.max_level).astype(np.int64)
+
+    def _predicted(self, tick):
+        h = (tick - self.last_tick) * self.dt_min
+        xp = np.empty_like(self.x)
+        vp = np.empty_like(self.v)
+        _predict(self.x, self.v, self.a, self.j, h, xp, vp)
+        return xp, vp, h
+
+    def positions(self):
+        return self._predicted(self.tick)[0]
+
+    def velocities(self):
+        return self._predicted(self.tick)[1]
+
+    def step(self):
+        """
+        Advance to the next block time, correcting only the due particles.
+        Returns the number of particles corrected.
+        """
+        ticks = np.left_shift(1, self.max_level - self.level)
+        due = self.last_tick + ticks
+        tick = due.min()
+        active = np.flatnonzero(due == tick)
+
+        xp, vp, _ = self._predicted(tick)
+        a1, j1 = direct.accelerations_jerks(xp, vp, self.w, self.eps_2, active)
+        h = ticks * self.dt_min
+        _correct(active, self.x, self.v, self.a, self.j, a1, j1, h, vp)
+
+        # new levels: shrinking is always allowed, growing by one level only
+        # when the block time is a multiple of the longer step
+        level = self.level[active]
+        wanted = self._levels(a1, j1)
+        up = np.maximum(level - 1, 0)
+        can_grow = (tick % np.left_shift(1, self.max_level - up)) == 0
+        level = np.where(wanted > level, wanted,
+                         np.where((wanted < level) & can_grow, up, level))
+        self.level[active] = level
+        self.last_tick[active] = tick
+        self.tick = tick
+
+        self.force_evaluations += len(active)
+        self.block_steps += 1
+        return len(active)
+
+    def advance(self, n_steps=1):
+        """
+        Advance by n_steps * dt_max, ending with every particle synchronized.
+        """
+        end = self.tick + n_steps * (1 << self.max_level)
+        while self.tick < end:
+            self.step()
+
+
+def _galaxy(n_stars, center_mass=10.0, star_mass_factor=1e-5, r_min=0.5,
+            r_max=5.0, seed=0):
+    # one center star with an orbiting disk, like NBodySimulation's galaxies
+    rs = np.random.RandomState(seed)
+    r = np.exp(rs.uniform(np.log(r_min), np.log(r_max), n_stars))
+    t = rs.uniform(0, 2 * np.pi, n_stars)
+    pos = np.zeros((n_stars + 1, 3))
+    vel = np.zeros((n_stars + 1, 3))
+    pos[1:, 0] = r * np.cos(t)
+    pos[1:, 2] = r * np.sin(t)
+    pos[1:, 1] = rs.uniform(-0.05, 0.05, n_stars)
+    speed = np.sqrt(center_mass / r)
+    vel[1:, 0] = -speed * np.sin(t)
+    vel[1:, 2] = speed * np.cos(t)
+    weights = np.full(n_stars + 1, center_mass * star_mass_factor)
+    weights[0] = center_mass
+    return pos, vel, weights
+
+
+if __name__ == "__main__":
+    import time
+
+    t_end = 2.0
+    pos, vel, w = _galaxy(1000)
+    e0 = energy(pos, vel, w)
+
+    for name, step in (('leapfrog', leapfrog_step),
+                       ('velocity verlet', velocity_verlet_step)):
+        for dt in (1e-2, 1e-3):
+            x = pos.copy()
+            v = vel.copy()
+            acc = None
+            t0 = time.perf_counter()
+            for _ in range(int(round(t_end / dt))):
+                acc = step(x, v, w, dt, acc)
+            t1 = time.perf_counter()
+            print('{:<16s} dt={:.0e}  evals {:>9d}  dE/E {:.1e}  {:>7.2f} s'.format(
+                name, dt, len(w) * int(round(t_end / dt)),
+                abs(energy(x, v, w) / e0 - 1), t1 - t0))
+
+    dt = 1e-2
+    x = pos.copy()
+    v = vel.copy()
+    acc = jerk = None
+    t0 = time.perf_counter()
+    for _ in range(int(round(t_end / dt))):
+        acc, jerk = hermite_step(x, v, w, dt, acc, jerk)
+    t1 = time.perf_counter()
+    print('{:<16s} dt={:.0e}  evals {:>9d}  dE/E {:.1e}  {:>7.2f} s'.format(
+        'hermite', dt, len(w) * int(round(t_end / dt)),
+        abs(energy(x, v, w) / e0 - 1), t1 - t0))
+
+    integ = BlockHermite(pos, vel, w, dt_max=0.125, max_level=10)
+    t0 = time.perf_counter()
+    integ.advance(int(round(t_end / integ.dt_max)))
+    t1 = time.perf_counter()
+    print('{:<16s} levels 0-{:d}  evals {:>9d}  dE/E {:.1e}  {:>7.2f} s  '
+          '({:d} block steps)'.format(
+              'block hermite', integ.max_level, integ.force_evaluations,
+              abs(energy(integ.x, integ.v, w) / e0 - 1), t1 - t0,
+              integ.block_steps))
@@ -0,0 +1,170 @@
+"""
+Particle container of the CPU engines.
+
+ParticleSet stores every component as its own contiguous row, so
+position[0] is all x coordinates, position[1] all y, and so on. The
+engines' (n, dim) layout is just the transpose, and splitting it back into
+per-axis arrays (direct.split_components) hands the rows through without a
+copy. direct.accelerations takes a ParticleSet directly and
+integrators.advance steps one in place.
+
+particle_dtype is the 32-byte interleaved record of
+NBodySimulation.particles_ssbo (two vec4 per particle in particle.comp,
+field offsets used by setup_vbo_attrs). The nbody app is a separate
+program of flat modules and keeps its own copy of that dtype in sim.py,
+the two have to be changed together. ParticleSet.wrap() gives zero-copy
+strided views into such a buffer; from_structured() / pack() move between
+the two layouts in a single pass.
+"""
+
+from __future__ import division
+
+import numpy as np
+from numba import njit, prange
+
+particle_dtype = np.dtype([
+    ('position', np.float32, 3),
+    ('mass', np.float32),
+    ('velocity', np.float32, 3),
+    ('radius', np.float32)])
+
+
+def raw_view(data):
+    """
+    (n, 8) float32 view of a particle_dtype buffer, i.e. the two vec4 per
+    particle that particle.comp reads: x, y, z, mass, vx, vy, vz, radius.
+    """
+    return data.view(np.float32).reshape(len(data), 8)
+
+
+@njit(cache=True, parallel=True)
+def _pack(position, velocity, mass, radius, raw):
+    dim = position.shape[0]
+    for i in prange(raw.shape[0]):
+        for k in range(3):
+            if k < dim:
+                raw[i, k] = position[k, i]
+                raw[i, 4 + k] = velocity[k, i]
+            else:
+                raw[i, k] = 0.0
+                raw[i, 4 + k] = 0.0
+        raw[i, 3] = mass[i]
+        raw[i, 7] = radius[i]
+
+
+@njit(cache=True, parallel=True)
+def _unpack(raw, position, velocity, mass, radius):
+    dim = position.shape[0]
+    for i in prange(raw.shape[0]):
+        for k in range(dim):
+            position[k, i] = raw[i, k]
+            velocity[k, i] = raw[i, 4 + k]
+        mass[i] = raw[i, 3]
+        radius[i] = raw[i, 7]
+
+
+class ParticleSet(object):
+    """
+    Structure-of-arrays particle storage.
+    """
+
+    __slots__ = ('position', 'velocity', 'acceleration', 'mass', 'radius')
+
+    def __init__(self, n, dim=3, dtype=np.float32):
+        self.position = np.zeros((dim, n), dtype)
+        self.velocity = np.zeros((dim, n), dtype)
+        self.acceleration = np.zeros((dim, n), dtype)
+        self.mass = np.zeros(n, dtype)
+        self.radius = np.zeros(n, dtype)
+
+    def __len__(self):
+        return self.mass.shape[0]
+
+    @property
+    def dim(self):
+        return self.position.shape[0]
+
+    @property
+    def dtype(self):
+        return self.mass.dtype
+
+    @property
+    def positions(self):
+        """
+        (n, dim) view of the positions, the layout the force engines take.
+        """
+        return self.position.T
+
+    @property
+    def velocities(self):
+        return self.velocity.T
+
+    @property
+    def accelerations(self):
+        """
+        (n, dim) view of the accelerations, usable as an engine's out=.
+        """
+        return self.acceleration.T
+
+    @classmethod
+    def from_arrays(cls, positions, weights, velocities=None, radii=None):
+        """
+        Build from the (n, dim) positions and (n,) weights of
+        make_nbody_samples, copying into SoA rows.
+        """
+        positions = np.asarray(positions)
+        n, dim = positions.shape
+        ps = cls(n, dim, positions.dtype)
+        ps.position[:] = positions.T
+        ps.mass[:] = weights
+        if velocities is not None:
+            ps.velocity[:] = np.asarray(velocities).T
+        if radii is not None:
+            ps.radius[:] = radii
+        return ps
+
+    @classmethod
+    def from_structured(cls, data):
+        """
+        Copy a particle_dtype buffer (e.g. particles_ssbo.data) into
+        contiguous SoA rows.
+        """
+        ps = cls(len(data), 3, np.float32)
+        ps.unpack(data)
+        return ps
+
+    @classmethod
+    def wrap(cls, data):
+        """
+        Zero-copy ParticleSet over a particle_dtype buffer. The rows are
+        strided views, so writes go straight to the buffer, but the engines
+        copy them into contiguous rows before running. There is no
+        acceleration field in the GL layout, so that one is freshly
+        allocated.
+        """
+        ps = cls.__new__(cls)
+        ps.position = data['position'].T
+        ps.velocity = data['velocity'].T
+        ps.mass = data['mass']
+        ps.radius = data['radius']
+        ps.acceleration = np.zeros((3, len(data)), np.float32)
+        return ps
+
+    def unpack(self, data):
+        """
+        Load positions, velocities, masses and radii from a particle_dtype
+        buffer of the same length.
+        """
+        _unpack(raw_view(data), self.position, self.velocity, self.mass,
+                self.radius)
+
+    def pack(self, out=None):
+        """
+        Write this set into a particle_dtype buffer in one pass, e.g.
+        pack(sim.particles_ssbo.data[:len(ps)]). 2D sets get z = 0.
+        """
+        if out is None:
+            out = np.empty(len(self), particle_dtype)
+        _pack(self.position, self.velocity, self.mass, self.radius,
+              raw_view(out))
+        return out
@@ -0,0 +1,393 @@
+"""
+Particle-mesh (PM) gravity on the CPU.
+
+Mass is assigned to a regular grid (CIC or TSC), the potential comes from
+one FFT convolution with a Green's function, and accelerations are
+interpolated back with the same assignment scheme from a 4-point finite
+difference of the potential. The cost is O(N + G log G) for G grid cells,
+independent of how clustered the bodies are, at the price of resolving
+nothing below a couple of cells.
+
+Two boundary conditions:
+
+    isolated   the grid covers the bodies' bounding box and is zero-padded
+               to twice its size (Hockney & Eastwood), so the result is the
+               plain open-space sum with the same 1 / r potential as
+               direct.accelerations, for (n, 2) and (n, 3) positions alike
+    periodic   bodies live in [0, box) along every axis and feel all
+               periodic images; the Green's function is the inverse of the
+               discrete Laplacian, 3D Newtonian for (n, 3) positions and
+               2D (logarithmic, as in gravity.py / fmm.py) for (n, 2)
+
+Forces below a few cells are smoothed away. That is harmless for the 3D
+Newtonian field of a large N, but bodies in a plane with the 1 / r^2 force
+of direct.accelerations are dominated by their nearest neighbours, so in 2D
+PM only gets the large-scale part right.
+
+Green's functions are cached per grid, so repeated steps on the same grid
+only pay for the deposit, two FFTs and the interpolation. numpy.fft keeps
+its own per-size plan cache, and grid sizes are rounded up to 5-smooth
+lengths where it is fastest.
+"""
+
+from __future__ import division
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+from . import direct
+
+eps_2 = direct.eps_2
+
+# grid cells per axis
+grid_size = 128
+
+assignments = ('cic', 'tsc')
+boundaries = ('isolated', 'periodic')
+
+# empty cells kept around the bounding box in the isolated case, so every
+# assignment and finite-difference stencil stays inside the grid
+margin = 4
+
+# x-slabs per deposit block; blocks of one parity never share a cell
+slab_block = 4
+
+# cached Green's functions in Fourier space, keyed by grid and kernel
+_greens = {}
+
+
+def _good_size(n):
+    # smallest 2^a 3^b 5^c >= n
+    best = 1 << int(math.ceil(math.log2(max(n, 1))))
+    f5 = 1
+    while f5 < best:
+        f35 = f5
+        while f35 < best:
+            f = f35
+            while f < n:
+                f *= 2
+            best = min(best, f)
+            f35 *= 3
+        f5 *= 5
+    return best
+
+
+@njit(cache=True, inline='always')
+def _stencil(u, order, m):
+    # first node and weights of the assignment of grid coordinate u;
+    # axes of a single cell (2D runs) take all the weight
+    if m == 1:
+        return 0, 1.0, 0.0, 0.0
+    if order == 2:
+        i0 = math.floor(u)
+        f = u - i0
+        return int(i0), 1.0 - f, f, 0.0
+    i0 = math.floor(u + 0.5)
+    d = u - i0
+    return (int(i0) - 1, 0.5 * (0.5 - d) * (0.5 - d), 0.75 - d * d,
+            0.5 * (0.5 + d) * (0.5 + d))
+
+
+@njit(cache=True)
+def _slab_sort(slab, n_slabs):
+    # counting sort of bodies by x-slab
+    counts = np.zeros(n_slabs + 1, np.int64)
+    for i in range(slab.shape[0]):
+        counts[slab[i] + 1] += 1
+    for s in range(n_slabs):
+        counts[s + 1] += counts[s]
+    offsets = counts.copy()
+    perm = np.empty(slab.shape[0], np.int64)
+    for i in range(slab.shape[0]):
+        s = slab[i]
+        perm[offsets[s]] = i
+        offsets[s] += 1
+    return perm, counts
+
+
+@njit(cache=True, parallel=True)
+def _slabs(ux, order, m, out):
+    for i in prange(ux.shape[0]):
+        i0, w0, w1, w2 = _stencil(ux[i], order, m)
+        out[i] = i0 % m
+
+
+@njit(cache=True)
+def _deposit_body(grid, i, ux, uy, uz, w, order):
+    mx, my, mz = grid.shape
+    ix, wx0, wx1, wx2 = _stencil(ux[i], order, mx)
+    iy, wy0, wy1, wy2 = _stencil(uy[i], order, my)
+    iz, wz0, wz1, wz2 = _stencil(uz[i], order, mz)
+    wx = (wx0, wx1, wx2)
+    wy = (wy0, wy1, wy2)
+    wz = (wz0, wz1, wz2)
+    for a in range(3):
+        if wx[a] == 0.0:
+            continue
+        ga = (ix + a) % mx
+        for b in range(3):
+            if wy[b] == 0.0:
+                continue
+            gb = (iy + b) % my
+            wab = w[i] * wx[a] * wy[b]
+            for c in range(3):
+                if wz[c] != 0.0:
+                    grid[ga, gb, (iz + c) % mz] += wab * wz[c]
+
+
+@njit(cache=True, parallel=True)
+def _deposit(ux, uy, uz, w, order, perm, slab_offsets, grid):
+    # blocks of slab_block x-slabs; a body touches at most three slabs from
+    # its own, so blocks two apart never collide. With an odd number of
+    # blocks the last one wraps onto block 0 and gets a pass of its own.
+    n_slabs = slab_offsets.shape[0] - 1
+    n_blocks = (n_slabs + slab_block - 1) // slab_block
+    for parity in range(3):
+        for b in prange(n_blocks):
+            p = b % 2
+            if n_blocks % 2 == 1 and b == n_blocks - 1 and n_blocks > 1:
+                p = 2
+            if p != parity:
+                continue
+            s0 = b * slab_block
+            s1 = min(s0 + slab_block, n_slabs)
+            for k in range(slab_offsets[s0], slab_offsets[s1]):
+                _deposit_body(grid, perm[k], ux, uy, uz, w, order)
+
+
+@njit(cache=True, parallel=True)
+def _force_grid(phi, scale, out):
+    # minus the 4-point central difference of phi, on the first
+    # out.shape[1:] nodes; phi wraps by its own size, which only matters in
+    # the periodic case (the isolated grid has empty margins)
+    mx, my, mz = phi.shape
+    for a in prange(out.shape[1]):
+        a_m2 = (a - 2) % mx
+        a_m1 = (a - 1) % mx
+        a_p1 = (a + 1) % mx
+        a_p2 = (a + 2) % mx
+        for b in range(out.shape[2]):
+            b_m2 = (b - 2) % my
+            b_m1 = (b - 1) % my
+            b_p1 = (b + 1) % my
+            b_p2 = (b + 2) % my
+            for c in range(out.shape[3]):
+                out[0, a, b, c] = -scale[0] * (
+                    8.0 * (phi[a_p1, b, c] - phi[a_m1, b, c])
+                    - (phi[a_p2, b, c] - phi[a_m2, b, c]))
+                out[1, a, b, c] = -scale[1] * (
+                    8.0 * (phi[a, b_p1, c] - phi[a, b_m1, c])
+                    - (phi[a, b_p2, c] - phi[a, b_m2, c]))
+                if mz == 1:
+                    out[2, a, b, c] = 0.0
+                else:
+                    out[2, a, b, c] = -scale[2] * (
+                        8.0 * (phi[a, b, (c + 1) % mz] - phi[a, b, (c - 1) % mz])
+                        - (phi[a, b, (c + 2) % mz] - phi[a, b, (c - 2) % mz]))
+
+
+@njit(cache=True, parallel=True)
+def _interpolate(force, ux, uy, uz, order, out):
+    mx, my, mz = force.shape[1:]
+    for i in prange(ux.shape[0]):
+        ix, wx0, wx1, wx2 = _stencil(ux[i], order, mx)
+        iy, wy0, wy1, wy2 = _stencil(uy[i], order, my)
+        iz, wz0, wz1, wz2 = _stencil(uz[i], order, mz)
+        wx = (wx0, wx1, wx2)
+        wy = (wy0, wy1, wy2)
+        wz = (wz0, wz1, wz2)
+        ax = 0.0
+        ay = 0.0
+        az = 0.0
+        for a in range(3):
+            if wx[a] == 0.0:
+                continue
+            ga = (ix + a) % mx
+            for b in range(3):
+                if wy[b] == 0.0:
+                    continue
+                gb = (iy + b) % my
+                wab = wx[a] * wy[b]
+                for c in range(3):
+                    if wz[c] == 0.0:
+                        continue
+                    gc = (iz + c) % mz
+                    wt = wab * wz[c]
+                    ax += wt * force[0, ga, gb, gc]
+                    ay += wt * force[1, ga, gb, gc]
+                    az += wt * force[2, ga, gb, gc]
+        out[i, 0] = ax
+        out[i, 1] = ay
+        out[i, 2] = az
+
+
+def _isolated_green(shape, h, eps_2):
+    """
+    rfftn of the softened -1 / r potential on the doubled grid, with
+    distances wrapped so the circular convolution is the open-space one.
+    The cell of the body itself gets the cell-averaged potential instead of
+    the (huge) softened value.
+    """
+    key = ('isolated', shape, h, float(eps_2))
+    if key not in _greens:
+        axes = []
+        for m, hk in zip(shape, h):
+            d = np.arange(m)
+            axes.append(np.minimum(d, m - d) * hk)
+        r2 = sum(np.square(a) for a in np.meshgrid(*axes, indexing='ij',
+                                                  sparse=True))
+        g = -1.0 / np.sqrt(r2 + eps_2)
+        flat = [hk for m, hk in zip(shape, h) if m > 1]
+        # mean of 1 / r over a cube (3D) or square (2D) cell of edge h
+        g[0, 0, 0] = -(2.3800774 if len(flat) == 3 else 3.5254988) / max(flat)
+        _greens[key] = np.fft.rfftn(g)
+    return _greens[key]
+
+
+def _periodic_green(shape, h, dim):
+    """
+    rfftn-layout inverse of the discrete 7-point (5-point in 2D) Laplacian,
+    times -4 pi G / cell volume (3D) or -2 pi G / cell area (2D).
+    """
+    key = ('periodic', shape, h, dim)
+    if key not in _greens:
+        k2 = 0.0
+        for axis, (m, hk) in enumerate(zip(shape, h)):
+            if m == 1:
+                continue
+            if axis == len(shape) - 1:
+                f = np.arange(m // 2 + 1)
+            else:
+                f = np.fft.fftfreq(m) * m
+            s = (2.0 / hk * np.sin(np.pi * f / m)) ** 2
+            s = s.reshape([-1 if a == axis else 1 for a in range(len(shape))])
+            k2 = k2 + s
+        volume = np.prod([hk for m, hk in zip(shape, h) if m > 1])
+        const = (4 * np.pi if dim == 3 else 2 * np.pi) / volume
+        with np.errstate(divide='ignore'):
+            g = -const / k2
+        g[(0,) * len(shape)] = 0.0
+        _greens[key] = g
+    return _greens[key]
+
+
+def _grid_coordinates(positions, grid_size, boundary, box):
+    """
+    Bodies in grid units (x, y, z, each float64) plus the physical grid
+    shape and cell size per axis.
+    """
+    n, dim = positions.shape
+    comps = direct.split_components(positions, np.zeros(n), np.float64)[:dim]
+    if boundary == 'periodic':
+        box = np.broadcast_to(np.asarray(box, np.float64), (dim,))
+        shape = [grid_size] * dim
+        h = [float(b) / grid_size for b in box]
+        u = [np.mod(c, b) / hk for c, b, hk in zip(comps, box, h)]
+    else:
+        lo = np.array([c.min() for c in comps])
+        extent = max(float(np.max([c.max() for c in comps] - lo)), 0.0)
+        cell = extent / (grid_size - 2 * margin) if extent > 0 else 1.0
+        shape = [grid_size] * dim
+        h = [cell] * dim
+        u = [(c - l) / cell + margin for c, l in zip(comps, lo)]
+    if dim == 2:
+        u.append(np.zeros(n))
+        shape.append(1)
+        h.append(1.0)
+    return u, tuple(shape), tuple(h)
+
+
+def accelerations(positions, weights, grid_size=grid_size, boundary='isolated',
+                  assignment='tsc', box=None, eps_2=eps_2, out=None):
+    """
+    Particle-mesh accelerations of (n, 2) or (n, 3) positions, G = 1.
+    For boundary='periodic', box is the period (scalar or per axis) and
+    bodies are wrapped into [0, box). Strided views such as
+    particles_ssbo.data['position'] are fine.
+    """
+    positions = np.asarray(positions)
+    n, dim = positions.shape
+    if dim not in (2, 3):
+        raise ValueError('positions must be (n, 2) or (n, 3), got {}'
+                         .format(positions.shape))
+    if boundary not in boundaries:
+        raise ValueError('boundary must be one of {}, got {!r}'
+                         .format(boundaries, boundary))
+    if assignment not in assignments:
+        raise ValueError('assignment must be one of {}, got {!r}'
+                         .format(assignments, assignment))
+    if boundary == 'periodic' and box is None:
+        raise ValueError('periodic boundaries need a box size')
+    order = 2 if assignment == 'cic' else 3
+
+    u, shape, h = _grid_coordinates(positions, _good_size(grid_size)
+                                    if boundary == 'periodic' else grid_size,
+                                    boundary, box)
+    w = np.ascontiguousarray(weights, np.float64)
+
+    if boundary == 'isolated':
+        # the padded grid is the FFT size; the deposit only touches its
+        # physical corner
+        fft_shape = tuple(_good_size(2 * m) if m > 1 else 1 for m in shape)
+        green = _isolated_green(fft_shape, h, eps_2)
+    else:
+        fft_shape = shape
+        green = _periodic_green(shape, h, dim)
+
+    grid = np.zeros(fft_shape)
+    slab = np.empty(n, np.int64)
+    _slabs(u[0], order, shape[0], slab)
+    perm, slab_offsets = _slab_sort(slab, shape[0])
+    _deposit(u[0], u[1], u[2], w, order, perm, slab_offsets,
+             grid[:shape[0], :shape[1], :shape[2]])
+
+    phi = np.fft.irfftn(np.fft.rfftn(grid) * green, fft_shape)
+
+    # accelerations on the physical grid, then back to the bodies
+    scale = np.array([1.0 / (12.0 * hk) for hk in h])
+    force = np.empty((3,) + shape)
+    _force_grid(phi, scale, force)
+    acc = np.empty((n, 3))
+    _interpolate(force, u[0], u[1], u[2], order, acc)
+    if out is None:
+        out = np.empty((n, dim), positions.dtype)
+    out[:] = acc[:, :dim]
+    return out
+
+
+def clear_cache():
+    """
+    Drop the cached Green's functions.
+    """
+    _greens.clear()
+
+
+def _plummer(n_bodies, dim=3, seed=0):
+    # Plummer sphere (or its projection on the plane), unit total mass
+    rs = np.random.RandomState(seed)
+    r = 1.0 / np.sqrt(rs.uniform(0.01, 0.99, n_bodies) ** (-2.0 / 3.0) - 1.0)
+    d = rs.normal(size=(n_bodies, dim))
+    d /= np.linalg.norm(d, axis=1, keepdims=True)
+    return (d * r[:, None]).astype(np.float32), \
+        np.full(n_bodies, 1.0 / n_bodies, np.float32)
+
+
+if __name__ == "__main__":
+    import time
+
+    for dim in (2, 3):
+        accelerations(*_plummer(1000, dim))
+        for n_bodies in (10 ** 5, 10 ** 6, 10 ** 7):
+            p, w = _plummer(n_bodies, dim)
+            for g in ((256, 1024) if dim == 2 else (64, 128)):
+                for assignment in assignments:
+                    t0 = time.perf_counter()
+                    acc = accelerations(p, w, g, assignment=assignment)
+                    t1 = time.perf_counter()
+                    err = direct.force_error(p, w, acc, n_samples=200)
+                    print('{}D n={:>9d} grid={:>4d} {}  {:>8.1f} ms  '
+                          'rms err {:.2e}  p99 err {:.2e}'.format(
+                              dim, n_bodies, g, assignment,
+                              (t1 - t0) * 1000, err.rms, err.p99))
@@ -0,0 +1,375 @@
+"""
+Precision modes for the direct-sum force engine.
+
+The plain float32 engine (direct.accelerations) sums each body's N terms in
+float32, so its error grows with N. These modes keep the float32 pair math
+and only change how the terms are added, or what the coordinates are
+relative to:
+
+    float32      direct.accelerations as is
+    kahan        float32 terms, Kahan-compensated float32 sums
+    pairwise     float32 terms, leaves of leaf_size summed naively and the
+                 leaf sums added as a balanced tree
+    float64_acc  float32 terms, one float64 sum per body over all N terms
+    relative     bodies stored as float32 offsets from float64 group
+                 centers (one per galaxy); differences between groups come
+                 from the float64 centers, so bodies far from the origin
+                 keep their float32 resolution
+    float64      everything in float64, the reference
+
+All modes take (n, 2) or (n, 3) positions; 2D inputs run through the 3D
+kernels with z = 0.
+"""
+
+from __future__ import division
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+from . import direct
+
+eps_2 = direct.eps_2
+
+modes = ('float32', 'kahan', 'pairwise', 'float64_acc', 'relative', 'float64')
+
+block_size = direct.block_size
+tile_size = direct.tile_size
+
+# terms summed naively before the pairwise tree takes over
+leaf_size = 64
+
+# fastmath without 'reassoc', which would let LLVM cancel the compensation
+# term of the Kahan sum
+_no_reassoc = {'nnan', 'ninf', 'nsz', 'arcp', 'contract', 'afn'}
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model='numpy')
+def _float64_acc(x, y, z, w, eps_2, block_size, out):
+    # one float64 sum per body over all j, rounded to float32 once at the end
+    n = x.shape[0]
+    n_blocks = (n + block_size - 1) // block_size
+    for b in prange(n_blocks):
+        i0 = b * block_size
+        i1 = min(i0 + block_size, n)
+        for i in range(i0, i1):
+            xi = x[i]
+            yi = y[i]
+            zi = z[i]
+            axi = 0.0
+            ayi = 0.0
+            azi = 0.0
+            for j in range(n):
+                rx = x[j] - xi
+                ry = y[j] - yi
+                rz = z[j] - zi
+                sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+                s = w[j] / (sqr_dist * math.sqrt(sqr_dist))
+                axi += np.float64(rx * s)
+                ayi += np.float64(ry * s)
+                azi += np.float64(rz * s)
+            out[i, 0] = axi
+            out[i, 1] = ayi
+            out[i, 2] = azi
+
+
+@njit(cache=True, parallel=True, fastmath=_no_reassoc, error_model='numpy')
+def _kahan(x, y, z, w, eps_2, block_size, out):
+    # the i loop is innermost so the serial Kahan update vectorizes across
+    # bodies instead of needing a reassociated reduction over j
+    n = x.shape[0]
+    n_blocks = (n + block_size - 1) // block_size
+    zero = x.dtype.type(0.0)
+    for b in prange(n_blocks):
+        i0 = b * block_size
+        i1 = min(i0 + block_size, n)
+        xb = x[i0:i1]
+        yb = y[i0:i1]
+        zb = z[i0:i1]
+        m = xb.shape[0]
+        sx = np.zeros(m, x.dtype)
+        sy = np.zeros(m, x.dtype)
+        sz = np.zeros(m, x.dtype)
+        cx = np.zeros(m, x.dtype)
+        cy = np.zeros(m, x.dtype)
+        cz = np.zeros(m, x.dtype)
+        for j in range(n):
+            xj = x[j]
+            yj = y[j]
+            zj = z[j]
+            wj = w[j]
+            for ii in range(m):
+                rx = xj - xb[ii]
+                ry = yj - yb[ii]
+                rz = zj - zb[ii]
+                sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+                s = wj / (sqr_dist * math.sqrt(sqr_dist))
+                t = rx * s - cx[ii]
+                u = sx[ii] + t
+                cx[ii] = (u - sx[ii]) - t
+                sx[ii] = u
+                t = ry * s - cy[ii]
+                u = sy[ii] + t
+                cy[ii] = (u - sy[ii]) - t
+                sy[ii] = u
+                t = rz * s - cz[ii]
+                u = sz[ii] + t
+                cz[ii] = (u - sz[ii]) - t
+                sz[ii] = u
+        for ii in range(m):
+            out[i0 + ii, 0] = sx[ii] + zero
+            out[i0 + ii, 1] = sy[ii] + zero
+            out[i0 + ii, 2] = sz[ii] + zero
+
+
+@njit(cache=True, inline='always')
+def _tree_sum(part, count):
+    # balanced pairwise sum of part[:count], in place
+    while count > 1:
+        half = count // 2
+        for k in range(half):
+            part[k] = part[2 * k] + part[2 * k + 1]
+        if count % 2:
+            part[half] = part[count - 1]
+            count = half + 1
+        else:
+            count = half
+    return part[0]
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model='numpy')
+def _pairwise(x, y, z, w, eps_2, block_size, leaf_size, out):
+    n = x.shape[0]
+    n_leaves = (n + leaf_size - 1) // leaf_size
+    n_blocks = (n + block_size - 1) // block_size
+    for b in prange(n_blocks):
+        # leaf sums of one body, reused by every body of the block
+        px = np.empty(n_leaves, x.dtype)
+        py = np.empty(n_leaves, x.dtype)
+        pz = np.empty(n_leaves, x.dtype)
+        i0 = b * block_size
+        i1 = min(i0 + block_size, n)
+        for i in range(i0, i1):
+            xi = x[i]
+            yi = y[i]
+            zi = z[i]
+            for leaf in range(n_leaves):
+                j0 = leaf * leaf_size
+                j1 = min(j0 + leaf_size, n)
+                xt = x[j0:j1]
+                yt = y[j0:j1]
+                zt = z[j0:j1]
+                wt = w[j0:j1]
+                axi = x.dtype.type(0.0)
+                ayi = x.dtype.type(0.0)
+                azi = x.dtype.type(0.0)
+                for j in range(xt.shape[0]):
+                    rx = xt[j] - xi
+                    ry = yt[j] - yi
+                    rz = zt[j] - zi
+                    sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+                    s = wt[j] / (sqr_dist * math.sqrt(sqr_dist))
+                    axi += rx * s
+                    ayi += ry * s
+                    azi += rz * s
+                px[leaf] = axi
+                py[leaf] = ayi
+                pz[leaf] = azi
+            out[i, 0] = _tree_sum(px, n_leaves)
+            out[i, 1] = _tree_sum(py, n_leaves)
+            out[i, 2] = _tree_sum(pz, n_leaves)
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model='numpy')
+def _relative(cx, cy, cz, group_start, ox, oy, oz, w, group, eps_2,
+              block_size, tile_size, out):
+    # bodies are sorted by group, group g owns [group_start[g], group_start[g + 1])
+    n = ox.shape[0]
+    n_groups = cx.shape[0]
+    n_blocks = (n + block_size - 1) // block_size
+    for b in prange(n_blocks):
+        i0 = b * block_size
+        i1 = min(i0 + block_size, n)
+        for i in range(i0, i1):
+            gi = group[i]
+            xi = ox[i]
+            yi = oy[i]
+            zi = oz[i]
+            # the float32 tile sums are added up in float64 and rounded once
+            sx = 0.0
+            sy = 0.0
+            sz = 0.0
+            for g in range(n_groups):
+                # center difference in float64, then one rounding to float32
+                dx = ox.dtype.type(cx[g] - cx[gi])
+                dy = ox.dtype.type(cy[g] - cy[gi])
+                dz = ox.dtype.type(cz[g] - cz[gi])
+                for j0 in range(group_start[g], group_start[g + 1], tile_size):
+                    j1 = min(j0 + tile_size, group_start[g + 1])
+                    xt = ox[j0:j1]
+                    yt = oy[j0:j1]
+                    zt = oz[j0:j1]
+                    wt = w[j0:j1]
+                    axi = ox.dtype.type(0.0)
+                    ayi = ox.dtype.type(0.0)
+                    azi = ox.dtype.type(0.0)
+                    for j in range(xt.shape[0]):
+                        rx = (xt[j] - xi) + dx
+                        ry = (yt[j] - yi) + dy
+                        rz = (zt[j] - zi) + dz
+                        sqr_dist = rx * rx + ry * ry + rz * rz + eps_2
+                        s = wt[j] / (sqr_dist * math.sqrt(sqr_dist))
+                        axi += rx * s
+                        ayi += ry * s
+                        azi += rz * s
+                    sx += np.float64(axi)
+                    sy += np.float64(ayi)
+                    sz += np.float64(azi)
+            out[i, 0] = sx
+            out[i, 1] = sy
+            out[i, 2] = sz
+
+
+def _components_3d(positions, weights, dtype):
+    comps = direct.split_components(positions, weights, dtype)
+    if positions.shape[1] == 2:
+        comps.insert(2, np.zeros(len(positions), dtype))
+    return comps
+
+
+def to_relative(positions, weights, groups=None):
+    """
+    Split float64 positions into float64 group centers (mass-weighted, one
+    row per group) and float32 offsets from their group's center. groups
+    gives the group of every body; None puts all bodies in one group.
+    """
+    positions = np.asarray(positions, np.float64)
+    weights = np.asarray(weights, np.float64)
+    if groups is None:
+        groups = np.zeros(len(positions), np.int64)
+    groups = np.asarray(groups, np.int64)
+    n_groups = groups.max() + 1 if len(groups) else 0
+    mass = np.bincount(groups, weights, minlength=n_groups)
+    mass = np.where(mass > 0, mass, 1.0)
+    centers = np.empty((n_groups, positions.shape[1]))
+    for k in range(positions.shape[1]):
+        centers[:, k] = np.bincount(groups, weights * positions[:, k],
+                                    minlength=n_groups) / mass
+    offsets = (positions - centers[groups]).astype(np.float32)
+    return centers, offsets
+
+
+def relative_accelerations(centers, offsets, groups, weights, eps_2=eps_2,
+                           out=None, block_size=block_size, tile_size=tile_size):
+    """
+    Float32 accelerations of bodies stored as float32 offsets from float64
+    group centers: body i is at centers[groups[i]] + offsets[i].
+    """
+    offsets = np.asarray(offsets)
+    n, dim = offsets.shape
+    groups = np.asarray(groups, np.int64)
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    group_start = np.searchsorted(sorted_groups, np.arange(len(centers) + 1))
+    o = _components_3d(offsets[order], np.asarray(weights)[order], np.float32)
+    c = _components_3d(np.asarray(centers, np.float64), np.zeros(len(centers)),
+                       np.float64)
+    acc = np.empty((n, 3), np.float32)
+    _relative(c[0], c[1], c[2], group_start, o[0], o[1], o[2], o[3],
+              sorted_groups, np.float32(eps_2), block_size, tile_size, acc)
+    if out is None:
+        out = np.empty((n, dim), np.float32)
+    out[order] = acc[:, :dim]
+    return out
+
+
+def accelerations(positions, weights, precision='kahan', eps_2=eps_2,
+                  out=None, groups=None):
+    """
+    Direct-sum accelerations with the given precision mode (see modes).
+    Results are float32 except for 'float64'. groups is only used by
+    'relative', where positions should be float64 to begin with.
+    """
+    positions = np.asarray(positions)
+    n, dim = positions.shape
+    if dim not in (2, 3):
+        raise ValueError('positions must be (n, 2) or (n, 3), got {}'
+                         .format(positions.shape))
+    if precision == 'float32':
+        return direct.accelerations(positions.astype(np.float32, copy=False),
+                                    np.asarray(weights, np.float32), eps_2, out)
+    if precision == 'float64':
+        return direct.accelerations(positions.astype(np.float64, copy=False),
+                                    np.asarray(weights, np.float64), eps_2, out)
+    if precision == 'relative':
+        centers, offsets = to_relative(positions, weights, groups)
+        if groups is None:
+            groups = np.zeros(n, np.int64)
+        return relative_accelerations(centers, offsets, groups, weights,
+                                      eps_2, out)
+    if precision not in modes:
+        raise ValueError('unknown precision mode {!r}, expected one of {}'
+                         .format(precision, modes))
+
+    x, y, z, w = _components_3d(positions, weights, np.float32)
+    acc = np.empty((n, 3), np.float32)
+    if precision == 'kahan':
+        _kahan(x, y, z, w, np.float32(eps_2), block_size, acc)
+    elif precision == 'pairwise':
+        _pairwise(x, y, z, w, np.float32(eps_2), block_size, leaf_size, acc)
+    else:
+        _float64_acc(x, y, z, w, np.float32(eps_2), block_size, acc)
+    if out is None:
+        out = np.empty((n, dim), np.float32)
+    out[:] = acc[:, :dim]
+    return out
+
+
+def _galaxies(n_bodies, n_galaxies=4, spread=100.0, size=5.0, seed=0):
+    # NBodySimulation-like layout: compact disks far apart from each other
+    # and from the origin, in float64
+    rs = np.random.RandomState(seed)
+    groups = np.arange(n_bodies) % n_galaxies
+    centers = rs.uniform(-spread, spread, (n_galaxies, 3))
+    r = size * rs.lognormal(sigma=0.5, size=n_bodies) / 2
+    t = rs.uniform(0, 2 * np.pi, n_bodies)
+    disk = np.column_stack([r * np.cos(t), rs.normal(0, 0.05 * size, n_bodies),
+                            r * np.sin(t)])
+    positions = centers[groups] + disk
+    weights = np.full(n_bodies, 1e-4)
+    weights[:n_galaxies] = 10.0
+    return positions, weights, groups
+
+
+def benchmark(sizes=(4096, 16384, 65536), repeat=3, n_samples=1000):
+    """
+    Time every mode on galaxy-like inputs. Two errors are reported: 'sum'
+    against the float64 direct sum over the mode's own inputs (the error of
+    the arithmetic alone) and 'total' against the float64 sum over the
+    float64 positions. The float32 modes get the positions rounded to
+    float32, as they would be stored, so their total error includes that
+    rounding.
+    """
+    from timeit import repeat as _repeat
+
+    for n in sizes:
+        positions, weights, groups = _galaxies(n)
+        p32 = positions.astype(np.float32)
+        for mode in modes:
+            p = positions if mode in ('relative', 'float64') else p32
+            f = lambda: accelerations(p, weights, mode, groups=groups)
+            acc = f()
+            t = min(_repeat(f, number=1, repeat=repeat))
+            sum_err = direct.force_error(p, weights, acc, n_samples=n_samples)
+            err = direct.force_error(positions, weights, acc,
+                                     n_samples=n_samples)
+            print('n={:>6d}  {:<12s} {:>9.1f} ms  {:>5.2f} Ginter/s  '
+                  'sum err rms {:.1e} max {:.1e}  '
+                  'total err rms {:.1e} max {:.1e}'.format(
+                      n, mode, t * 1000, n * n / t / 1e9, sum_err.rms,
+                      sum_err.max, err.rms, err.max))
+
+
+if __name__ == "__main__":
+    benchmark()
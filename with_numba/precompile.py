@@ -0,0 +1,207 @@
+"""
+Build every engine kernel up front.
+
+The numba kernels are compiled with cache=True, so the machine code is
+stored next to the sources (or under NUMBA_CACHE_DIR), keyed by signature
+and a hash of the source file. A later process with the same sources,
+numba version and CPU loads it instead of compiling. warmup() calls each
+engine once on tiny inputs of the types the engines run with, so one step
+(after an install, in a CI cache job, at the start of a batch job) fills
+the cache or loads all of it:
+
+    python -m with_numba.precompile [--cuda]
+
+CompileTimer measures the time spent in numba's compiler, compiling or
+loading from the cache, apart from the run time around it.
+"""
+
+from __future__ import division
+
+import time
+from collections import namedtuple
+
+import numpy as np
+from numba.core import event
+
+from . import (barnes_hut, direct, ensemble, fmm, integrators, particles, pm,
+               precision)
+
+# (name, compile seconds, run seconds, kernels compiled rather than loaded)
+Warmup = namedtuple('Warmup', ['name', 'compile_time', 'run_time',
+                               'compiled'])
+
+# bodies of the warm-up inputs
+n_bodies = 64
+
+
+class CompileTimer(object):
+    """
+    Context manager: seconds spent in numba's compiler while active
+    (including cache loads), and how many functions it compiled from
+    scratch. Counts compilations on every thread.
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.compiled = 0
+
+    def __enter__(self):
+        self._timer = event.TimingListener()
+        self._recorder = event.RecordingListener()
+        # the compiler lock is held for cache loads and compilations alike
+        event.register('numba:compiler_lock', self._timer)
+        event.register('numba:compile', self._recorder)
+        return self
+
+    def __exit__(self, *exc):
+        event.unregister('numba:compiler_lock', self._timer)
+        event.unregister('numba:compile', self._recorder)
+        if self._timer.done:
+            self.seconds = self._timer.duration
+        self.compiled = sum(1 for _, e in self._recorder.buffer
+                            if e.is_start)
+
+
+def timed(f, *args, **kw):
+    """
+    Call f and return (result, compile seconds, run seconds).
+    """
+    with CompileTimer() as timer:
+        start = time.perf_counter()
+        result = f(*args, **kw)
+        total = time.perf_counter() - start
+    return result, timer.seconds, total - timer.seconds
+
+
+def _bodies(dim, dtype, n=n_bodies):
+    rs = np.random.RandomState(0)
+    return (rs.uniform(-1.0, 1.0, (n, dim)).astype(dtype),
+            rs.uniform(1.0, 2.0, n).astype(dtype))
+
+
+def _direct():
+    for dtype in (np.float32, np.float64):
+        for dim in (2, 3):
+            p, w = _bodies(dim, dtype)
+            direct.accelerations(p, w)
+            direct.symmetric_accelerations(p, w)
+    p, w = _bodies(3, np.float64)
+    direct.accelerations_at(p[:4], p, w)
+    direct.accelerations_jerks(p, p[::-1].copy(), w)
+
+
+def _precision():
+    for dim in (2, 3):
+        p, w = _bodies(dim, np.float64)
+        for mode in precision.modes:
+            precision.accelerations(p if mode in ('relative', 'float64')
+                                    else p.astype(np.float32), w, mode)
+
+
+def _trees():
+    for dim in (2, 3):
+        barnes_hut.accelerations(*_bodies(dim, np.float32))
+    fmm.accelerations(*_bodies(2, np.float64))
+
+
+def _pm():
+    for dim in (2, 3):
+        p, w = _bodies(dim, np.float32)
+        for assignment in pm.assignments:
+            pm.accelerations(p, w, 16, 'isolated', assignment)
+            pm.accelerations(p + 1, w, 16, 'periodic', assignment, box=2.0)
+
+
+def _integrators():
+    p, w = _bodies(3, np.float64)
+    v = np.zeros_like(p)
+    integrators.leapfrog_step(p, v, w, 1e-3)
+    integrators.velocity_verlet_step(p, v, w, 1e-3)
+    integrators.hermite_step(p, v, w, 1e-3)
+    integrators.energy(p, v, w)
+    integrators.BlockHermite(p, v, w, 1e-3).advance()
+
+
+def _ensemble():
+    for dim in (2, 3):
+        x, v, m = ensemble.make_ensemble(2, 8, dim)
+        ensemble.ensemble_accelerations(x, m)
+        ensemble.ensemble_leapfrog(x, v, m, 1e-3, 1)
+
+
+def _particles():
+    for dim in (2, 3):
+        p, w = _bodies(dim, np.float32)
+        ps = particles.ParticleSet.from_arrays(p, w)
+        ps.unpack(ps.pack())
+        integrators.advance(ps, 1e-3)
+
+
+def _cuda():
+    from numba import cuda
+    if not cuda.is_available():
+        print('No CUDA device, skipping the CUDA kernels')
+        return
+    from . import bench_cuda
+    p, w = bench_cuda.make_nbody_samples(bench_cuda.tile_size)
+    bench_cuda.NBodyCUDARunner(p, w).run()
+    for dtype in (np.float32, np.float64):
+        kernel = bench_cuda.addmul_f32 if dtype == np.float32 \
+            else bench_cuda.addmul_f64
+        x = cuda.to_device(np.zeros(512, dtype))
+        kernel[1, 512](x, x, x)
+    n = 512
+    bench_cuda.black_scholes_cuda[1, 512](
+        *([cuda.to_device(np.zeros(n)) for _ in range(5)] +
+          [bench_cuda.RISKFREE, bench_cuda.VOLATILITY]))
+    bench_cuda.no_op[1, 1]()
+    cuda.synchronize()
+
+
+# engines in the order warmup() builds them
+engines = [
+    ('direct', _direct),
+    ('precision', _precision),
+    ('barnes_hut / fmm', _trees),
+    ('pm', _pm),
+    ('integrators', _integrators),
+    ('ensemble', _ensemble),
+    ('particles', _particles),
+]
+
+
+def warmup(cuda=False, log=print):
+    """
+    Compile, or load from the cache, every engine kernel. With cuda=True
+    the bench_cuda kernels are built too when a device is present. Returns
+    a Warmup per engine.
+    """
+    results = []
+    for name, build in engines + ([('cuda', _cuda)] if cuda else []):
+        with CompileTimer() as timer:
+            start = time.perf_counter()
+            build()
+            total = time.perf_counter() - start
+        result = Warmup(name, timer.seconds, total - timer.seconds,
+                        timer.compiled)
+        results.append(result)
+        if log is not None:
+            log('{:<18s} compile {:>7.2f} s  run {:>7.3f} s  '
+                '{} functions compiled'.format(*result))
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m with_numba.precompile',
+        description='Compile every engine kernel into the numba cache.')
+    parser.add_argument('--cuda', action='store_true',
+                        help='also build the CUDA kernels, if there is a device')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    results = warmup(cuda=args.cuda)
+    print('{:.2f} s total, {:.2f} s compiling or loading'.format(
+        time.perf_counter() - start,
+        sum(r.compile_time for r in results)))